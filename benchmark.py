@@ -0,0 +1,206 @@
+#! /usr/bin/env python3
+"""Benchmarks for the bot's data structures.
+
+Usage: benchmark.py [benchmark name...]
+Runs all benchmarks if none are named.
+"""
+import json
+import sys
+import time
+import timeit
+import tracemalloc
+
+from discord.ext.commands import Bot
+
+import vampbot
+from vampchar.sheet import Character
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register a benchmark under its function name."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def _sample_character(number):
+    """Make a character with a typical amount of detail."""
+    character = Character()
+    character.player = 'Player {}'.format(number)
+    character.character = 'Character {}'.format(number)
+    character.clan = 'Toreador'
+    character.attributes['physical'].value = 5
+    character.attributes['physical'].focuses.append('dexterity')
+    character.skills['brawl'] = 3
+    character.disciplines['auspex'] = 2
+    character.award_xp(5, 'Attended the session')
+    character.notes.append('Owes a boon to the prince')
+    return character
+
+
+def _measure(make, count):
+    """Return the bytes allocated per item when making `count` items."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = [make(number) for number in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(items) == count
+    return (after - before) / count
+
+
+@benchmark
+def memory(count=10000):
+    """Compare the memory used by characters and their plain dict form."""
+    slotted = _measure(_sample_character, count)
+    plain = _measure(
+        lambda number: json.loads(
+            json.dumps(_sample_character(number).to_dict())),
+        count,
+    )
+    print('{} characters:'.format(count))
+    print('  Character objects: {:,.0f} bytes each'.format(slotted))
+    print('  Plain dicts:       {:,.0f} bytes each'.format(plain))
+    print('  Saving:            {:.0%}'.format(1 - slotted / plain))
+
+
+@benchmark
+def dots(number=20000):
+    """Compare building dotted ratings with looking them up in tables."""
+    def build():
+        for value in (7, 8, 12):
+            vampbot._build_attribute_dots(value)  # pylint: disable=W0212
+        for value in range(12):
+            vampbot._build_rating_dots(value % 6)  # pylint: disable=W0212
+        for current in (8, 4):
+            vampbot._build_dots(current, 20, 15)  # pylint: disable=W0212
+
+    def look_up():
+        for value in (7, 8, 12):
+            vampbot.ATTRIBUTE_DOTS[value]  # pylint: disable=W0104
+        for value in range(12):
+            vampbot.RATING_DOTS[value % 6]  # pylint: disable=W0104
+        for current in (8, 4):
+            vampbot._resource_dots(current, 20)  # pylint: disable=W0212
+
+    built = timeit.timeit(build, number=number) / number
+    looked_up = timeit.timeit(look_up, number=number) / number
+    print('Dots for one sheet ({} runs):'.format(number))
+    print('  Built:     {:.2f} us'.format(built * 1e6))
+    print('  Looked up: {:.2f} us'.format(looked_up * 1e6))
+    print('  Speedup:   {:.1f}x'.format(built / looked_up))
+
+
+def _generate_partials(group):
+    """Generate aliases for all partial matches of commands, recursively, as
+    the bot used to when starting."""
+    commands = group.all_commands
+
+    groups = []
+    aliases_mapping = {}
+
+    for command_name, command in commands.items():
+        if hasattr(command, 'commands'):
+            groups.append(command_name)
+        found_unambiguous = False
+        for pos in range(1, len(command_name)):
+            sub = command_name[:pos]
+            if found_unambiguous:
+                aliases_mapping[command_name].append(sub)
+            elif any(c.startswith(sub) for c in commands
+                     if c != command_name):
+                # This would be an ambiguous alias
+                continue
+            else:
+                aliases_mapping[command_name] = [sub]
+                found_unambiguous = True
+
+    for command_name, aliases in aliases_mapping.items():
+        command = commands[command_name]
+        command.aliases.extend(aliases)
+        group.remove_command(command_name)
+        group.add_command(command)
+
+    for sub_group in groups:
+        _generate_partials(commands[sub_group])
+
+
+def _command_names(group):
+    """Get the names of a group's commands, with those of any subgroups."""
+    return {
+        name: (
+            _command_names(command) if hasattr(command, 'commands') else None
+        )
+        for name, command in group.all_commands.items()
+    }
+
+
+def _make_bot(names, group=None):
+    """Make a bot with commands of the given names that do nothing."""
+    async def nothing(ctx):  # pylint: disable=W0613
+        pass
+
+    if group is None:
+        group = Bot(command_prefix='!')
+    for name, subcommands in names.items():
+        if name in group.all_commands:
+            continue
+        if subcommands is None:
+            group.command(name)(nothing)
+        else:
+            _make_bot(subcommands, group.group(name)(nothing))
+    return group
+
+
+def _count_keys(group):
+    """Count the entries in a group's command tables, recursively."""
+    return len(group.all_commands) + sum(
+        _count_keys(command) for command in group.commands
+        if hasattr(command, 'commands')
+    )
+
+
+@benchmark
+def commands(number=20):
+    """Compare making command aliases for every prefix at startup with
+    resolving prefixes when commands are used, for the bot's commands and
+    for a made up set of 300 commands sharing many prefixes."""
+    print("The bot's commands:")
+    _compare_command_setup(_command_names(vampbot.CLIENT), number)
+    print('300 made up commands:')
+    _compare_command_setup({
+        '{}_{}'.format(verb, thing): None
+        for verb in ('get', 'set', 'show', 'spend', 'gain', 'buy')
+        for thing in range(50)
+    }, max(number // 10, 1))
+
+
+def _compare_command_setup(names, number):
+    """Time setting up abbreviations both ways for commands of the given
+    names."""
+    results = {}
+    for name, setup in (
+            ('Aliases', _generate_partials),
+            ('Prefix trie', vampbot.resolve_prefixes),
+    ):
+        taken = 0
+        for _ in range(number):
+            bot = _make_bot(names)
+            start = time.perf_counter()
+            setup(bot)
+            taken += time.perf_counter() - start
+        lookup = timeit.timeit(lambda: bot.all_commands.get('sh'),
+                               number=100000) / 100000
+        results[name] = taken / number
+        print('  {:<12} startup {:7.2f} ms, {:4} table entries, '
+              'lookup {:.2f} us'.format(
+                  name, taken / number * 1e3, _count_keys(bot), lookup * 1e6))
+    print('  Startup speedup: {:.1f}x'.format(
+        results['Aliases'] / results['Prefix trie']))
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print('== {} =='.format(name))
+        BENCHMARKS[name]()
@@ -0,0 +1,22 @@
+#! /usr/bin/env python3
+"""Copy a vampire session save into an SQLite database."""
+import json
+import sys
+
+from vampchar.sqlstorage import DATABASE_NAME, migrate
+
+
+def load_config(path):
+    """Load the configuration"""
+    with open(path, encoding='utf-8') as conf_handle:
+        return json.load(conf_handle)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        SAVE_PATH = sys.argv[1]
+    else:
+        SAVE_PATH = load_config('config.json')['vamp_save_path']
+    COUNT = migrate(SAVE_PATH)
+    print('Migrated {} players into {}.'.format(COUNT, DATABASE_NAME))
+    print('Set "storage": "sqlite" in config.json to use it.')
@@ -1,46 +1,517 @@
 #! /usr/bin/env python3
 # pylint: disable=C0302
 """Discord based game bot."""
+import asyncio
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import cProfile
+from functools import partial
 import json
 from math import ceil
+import os
+import pstats
 import random
 import signal
 import sys
+import threading
+import time
+from weakref import WeakValueDictionary
 
-from discord import Embed, Game
-from discord.ext.commands import Bot, is_owner
+from discord import Embed, Game, HTTPException, NotFound
+from discord.ext.commands import Bot, Command, Context, is_owner
 import websockets
 
-from vampchar.session import BadInput, Session
+from vampchar.manager import SessionManager
+from vampchar.session import BadInput, parse_batch
+from vampchar.snapshot import write_atomically
+
+MESSAGE_LIMIT = 2000
+EMBED_FIELD_LIMIT = 1024
+PAGE_PREVIOUS = '\u2b05\ufe0f'
+PAGE_NEXT = '\u27a1\ufe0f'
+# How long a paged message can be turned for, in seconds
+PAGING_TIMEOUT = 300
+
+
+class _Channel:  # pylint: disable=R0903
+    """Messages waiting to be sent to a channel, and when it was last sent
+    to."""
+    __slots__ = ('pending', 'ready', 'sent_times')
+
+    def __init__(self, rate):
+        # (time queued, content, embed, future, whether it may be merged)
+        # for each message
+        self.pending = deque()
+        self.ready = asyncio.Event()
+        self.sent_times = deque(maxlen=rate)
+
+
+class Outbox:  # pylint: disable=R0902
+    """Messages to send, queued per channel and sent in order by a task for
+    each channel.
+
+    Sends to a channel are spaced so that no more than `rate` are sent every
+    `per` seconds, which is Discord's limit, rather than waiting to be told
+    to slow down. Consecutive short text messages are merged into one, and
+    short messages wait `window` seconds for others to be merged with them.
+    A channel's task stops when nothing has been queued for it for `idle`
+    seconds.
+    """
+    def __init__(self, rate=5, per=5.0, window=0.1,  # pylint: disable=R0913
+                 short=500, idle=60):
+        self.rate = rate
+        self.per = per
+        self.window = window
+        self.short = short
+        self.idle = idle
+        self.channels = {}
+        self.max_depth = 0
+        self.sent = 0
+        self.merged = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def send(self, channel, content=None, embed=None, merge=True):
+        """Queue a message to a channel. Returns a future of the message
+        once sent, which may include other messages merged with it unless
+        `merge` is false, e.g. for a message that will be edited."""
+        queue = self.channels.get(channel.id)
+        if queue is None:
+            queue = self.channels[channel.id] = _Channel(self.rate)
+            asyncio.ensure_future(self._run(channel, queue))
+        future = asyncio.get_event_loop().create_future()
+        if content is not None:
+            content = str(content)
+        queue.pending.append(
+            (time.monotonic(), content, embed, future, merge))
+        queue.ready.set()
+        self.max_depth = max(self.max_depth, len(queue.pending))
+        return future
+
+    def _is_short(self, message):
+        """Check whether a queued message can be merged with others."""
+        _, content, embed, _, merge = message
+        return (
+            merge and embed is None and content is not None
+            and len(content) <= self.short
+        )
+
+    async def _run(self, channel, queue):
+        """Send a channel's messages as they are queued, until the channel
+        is idle or the task is stopped."""
+        try:
+            await self._send_queued(channel, queue)
+        finally:
+            if self.channels.get(channel.id) is queue:
+                del self.channels[channel.id]
+            # Anything still queued would otherwise wait forever
+            while queue.pending:
+                future = queue.pending.popleft()[3]
+                if not future.done():
+                    future.set_exception(RuntimeError(
+                        'Stopped sending to {}.'.format(channel.id)))
+
+    async def _send_queued(self, channel, queue):
+        """Send a channel's messages as they are queued, returning once none
+        have been queued for `idle` seconds."""
+        while True:
+            if not queue.pending:
+                queue.ready.clear()
+                try:
+                    await asyncio.wait_for(queue.ready.wait(), self.idle)
+                except asyncio.TimeoutError:
+                    if not queue.pending:
+                        return
+                continue
 
-CLIENT = Bot(command_prefix='!')
+            if len(queue.sent_times) == self.rate:
+                delay = queue.sent_times[0] + self.per - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if self._is_short(queue.pending[0]):
+                await asyncio.sleep(self.window)
+
+            messages = [queue.pending.popleft()]
+            content, embed = messages[0][1:3]
+            while (
+                    self._is_short(messages[0]) and queue.pending
+                    and self._is_short(queue.pending[0])
+                    and len(content) + len(queue.pending[0][1]) < MESSAGE_LIMIT
+            ):
+                messages.append(queue.pending.popleft())
+                content += '\n' + messages[-1][1]
+
+            await self._send(channel, content, embed, messages)
+            queue.sent_times.append(time.monotonic())
+
+    async def _send(self, channel, content, embed, messages):
+        """Send merged messages, then record how long they waited."""
+        error = None
+        try:
+            sent = await channel.send(content, embed=embed)
+        except asyncio.CancelledError:
+            for message in messages:
+                message[3].cancel()
+            raise
+        except HTTPException as err:
+            sys.stderr.write('Could not send to {}: {}\n'.format(
+                channel.id, err))
+            sent = None
+        except Exception as err:  # pylint: disable=W0703
+            # Fail these messages but keep sending the rest
+            sys.stderr.write('Could not send to {}: {!r}\n'.format(
+                channel.id, err))
+            error = err
+        now = time.monotonic()
+        self.sent += 1
+        self.merged += len(messages) - 1
+        for queued, _, _, future, _ in messages:
+            self.total_wait += now - queued
+            self.max_wait = max(self.max_wait, now - queued)
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(sent)
+            else:
+                future.set_exception(error)
+
+    def metrics(self):
+        """Return details of the queues and of messages sent so far."""
+        queued = self.sent + self.merged
+        return {
+            'channels': len(self.channels),
+            'depth': sum(
+                len(queue.pending) for queue in self.channels.values()),
+            'max_depth': self.max_depth,
+            'sent': self.sent,
+            'merged': self.merged,
+            'mean_wait': self.total_wait / queued if queued else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0,
+)
+# Parts of a command that are timed, then the whole command
+STAGES = ('parse', 'session', 'render', 'send', 'total')
+
+
+class Histogram:
+    """Counts of values in fixed buckets, along with their sum."""
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        # The last bucket has no upper bound
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Count a value."""
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        """The number of values counted."""
+        return sum(self.counts)
+
+    def quantile(self, fraction):
+        """Return the upper bound of the bucket holding the given fraction of
+        values, or None if that is the unbounded bucket."""
+        needed = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            seen += count
+            if seen >= needed:
+                return bound
+        return None
+
+
+def _escape_label(value):
+    """Escape a Prometheus label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+class CommandStats:
+    """Latency histograms for each stage of each command, and counts of
+    how often each command succeeded and failed, and of replies that could
+    not be sent."""
+    def __init__(self):
+        self.histograms = {}
+        self.outcomes = Counter()
+        self.failed_sends = Counter()
+
+    def observe(self, command, stage, seconds):
+        """Record how long a stage of a command took."""
+        histogram = self.histograms.get((command, stage))
+        if histogram is None:
+            histogram = self.histograms[command, stage] = Histogram()
+        histogram.observe(seconds)
+
+    def count(self, command, outcome):
+        """Count a command's outcome, e.g. ok or failed."""
+        self.outcomes[command, outcome] += 1
+
+    def summary(self):
+        """Return a line describing each command's latency, busiest
+        first."""
+        lines = []
+        commands = Counter()
+        for (command, _), count in self.outcomes.items():
+            commands[command] += count
+        for command, count in commands.most_common():
+            total = self.histograms.get((command, 'total'))
+            if total is None:
+                continue
+            p90 = total.quantile(0.9)
+            lines.append(
+                '{}: {} runs, {} failed, mean {:.1f}ms ({}), p90 {}'.format(
+                    command, count, self.outcomes[command, 'failed'],
+                    total.sum / total.count * 1e3,
+                    ', '.join(
+                        '{} {:.1f}'.format(
+                            stage, self.histograms[command, stage].sum
+                            / self.histograms[command, stage].count * 1e3)
+                        for stage in STAGES[:-1]
+                        if (command, stage) in self.histograms
+                    ),
+                    '<= {:g}ms'.format(p90 * 1e3) if p90 else '> 10s',
+                ))
+        return lines
+
+    def prometheus(self):
+        """Return the stats in Prometheus' text format."""
+        lines = [
+            '# HELP gamebot_command_seconds Time taken by bot commands, '
+            'by stage.',
+            '# TYPE gamebot_command_seconds histogram',
+        ]
+        for (command, stage), histogram in sorted(self.histograms.items()):
+            labels = 'command="{}",stage="{}"'.format(
+                _escape_label(command), stage)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',),
+                                    histogram.counts):
+                cumulative += count
+                lines.append('gamebot_command_seconds_bucket{{{},le="{}"}} '
+                             '{}'.format(labels, bound, cumulative))
+            lines.append('gamebot_command_seconds_sum{{{}}} {}'.format(
+                labels, histogram.sum))
+            lines.append('gamebot_command_seconds_count{{{}}} {}'.format(
+                labels, cumulative))
+        lines.extend([
+            '# HELP gamebot_commands_total Bot commands run, by outcome.',
+            '# TYPE gamebot_commands_total counter',
+        ])
+        for (command, outcome), count in sorted(self.outcomes.items()):
+            lines.append(
+                'gamebot_commands_total{{command="{}",outcome="{}"}} '
+                '{}'.format(_escape_label(command), outcome, count))
+        lines.extend([
+            '# HELP gamebot_failed_sends_total Bot replies that could not be '
+            'sent, by command.',
+            '# TYPE gamebot_failed_sends_total counter',
+        ])
+        for command, count in sorted(self.failed_sends.items()):
+            lines.append('gamebot_failed_sends_total{{command="{}"}} '
+                         '{}'.format(_escape_label(command), count))
+        return '\n'.join(lines) + '\n'
+
+
+class QueuedContext(Context):
+    """A command context whose replies are sent through the outbox.
+    Replies return a future of the sent message rather than the message.
+    How long each stage of the command takes is noted in `timings`, and the
+    key of any session it uses, which is held until it finishes, in
+    `session_key`."""
+    def __init__(self, **attrs):
+        super().__init__(**attrs)
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.session_key = None
+        # (time queued, future of the message) for each reply
+        self.sends = []
+
+    async def send(self, content=None, *, embed=None, merge=True,
+                   **kwargs):
+        # pylint: disable=W0221
+        if kwargs:
+            return await super().send(content, embed=embed, **kwargs)
+        future = OUTBOX.send(self.channel, content, embed, merge)
+        self.sends.append((time.perf_counter(), future))
+        return future
+
+
+class GameBot(Bot):
+    """The bot, replying through the outbox and timing commands."""
+    async def get_context(self, message, *, cls=QueuedContext):
+        return await super().get_context(message, cls=cls)
+
+    async def invoke(self, ctx):
+        try:
+            await super().invoke(ctx)
+        finally:
+            if getattr(ctx, 'session_key', None) is not None:
+                SESSIONS.release(ctx.session_key)
+        if ctx.command is not None and isinstance(ctx, QueuedContext):
+            asyncio.ensure_future(_record_timings(ctx))
+
+
+@contextmanager
+def _timed(ctx, stage):
+    """Add the time taken in this context to a stage of a command's
+    timings."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = getattr(ctx, 'timings', None)
+        if timings is not None:
+            timings[stage] = (
+                timings.get(stage, 0.0) + time.perf_counter() - start)
+
+
+async def _record_timings(ctx):
+    """Record how long a command took, once its replies have been sent."""
+    command = ctx.command.qualified_name
+    STATS.count(command, 'failed' if ctx.command_failed else 'ok')
+    finished = time.perf_counter()
+    if ctx.sends:
+        results = await asyncio.gather(
+            *(future for _, future in ctx.sends), return_exceptions=True)
+        failed = sum(isinstance(result, BaseException) for result in results)
+        if failed:
+            STATS.failed_sends[command] += failed
+        finished = time.perf_counter()
+        ctx.timings['send'] = finished - ctx.sends[0][0]
+    for stage, seconds in ctx.timings.items():
+        STATS.observe(command, stage, seconds)
+    STATS.observe(command, 'total', finished - ctx.started)
+
+
+CLIENT = GameBot(command_prefix='!')
+OUTBOX = Outbox()
+STATS = CommandStats()
 CONFIG = {}
-SESSION = Session()
+SESSIONS = None
+# Threads session commands are run in, off the event loop
+EXECUTOR = None
+# Held while running and answering each player's commands, so they are
+# handled in the order they were sent
+ORDERING_LOCKS = WeakValueDictionary()
+# Formatted character sheets by game and player, least recently shown first
+RENDERED_SHEETS = OrderedDict()
+RENDERED_SHEETS_LIMIT = 1000
+# Held while profiling, so only one profile is taken at once
+PROFILE_LOCK = asyncio.Lock()
+# Users fetched from Discord, as {user ID: (expiry time, user)}
+USER_CACHE = {}
+USER_CACHE_TTL = 600
+# How many users may be fetched at once
+USER_FETCH_LIMIT = 5
 DOT = '•'
 NO_DOT = '◦'
 SKULL = '🕱'
 
 
+class SamplingProfiler(threading.Thread):
+    """Samples the stacks of all other threads every interval until
+    stopped, counting how often each stack is seen."""
+    def __init__(self, interval=0.005):
+        super().__init__(name='profiler', daemon=True)
+        self.interval = interval
+        self.samples = 0
+        self.stacks = Counter()
+        self._stopping = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self._stopping.wait(self.interval):
+            names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+            frames = sys._current_frames()  # pylint: disable=W0212
+            for thread_id, frame in frames.items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        """Stop sampling and wait for the thread to finish."""
+        self._stopping.set()
+        self.join()
+
+    def collapsed(self):
+        """Return the stacks seen in the collapsed format used to draw
+        flame graphs."""
+        return ''.join(
+            '{} {}\n'.format(stack, count)
+            for stack, count in self.stacks.most_common()
+        )
+
+    def hottest(self, number):
+        """Return the functions most often found running, with how often."""
+        running = Counter()
+        for stack, count in self.stacks.items():
+            running[stack.rsplit(';', 1)[-1]] += count
+        return running.most_common(number)
+
+
 def load_config(path):
     """Load the configuration"""
     with open(path, encoding='utf-8') as conf_handle:
         return json.load(conf_handle)
 
 
+def _session_key(ctx):
+    """Get the key of the game a command is for: its guild, or its channel
+    for direct messages."""
+    if ctx.guild is not None:
+        return ctx.guild.id
+    return ctx.channel.id
+
+
+def _session(ctx):
+    """Get the session for the game a command is for. It is kept loaded
+    until the command finishes."""
+    key = _session_key(ctx)
+    if not isinstance(ctx, QueuedContext) or ctx.session_key is not None:
+        return SESSIONS.get(key)
+    ctx.session_key = key
+    return SESSIONS.get(key, hold=True)
+
+
 @CLIENT.command()
 async def rps(ctx):
     """Get a rock-paper-scissors result."""
-    if await ctx.bot.is_owner(ctx.message.author):
-        character_name = 'Storyteller'
-    else:
-        character = SESSION.get_player_dict(ctx.message.author.id)
-        character_name = character['header']['character']
-    await ctx.send(
-        '{character_name} {result}'.format(
-            character_name=character_name,
-            result=random.choice(['wins', 'loses', 'draws']),
+    async with _ordering_lock(ctx):
+        if await ctx.bot.is_owner(ctx.message.author):
+            character_name = 'Storyteller'
+        else:
+            character = await _call_session(
+                ctx, _session(ctx).get_player_dict, ctx.message.author.id)
+            character_name = character['header']['character']
+        await ctx.send(
+            '{character_name} {result}'.format(
+                character_name=character_name,
+                result=random.choice(['wins', 'loses', 'draws']),
+            )
         )
-    )
 
 
 @CLIENT.group('players')
@@ -52,6 +523,49 @@ async def players(ctx):
             ", ".join([command.name for command in players.commands])))
 
 
+async def _get_users(user_ids):
+    """Get Discord users by ID, as a dict, leaving out any that don't exist.
+    Users are taken from the gateway's cache if possible, then from those
+    fetched recently, and any others are fetched concurrently."""
+    now = time.monotonic()
+    users = {}
+    missing = []
+    for user_id in user_ids:
+        user = CLIENT.get_user(user_id)
+        if user is None:
+            expiry, user = USER_CACHE.get(user_id, (now, None))
+            if expiry <= now:
+                user = None
+        if user is None:
+            missing.append(user_id)
+        else:
+            users[user_id] = user
+
+    if missing:
+        semaphore = asyncio.Semaphore(USER_FETCH_LIMIT)
+
+        async def fetch(user_id):
+            async with semaphore:
+                try:
+                    return await CLIENT.fetch_user(user_id)
+                except NotFound:
+                    return None
+
+        fetched = await asyncio.gather(*(fetch(user_id)
+                                         for user_id in missing))
+        expiry = time.monotonic() + USER_CACHE_TTL
+        for user_id, user in zip(missing, fetched):
+            if user is not None:
+                users[user_id] = user
+                USER_CACHE[user_id] = (expiry, user)
+        for user_id in [
+                user_id for user_id, (expiry, _) in USER_CACHE.items()
+                if expiry <= now
+        ]:
+            del USER_CACHE[user_id]
+    return users
+
+
 async def _get_player_id_and_name(message, ctx):
     """Check a passed in message contains a player ID."""
     message = message.strip()
@@ -59,8 +573,9 @@ async def _get_player_id_and_name(message, ctx):
         # Expected to be in the form: <@!012345678901234567>
         message = message.split('!')[1]
         player_id = int(message.rstrip('>'))
-        player = await CLIENT.fetch_user(player_id)
-        return player_id, player.display_name
+        player = (await _get_users([player_id])).get(player_id)
+        if player is not None:
+            return player_id, player.display_name
     await ctx.send('Please @ a single channel member.')
 
 
@@ -70,7 +585,7 @@ async def player_add(ctx, player):
     player_details = await _get_player_id_and_name(player, ctx)
     if player_details is not None:
         await _call_session_and_output(
-            ctx, SESSION.add_player, *player_details
+            ctx, _session(ctx).add_player, *player_details
         )
 
 
@@ -80,57 +595,272 @@ async def player_remove(ctx, player):
     player_details = await _get_player_id_and_name(player, ctx)
     if player_details is not None:
         await _call_session_and_output(
-            ctx, SESSION.remove_player, *player_details
+            ctx, _session(ctx).remove_player, *player_details
         )
 
 
 @players.group('list')
 async def player_list(ctx):
     """List players."""
-    output = '**Players**\n'
-    for player_id in sorted(list(
-        SESSION.player_characters.keys()
-    )):
-        player = await CLIENT.fetch_user(player_id)
-        output += player.display_name
-        on_sheet = SESSION.player_characters[player_id].player
-        if player.display_name != on_sheet:
-            output += ' (on sheet as: {}'.format(on_sheet)
-        output += '\n'
-    await ctx.send(output)
+    async with _ordering_lock(ctx):
+        names = await _call_session(ctx, _session(ctx).player_names)
+    users = await _get_users(names)
+
+    def lines():
+        """Make the lines of the listing."""
+        yield '**Players**'
+        for player_id, on_sheet in names.items():
+            player = users.get(player_id)
+            if player is None:
+                yield '{} (no longer on Discord)'.format(on_sheet)
+                continue
+            output = player.display_name
+            if player.display_name != on_sheet:
+                output += ' (on sheet as: {}'.format(on_sheet)
+            yield output
+
+    await send_pages(ctx, lines())
 
 
 @CLIENT.command()
 async def reset(ctx):
     """Reset your character."""
-    await _call_session_and_output(ctx, SESSION.reset, ctx.message.author.id)
+    await _call_session_and_output(ctx, _session(ctx).reset,
+                                   ctx.message.author.id)
 
 
 @CLIENT.command()
 async def undo(ctx):
     """Undo the last change to your character."""
-    await _call_session_and_output(ctx, SESSION.undo, ctx.message.author.id)
+    await _call_session_and_output(ctx, _session(ctx).undo,
+                                   ctx.message.author.id)
+
+
+@CLIENT.command()
+async def redo(ctx):
+    """Redo the last change to your character that you undid."""
+    await _call_session_and_output(ctx, _session(ctx).redo,
+                                   ctx.message.author.id)
+
+
+def _ordering_lock(ctx):
+    """Get the lock ordering the commands of the player sending a command."""
+    key = (_session_key(ctx), ctx.message.author.id)
+    lock = ORDERING_LOCKS.get(key)
+    if lock is None:
+        lock = ORDERING_LOCKS[key] = asyncio.Lock()
+    return lock
+
+
+def paginate(lines, limit=MESSAGE_LIMIT):
+    """Join lines of text into pages of at most `limit` characters, breaking
+    between lines, or within lines too long for a page. Each page is made
+    only when it is asked for."""
+    page = None
+    for line in lines:
+        while len(line) > limit:
+            if page is not None:
+                yield page
+                page = None
+            yield line[:limit]
+            line = line[limit:]
+        if page is None:
+            page = line
+        elif len(page) + 1 + len(line) > limit:
+            yield page
+            page = line
+        else:
+            page += '\n' + line
+    if page is not None:
+        yield page
+
+
+async def send_pages(ctx, lines):
+    """Send text that may be too long for one message.
+    Pages are sent as they are made, or if reaction paging is configured
+    the first is sent with reactions to turn to the others, which are only
+    made when turned to."""
+    if not CONFIG.get('reaction_paging'):
+        for page in paginate(lines):
+            await ctx.send(page)
+        return
+    # Leave room to show the page number
+    pages = paginate(lines, MESSAGE_LIMIT - 20)
+
+    async def next_page():
+        """Make the next page."""
+        return next(pages, None)
+
+    await _send_turnable(ctx, next(pages, '\u200b'), next(pages, None),
+                         next_page)
+
+
+async def _send_turnable(ctx, first, following, next_page):
+    """Send the first of several pages, with reactions to turn to the
+    others if there are any. `next_page` is an async function returning
+    each page after `following` in turn, then None."""
+    if following is None:
+        await ctx.send(first)
+        return
+    # Not merged, so the reactions go on a message holding only this page
+    sending = await ctx.send('{}\n(page 1)'.format(first), merge=False)
+    asyncio.ensure_future(_turn_pages(
+        ctx, sending, [first, following], next_page))
+
+
+async def _turn_pages(ctx, sending, shown, next_page):
+    """Turn the pages of a message as its reader reacts to it."""
+    message = await sending
+    if message is None:
+        return
+    for emoji in (PAGE_PREVIOUS, PAGE_NEXT):
+        await message.add_reaction(emoji)
+
+    def is_turn(reaction, user):
+        """Check whether a reaction turns this message's pages."""
+        return (
+            reaction.message.id == message.id and user == ctx.author
+            and str(reaction.emoji) in (PAGE_PREVIOUS, PAGE_NEXT)
+        )
+
+    page = 0
+    while True:
+        try:
+            reaction, user = await CLIENT.wait_for(
+                'reaction_add', check=is_turn, timeout=PAGING_TIMEOUT)
+        except asyncio.TimeoutError:
+            return
+        if str(reaction.emoji) == PAGE_NEXT:
+            if page + 1 == len(shown):
+                following = await next_page()
+                if following is not None:
+                    shown.append(following)
+            page = min(page + 1, len(shown) - 1)
+        else:
+            page = max(page - 1, 0)
+        await message.edit(content='{}\n(page {})'.format(
+            shown[page], page + 1))
+        try:
+            await message.remove_reaction(reaction.emoji, user)
+        except HTTPException:
+            # Not allowed to remove others' reactions here
+            pass
+
+
+async def _call_session(ctx, command, *args, **kwargs):
+    """Call a session command in a worker thread and return the result.
+    Callers should hold the player's ordering lock."""
+    with _timed(ctx, 'session'):
+        return await asyncio.get_event_loop().run_in_executor(
+            EXECUTOR, partial(command, *args, **kwargs))
 
 
 async def _call_session_and_output(ctx, command, *args, **kwargs):
-    """Call a session command and output the result."""
-    try:
-        await ctx.send(command(*args, **kwargs))
-    except BadInput as err:
-        await ctx.send(str(err))
+    """Call a session command in a worker thread and output the result.
+    Each player's commands are run and answered in the order sent."""
+    async with _ordering_lock(ctx):
+        try:
+            output = await _call_session(ctx, command, *args, **kwargs)
+        except BadInput as err:
+            output = str(err)
+        if len(output) > MESSAGE_LIMIT:
+            await send_pages(ctx, output.split('\n'))
+        else:
+            await ctx.send(output)
+
+
+async def _output_session_pages(ctx, command, *args):
+    """Call a paged session listing in worker threads and output all of its
+    pages. Each page is only asked for when it is about to be sent, which
+    for reaction paging is when it is turned to."""
+    reaction_paging = CONFIG.get('reaction_paging')
+    # Leave room to show the page number
+    limit = MESSAGE_LIMIT - 20 if reaction_paging else MESSAGE_LIMIT
+    # Pages the last listing page was split into to fit in messages
+    split = deque()
+    number = 0
+
+    async def next_page():
+        """Get the next page, or None after the last."""
+        nonlocal number
+        while not split:
+            if number is None:
+                return None
+            number += 1
+            try:
+                output = await _call_session(ctx, command, *args,
+                                             page=number)
+            except BadInput as err:
+                if number > 1:
+                    # Past the last page
+                    number = None
+                    return None
+                output = str(err)
+                number = None
+            split.extend(paginate(output.split('\n'), limit))
+        return split.popleft()
+
+    async def next_page_in_order():
+        """Get the next page once the player's earlier commands are done."""
+        async with _ordering_lock(ctx):
+            return await next_page()
+
+    async with _ordering_lock(ctx):
+        if reaction_paging:
+            first = await next_page()
+            await _send_turnable(ctx, first, await next_page(),
+                                 next_page_in_order)
+            return
+        page = await next_page()
+        while page is not None:
+            await ctx.send(page)
+            page = await next_page()
 
 
 @CLIENT.command()
 async def award(ctx, amount, reason):
     """Award XP."""
-    await _call_session_and_output(ctx, SESSION.award_xp, amount, reason)
+    await _call_session_and_output(ctx, _session(ctx).award_xp, amount, reason)
+
+
+@CLIENT.command()
+@is_owner()
+async def batch(ctx, *, script=''):
+    """Apply several operations at once, or none if any fail.
+    One operation per line, e.g.: award_xp 5 "the ball"
+    or: set_name @player Anne"""
+    script = script.strip().strip('`')
+    try:
+        operations = parse_batch(script)
+    except BadInput as err:
+        await ctx.send(str(err))
+        return
+    if not operations:
+        await ctx.send('Syntax: !batch followed by one operation per line.')
+    else:
+        await _call_session_and_output(ctx, _session(ctx).batch, operations)
+
+
+@CLIENT.group('xp')
+async def xp_(ctx):
+    """Deal with a character's XP."""
+    if not ctx.subcommand_passed:
+        await ctx.send("Try !xp with one of these: {}".format(
+            ", ".join([command.name for command in xp_.commands])))
+
+
+@xp_.command('history')
+async def xp_history(ctx, page=1):
+    """Show a page of your XP history, newest first."""
+    await _call_session_and_output(ctx, _session(ctx).get_xp_history,
+                                   ctx.message.author.id, page)
 
 
 @CLIENT.command()
 async def begin(ctx):
     """Finish character creation, begin the adventure!"""
-    await _call_session_and_output(ctx, SESSION.finish_character_creation,
-                                   ctx.message.author.id)
+    await _call_session_and_output(
+        ctx, _session(ctx).finish_character_creation, ctx.message.author.id)
 
 
 @CLIENT.group('notes')
@@ -145,21 +875,25 @@ async def notes(ctx):
 async def add_note(ctx, *content):
     """Add a note to a character."""
     content = ' '.join(content)
-    await _call_session_and_output(ctx, SESSION.add_note,
+    await _call_session_and_output(ctx, _session(ctx).add_note,
                                    ctx.message.author.id, content)
 
 
 @notes.group('list')
-async def list_notes(ctx):
-    """List notes for a character."""
-    await _call_session_and_output(ctx, SESSION.list_notes,
-                                   ctx.message.author.id)
+async def list_notes(ctx, page=None):
+    """List notes for a character: [page]"""
+    if page is not None:
+        await _call_session_and_output(ctx, _session(ctx).list_notes,
+                                       ctx.message.author.id, page)
+        return
+    await _output_session_pages(ctx, _session(ctx).list_notes,
+                                ctx.message.author.id)
 
 
 @notes.group('delete')
 async def delete_note(ctx, pos):
     """Delete note for a character."""
-    await _call_session_and_output(ctx, SESSION.remove_note,
+    await _call_session_and_output(ctx, _session(ctx).remove_note,
                                    ctx.message.author.id, pos)
 
 
@@ -174,7 +908,7 @@ async def set_(ctx):
 @set_.command('attribute')
 async def set_attribute(ctx, attribute, value):
     """Set an attribute to a given value."""
-    await _call_session_and_output(ctx, SESSION.set_attribute,
+    await _call_session_and_output(ctx, _session(ctx).set_attribute,
                                    ctx.message.author.id, attribute, value)
 
 
@@ -187,7 +921,7 @@ async def set_skill(ctx, *args):
     else:
         skill = ' '.join(args[:-1])
         value = args[-1]
-        await _call_session_and_output(ctx, SESSION.set_skill,
+        await _call_session_and_output(ctx, _session(ctx).set_skill,
                                        ctx.message.author.id, skill, value)
 
 
@@ -200,7 +934,7 @@ async def set_background(ctx, *args):
     else:
         background = ' '.join(args[:-1])
         value = args[-1]
-        await _call_session_and_output(ctx, SESSION.set_background,
+        await _call_session_and_output(ctx, _session(ctx).set_background,
                                        ctx.message.author.id, background,
                                        value)
 
@@ -214,7 +948,7 @@ async def set_discipline(ctx, *args):
     else:
         discipline = ' '.join(args[:-1])
         value = args[-1]
-        await _call_session_and_output(ctx, SESSION.set_discipline,
+        await _call_session_and_output(ctx, _session(ctx).set_discipline,
                                        ctx.message.author.id, discipline,
                                        value)
 
@@ -222,49 +956,49 @@ async def set_discipline(ctx, *args):
 @set_.command('clan')
 async def set_clan(ctx, *clan_name):
     """Set a character's clan membership."""
-    await _call_session_and_output(ctx, SESSION.set_clan,
+    await _call_session_and_output(ctx, _session(ctx).set_clan,
                                    ctx.message.author.id, ' '.join(clan_name))
 
 
 @set_.command('name')
 async def set_name(ctx, *name):
     """Set a character's character name."""
-    await _call_session_and_output(ctx, SESSION.set_name,
+    await _call_session_and_output(ctx, _session(ctx).set_name,
                                    ctx.message.author.id, ' '.join(name))
 
 
 @set_.command('archetype')
 async def set_archetype(ctx, *archetype):
     """Set a character's archetype."""
-    await _call_session_and_output(ctx, SESSION.set_archetype,
+    await _call_session_and_output(ctx, _session(ctx).set_archetype,
                                    ctx.message.author.id, ' '.join(archetype))
 
 
 @set_.command('blood_rate')
 async def set_blood_rate(ctx, rate):
     """Set a character's blood burn rate."""
-    await _call_session_and_output(ctx, SESSION.set_blood_burn_rate,
+    await _call_session_and_output(ctx, _session(ctx).set_blood_burn_rate,
                                    ctx.message.author.id, rate)
 
 
 @set_.command('healthy_count')
 async def set_healthy_count(ctx, count):
     """Set a character's amount of healthy wound levels."""
-    await _call_session_and_output(ctx, SESSION.set_healthy_count,
+    await _call_session_and_output(ctx, _session(ctx).set_healthy_count,
                                    ctx.message.author.id, count)
 
 
 @set_.command('unhealthy_counts')
 async def set_unhealthy_count(ctx, count):
     """Set a character's amount of injured/incapacitated wound levels."""
-    await _call_session_and_output(ctx, SESSION.set_unhealthy_counts,
+    await _call_session_and_output(ctx, _session(ctx).set_unhealthy_counts,
                                    ctx.message.author.id, count)
 
 
 @set_.command('max_willpower')
 async def set_max_willpower(ctx, maximum):
     """Set a character's maximum willpower."""
-    await _call_session_and_output(ctx, SESSION.set_max_willpower,
+    await _call_session_and_output(ctx, _session(ctx).set_max_willpower,
                                    ctx.message.author.id, maximum)
 
 
@@ -279,21 +1013,21 @@ async def buy(ctx):
 @buy.command('attribute')
 async def buy_attribute(ctx, attribute):
     """Buy an extra point in an attribute."""
-    await _call_session_and_output(ctx, SESSION.increase_attribute,
+    await _call_session_and_output(ctx, _session(ctx).increase_attribute,
                                    ctx.message.author.id, attribute)
 
 
 @buy.command('skill')
 async def buy_skill(ctx, skill):
     """Buy an extra point in a skill."""
-    await _call_session_and_output(ctx, SESSION.increase_skill,
+    await _call_session_and_output(ctx, _session(ctx).increase_skill,
                                    ctx.message.author.id, skill)
 
 
 @buy.command('exceptional')
 async def buy_exceptional_skill(ctx, skill):
     """Buy an extra point (including beyond 5) in a skill."""
-    await _call_session_and_output(ctx, SESSION.increase_skill,
+    await _call_session_and_output(ctx, _session(ctx).increase_skill,
                                    ctx.message.author.id, skill,
                                    exceed_maximum=True)
 
@@ -302,7 +1036,7 @@ async def buy_exceptional_skill(ctx, skill):
 async def buy_in_clan_discipline(ctx, *discipline):
     """Buy an extra point in an in-clan discipline."""
     discipline = ' '.join(discipline)
-    await _call_session_and_output(ctx, SESSION.increase_discipline,
+    await _call_session_and_output(ctx, _session(ctx).increase_discipline,
                                    ctx.message.author.id, discipline)
 
 
@@ -310,14 +1044,14 @@ async def buy_in_clan_discipline(ctx, *discipline):
 async def buy_out_of_clan_discipline(ctx, *discipline):
     """Buy an extra point in an out-of-clan discipline."""
     discipline = ' '.join(discipline)
-    await _call_session_and_output(ctx, SESSION.increase_discipline,
+    await _call_session_and_output(ctx, _session(ctx).increase_discipline,
                                    ctx.message.author.id, discipline, True)
 
 
 @buy.command('background')
 async def buy_background(ctx, background):
     """Buy an extra point in a background."""
-    await _call_session_and_output(ctx, SESSION.increase_background,
+    await _call_session_and_output(ctx, _session(ctx).increase_background,
                                    ctx.message.author.id, background)
 
 
@@ -330,7 +1064,7 @@ async def buy_merit(ctx, *args):
     else:
         merit_name = ' '.join(args[:-1])
         cost = args[-1]
-        await _call_session_and_output(ctx, SESSION.add_merit,
+        await _call_session_and_output(ctx, _session(ctx).add_merit,
                                        ctx.message.author.id,
                                        merit_name, cost)
 
@@ -352,7 +1086,7 @@ async def inflict_flaw(ctx, *args):
     else:
         flaw_name = ' '.join(args[:-1])
         value = args[-1]
-        await _call_session_and_output(ctx, SESSION.add_flaw,
+        await _call_session_and_output(ctx, _session(ctx).add_flaw,
                                        ctx.message.author.id,
                                        flaw_name, value)
 
@@ -361,7 +1095,7 @@ async def inflict_flaw(ctx, *args):
 async def inflict_derangement(ctx, *args):
     """Inflict a derangement."""
     derangement = ' '.join(args)
-    await _call_session_and_output(ctx, SESSION.add_derangement,
+    await _call_session_and_output(ctx, _session(ctx).add_derangement,
                                    ctx.message.author.id,
                                    derangement)
 
@@ -369,14 +1103,14 @@ async def inflict_derangement(ctx, *args):
 @inflict.command('damage')
 async def inflict_normal_damage(ctx, amount=1):
     """Inflict one or more points of normal damage."""
-    await _call_session_and_output(ctx, SESSION.inflict_damage,
+    await _call_session_and_output(ctx, _session(ctx).inflict_damage,
                                    ctx.message.author.id, 'normal', amount)
 
 
 @inflict.command('aggravated')
 async def inflict_aggravated_damage(ctx, amount=1):
     """Inflict one or more points of aggravated damage."""
-    await _call_session_and_output(ctx, SESSION.inflict_damage,
+    await _call_session_and_output(ctx, _session(ctx).inflict_damage,
                                    ctx.message.author.id,
                                    'aggravated', amount)
 
@@ -392,14 +1126,14 @@ async def heal(ctx):
 @heal.command('damage')
 async def heal_normal_damage(ctx):
     """Heal one point of normal damage."""
-    await _call_session_and_output(ctx, SESSION.heal_damage,
+    await _call_session_and_output(ctx, _session(ctx).heal_damage,
                                    ctx.message.author.id, 'normal')
 
 
 @heal.command('aggravated')
 async def heal_aggravated_damage(ctx):
     """Heal one point of aggravated damage."""
-    await _call_session_and_output(ctx, SESSION.heal_damage,
+    await _call_session_and_output(ctx, _session(ctx).heal_damage,
                                    ctx.message.author.id, 'aggravated')
 
 
@@ -417,7 +1151,7 @@ async def remove_merit(ctx, *merit_name):
     Refund the cost if during character creation.
     """
     merit_name = ' '.join(merit_name)
-    await _call_session_and_output(ctx, SESSION.remove_merit,
+    await _call_session_and_output(ctx, _session(ctx).remove_merit,
                                    ctx.message.author.id, merit_name)
 
 
@@ -428,7 +1162,7 @@ async def remove_flaw(ctx, *flaw_name):
     Spend XP after character creation.
     """
     flaw_name = ' '.join(flaw_name)
-    await _call_session_and_output(ctx, SESSION.remove_flaw,
+    await _call_session_and_output(ctx, _session(ctx).remove_flaw,
                                    ctx.message.author.id, flaw_name)
 
 
@@ -439,35 +1173,35 @@ async def remove_derangement(ctx, *derangement_name):
     Spend XP after character creation.
     """
     derangement_name = ' '.join(derangement_name)
-    await _call_session_and_output(ctx, SESSION.remove_derangement,
+    await _call_session_and_output(ctx, _session(ctx).remove_derangement,
                                    ctx.message.author.id, derangement_name)
 
 
 @remove.command('beast')
 async def remove_beast_traits(ctx, amount=1):
     """Remove some beast traits."""
-    await _call_session_and_output(ctx, SESSION.remove_beast_traits,
+    await _call_session_and_output(ctx, _session(ctx).remove_beast_traits,
                                    ctx.message.author.id, amount)
 
 
 @remove.command('morality')
 async def remove_morality(ctx):
     """Remove a point of morality."""
-    await _call_session_and_output(ctx, SESSION.remove_morality,
+    await _call_session_and_output(ctx, _session(ctx).remove_morality,
                                    ctx.message.author.id)
 
 
 @CLIENT.command('focus')
 async def add_focus(ctx, attribute, focus):
     """Add a focus for an attribute."""
-    await _call_session_and_output(ctx, SESSION.add_focus,
+    await _call_session_and_output(ctx, _session(ctx).add_focus,
                                    ctx.message.author.id, attribute, focus)
 
 
 @CLIENT.command('unfocus')
 async def remove_focus(ctx, attribute, focus):
     """Add a focus for an attribute."""
-    await _call_session_and_output(ctx, SESSION.remove_focus,
+    await _call_session_and_output(ctx, _session(ctx).remove_focus,
                                    ctx.message.author.id, attribute, focus)
 
 
@@ -488,7 +1222,7 @@ async def create_equipment(ctx, *args):
     if not equipment_name:
         await ctx.send('Syntax: <category> <equipment name>')
     else:
-        await _call_session_and_output(ctx, SESSION.create_equipment,
+        await _call_session_and_output(ctx, _session(ctx).create_equipment,
                                        equipment_name, category)
 
 
@@ -497,14 +1231,27 @@ async def create_equipment(ctx, *args):
 async def destroy_equipment(ctx, *args):
     """Delete an item of equipment from the pool (and any characters)."""
     equipment_name = ' '.join(args)
-    await _call_session_and_output(ctx, SESSION.destroy_equipment,
+    await _call_session_and_output(ctx, _session(ctx).destroy_equipment,
                                    equipment_name)
 
 
 @equipment.command('list')
-async def list_equipment(ctx):
-    """List equipment in pool."""
-    await _call_session_and_output(ctx, SESSION.list_equipment)
+async def list_equipment(ctx, *args):
+    """List equipment in pool: [category] [page]"""
+    page = 1
+    if args and args[-1].isdigit():
+        page = args[-1]
+        args = args[:-1]
+    category = ' '.join(args) or None
+    await _call_session_and_output(ctx, _session(ctx).list_equipment,
+                                   category, page)
+
+
+@equipment.command('search')
+async def search_equipment(ctx, *args):
+    """Find equipment in the pool by the start of its name."""
+    prefix = ' '.join(args)
+    await _output_session_pages(ctx, _session(ctx).search_equipment, prefix)
 
 
 @equipment.command('quality')
@@ -516,8 +1263,9 @@ async def add_equipment_quality(ctx, *args):
         await ctx.send("Syntax: <equipment_name>:<quality name>")
     else:
         equipment_name, quality = args
-        await _call_session_and_output(ctx, SESSION.add_quality_to_equipment,
-                                       equipment_name, quality)
+        await _call_session_and_output(
+            ctx, _session(ctx).add_quality_to_equipment,
+            equipment_name, quality)
 
 
 @equipment.command('unquality')
@@ -530,7 +1278,7 @@ async def remove_equipment_quality(ctx, *args):
     else:
         equipment_name, quality = args
         await _call_session_and_output(
-            ctx, SESSION.remove_quality_from_equipment,
+            ctx, _session(ctx).remove_quality_from_equipment,
             equipment_name, quality)
 
 
@@ -538,7 +1286,7 @@ async def remove_equipment_quality(ctx, *args):
 async def take_equipment(ctx, *args):
     """Add an item of equipment to your character."""
     equipment_name = ' '.join(args)
-    await _call_session_and_output(ctx, SESSION.take_equipment,
+    await _call_session_and_output(ctx, _session(ctx).take_equipment,
                                    ctx.message.author.id, equipment_name)
 
 
@@ -546,10 +1294,18 @@ async def take_equipment(ctx, *args):
 async def drop_equipment(ctx, *args):
     """Remove an item of equipment from your character."""
     equipment_name = ' '.join(args)
-    await _call_session_and_output(ctx, SESSION.drop_equipment,
+    await _call_session_and_output(ctx, _session(ctx).drop_equipment,
                                    ctx.message.author.id, equipment_name)
 
 
+@equipment.command('holders')
+async def equipment_holders(ctx, *args):
+    """Show who holds an item of equipment."""
+    equipment_name = ' '.join(args)
+    await _output_session_pages(ctx, _session(ctx).list_holders,
+                                equipment_name)
+
+
 @CLIENT.group('spend')
 async def spend(ctx):
     """Spend resources."""
@@ -561,14 +1317,14 @@ async def spend(ctx):
 @spend.command('willpower')
 async def spend_willpower(ctx, amount=1):
     """Spend some blood."""
-    await _call_session_and_output(ctx, SESSION.spend_willpower,
+    await _call_session_and_output(ctx, _session(ctx).spend_willpower,
                                    ctx.message.author.id, amount)
 
 
 @spend.command('blood')
 async def spend_blood(ctx, amount=1):
     """Gain some blood."""
-    await _call_session_and_output(ctx, SESSION.spend_blood,
+    await _call_session_and_output(ctx, _session(ctx).spend_blood,
                                    ctx.message.author.id, amount)
 
 
@@ -583,38 +1339,52 @@ async def gain(ctx):
 @gain.command('willpower')
 async def gain_willpower(ctx, amount=1):
     """Gain some blood."""
-    await _call_session_and_output(ctx, SESSION.gain_willpower,
+    await _call_session_and_output(ctx, _session(ctx).gain_willpower,
                                    ctx.message.author.id, amount)
 
 
 @gain.command('blood')
 async def gain_blood(ctx, amount=1):
     """Gain some blood."""
-    await _call_session_and_output(ctx, SESSION.gain_blood,
+    await _call_session_and_output(ctx, _session(ctx).gain_blood,
                                    ctx.message.author.id, amount)
 
 
 @gain.command('beast')
 async def gain_beast_traits(ctx, amount=1):
     """Gain some beast traits."""
-    await _call_session_and_output(ctx, SESSION.gain_beast_traits,
+    await _call_session_and_output(ctx, _session(ctx).gain_beast_traits,
                                    ctx.message.author.id, amount)
 
 
 @gain.command('morality')
 async def gain_morality(ctx):
     """Gain some morality."""
-    await _call_session_and_output(ctx, SESSION.gain_morality,
+    await _call_session_and_output(ctx, _session(ctx).gain_morality,
                                    ctx.message.author.id)
 
 
 def _save_on_ctrl_c():
     """Save if exiting with ctrl+c."""
     print('Saving on SIGINT')
-    SESSION.save(CONFIG['vamp_save_path'])
+    SESSIONS.save_all()
     sys.exit(0)
 
 
+@CLIENT.before_invoke
+async def _parsed(ctx):
+    """Note how long a command took to find and parse."""
+    if isinstance(ctx, QueuedContext):
+        ctx.timings['parse'] = time.perf_counter() - ctx.started
+
+
+async def _write_stats(path, interval):
+    """Write the command stats to a file for Prometheus every interval."""
+    while True:
+        await asyncio.sleep(interval)
+        write_atomically(path, STATS.prometheus())
+
+
 @CLIENT.event
 async def on_ready():
     """Output a message when connected"""
@@ -623,6 +1393,10 @@ async def on_ready():
         name="with blood.",
     ))
     CLIENT.loop.add_signal_handler(signal.SIGINT, _save_on_ctrl_c)
+    SESSIONS.start()
+    if CONFIG.get('stats_path'):
+        asyncio.ensure_future(_write_stats(CONFIG['stats_path'],
+                                           CONFIG.get('stats_interval', 60)))
 
 
 @CLIENT.command()
@@ -636,13 +1410,108 @@ async def hello(ctx):
 async def close(_):
     """Disconnect the bot and stop running."""
     print("Closing by owner's demand.")
-    SESSION.save(CONFIG['vamp_save_path'])
+    await SESSIONS.close()
     try:
         await CLIENT.close()
     except websockets.exceptions.ConnectionClosedOK:
         pass
 
 
+@CLIENT.command()
+@is_owner()
+async def stats(ctx):
+    """Show how long commands have been taking, in milliseconds."""
+    lines = STATS.summary() or ['No commands timed yet.']
+    if CONFIG.get('stats_path'):
+        write_atomically(CONFIG['stats_path'], STATS.prometheus())
+        lines.append('Written to {}'.format(CONFIG['stats_path']))
+    await send_pages(ctx, lines)
+
+
+@CLIENT.command()
+@is_owner()
+async def profile(ctx, seconds=30, top=10):
+    """Profile the bot for some seconds, then show where its time went."""
+    try:
+        seconds = min(max(float(seconds), 1), 600)
+        top = int(top)
+    except ValueError:
+        await ctx.send('Syntax: !profile [seconds] [number of functions]')
+        return
+    if PROFILE_LOCK.locked():
+        await ctx.send('Already profiling.')
+        return
+    async with PROFILE_LOCK:
+        await ctx.send('Profiling for {:g}s.'.format(seconds))
+        profiler = cProfile.Profile()
+        sampler = SamplingProfiler()
+        sampler.start()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            sampler.stop()
+
+    directory = CONFIG.get('profile_path', 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, time.strftime('profile-%Y%m%d-%H%M%S'))
+    profiler.dump_stats(base + '.pstats')
+    write_atomically(base + '.collapsed', sampler.collapsed())
+
+    lines = [
+        'Wrote {0}.pstats and {0}.collapsed'.format(base),
+        '**Event loop, by own time**',
+    ]
+    stats_by_function = pstats.Stats(profiler).stats  # pylint: disable=E1101
+    for (filename, line, function), details in sorted(
+            stats_by_function.items(), key=lambda item: -item[1][2])[:top]:
+        lines.append('{:.3f}s in {} calls: {} ({}:{})'.format(
+            details[2], details[1], function, os.path.basename(filename),
+            line))
+    lines.append('**All threads, by {} samples**'.format(sampler.samples))
+    for function, count in sampler.hottest(top):
+        lines.append('{} samples: {}'.format(count, function))
+    await send_pages(ctx, lines)
+
+
+@CLIENT.command()
+@is_owner()
+async def outbox(ctx):
+    """Show how replies are queueing."""
+    metrics = OUTBOX.metrics()
+    await ctx.send(
+        '{depth} replies queued for {channels} channels (at most {max_depth} '
+        'for one). {sent} messages sent, with {merged} more merged into '
+        'them. Waited {mean_wait:.2f}s on average, at most '
+        '{max_wait:.2f}s.'.format(**metrics)
+    )
+
+
+@CLIENT.command()
+@is_owner()
+async def snapshot(ctx):
+    """Show when the session was last saved."""
+    key = _session_key(ctx)
+    SESSIONS.get(key)
+    metrics = SESSIONS.snapshots[key].metrics()
+    if metrics['last_snapshot_age'] is None:
+        output = 'Not saved since starting.'
+    else:
+        output = 'Last saved {:.0f}s ago, taking {:.3f}s.'.format(
+            metrics['last_snapshot_age'], metrics['last_snapshot_duration'],
+        )
+    output += ' {} saves so far. {}'.format(
+        metrics['snapshot_count'],
+        'Unsaved changes pending.' if metrics['dirty'] else 'No changes.',
+    )
+    if metrics['failure_count']:
+        output += ' {} saves failed, most recently with {}.'.format(
+            metrics['failure_count'], metrics['last_error'])
+    output += ' {} games loaded.'.format(len(SESSIONS.sessions))
+    await ctx.send(output)
+
+
 @CLIENT.group('show')
 async def show(ctx):
     """Show character sheet or equipment."""
@@ -651,27 +1520,78 @@ async def show(ctx):
             ", ".join([command.name for command in show.commands])))
 
 
-# Add attributes
-def _format_attribute(attribute):
-    """Format an attribute for display."""
+def _build_dots(current, maximum, line_length=None):
+    """Build a row of dots, filled up to the current value, with a space
+    every five dots and optionally a line break every line_length."""
     output = ''
-    value = attribute['value']
+    for pos in range(maximum):
+        if line_length and pos % line_length == 0 and pos > 0:
+            output += '\n'
+        elif pos % 5 == 0 and pos > 0:
+            output += ' '
+        output += DOT if pos < current else NO_DOT
+    return output
+
 
+def _build_attribute_dots(value):
+    """Build the dots for an attribute, with any bonus above ten apart."""
     base = min(value, 10)
+    bonus = max(value - 10, 0)
     output = DOT * base + NO_DOT * (10 - base)
     # Insert a space for readability
-    output = output[:5] + ' ' + output[5:]
-    output += '\n'
+    return '{} {}\nBonus: {}\n'.format(
+        output[:5], output[5:], DOT * bonus + NO_DOT * (5 - bonus))
+
+
+def _build_rating_dots(value):
+    """Build the dots for a rating, with any above five apart."""
+    base = min(value, 5)
+    extra = max(value - 5, 0)
+    output = DOT * base + NO_DOT * (5 - base)
+    if extra:
+        output += ' ' + DOT * extra
+    return output
+
+
+# Dots for every value the game allows are built once, when starting.
+# Resources are indexed by [maximum][current].
+MAX_ATTRIBUTE = 15
+MAX_RATING = 10
+MAX_RESOURCE = 30
+ATTRIBUTE_DOTS = tuple(
+    _build_attribute_dots(value) for value in range(MAX_ATTRIBUTE + 1))
+RATING_DOTS = tuple(
+    _build_rating_dots(value) for value in range(MAX_RATING + 1))
+RESOURCE_DOTS = tuple(
+    tuple(_build_dots(current, maximum, 15)
+          for current in range(maximum + 1))
+    for maximum in range(MAX_RESOURCE + 1)
+)
+GROUPED_DOTS = tuple(
+    tuple(_build_dots(current, maximum) for current in range(maximum + 1))
+    for maximum in range(MAX_RESOURCE + 1)
+)
+
+
+def _resource_dots(current, maximum, table=RESOURCE_DOTS, line_length=15):
+    """Get a row of dots for a resource, building it if the values are out
+    of the table's range."""
+    if 0 <= current <= maximum <= MAX_RESOURCE:
+        return table[maximum][current]
+    return _build_dots(current, maximum, line_length)
 
-    bonus = max(value - 10, 0)
-    output += 'Bonus: '
-    output += DOT * bonus + NO_DOT * (5 - bonus)
-    output += '\n'
 
-    output += ' '.join(
+# Add attributes
+def _format_attribute(attribute):
+    """Format an attribute for display."""
+    value = attribute['value']
+    if 0 <= value <= MAX_ATTRIBUTE:
+        output = ATTRIBUTE_DOTS[value]
+    else:
+        output = _build_attribute_dots(value)
+    return output + ' '.join(
         focus.title() for focus in attribute['focuses']
     )
-    return output
 
 
 def _make_skill_columns(skills):
@@ -699,98 +1619,71 @@ def _make_skill_columns(skills):
 
 def _dotted_display(name, value):
     """Prepare a numeric entry on the character sheet for dotted display."""
-    base = min(value, 5)
-    extra = max(value - 5, 0)
-
-    rating_output = DOT * base
-    rating_output += NO_DOT * (5 - base)
-    if extra:
-        rating_output += ' '
-        rating_output += DOT * extra
+    if 0 <= value <= MAX_RATING:
+        rating_output = RATING_DOTS[value]
+    else:
+        rating_output = _build_rating_dots(value)
     return '{}: {}\n'.format(name.title(), rating_output)
 
 
 def _format_resource(state):
     """Prepare a resource (e.g. blood) for dotted display."""
-    output = ''
-    for pos in range(state['max']):
-        # Add a newline every ten and a space every five blood for
-        # readability
-        if pos % 15 == 0 and pos > 0:
-            output += '\n'
-        elif pos % 5 == 0 and pos > 0:
-            output += ' '
-
-        output += DOT if pos < state['current'] else NO_DOT
-    return output
+    return _resource_dots(state['current'], state['max'])
 
 
 def _format_health(health_state):
     """Format character health for display."""
     output = ''
 
-    damage_applied = 0
+    # Damage is listed aggravated first, so only needs counting
+    damage = health_state['damage']
+    aggravated = damage.count('aggravated')
+    normal = len(damage) - aggravated
     for level in ['healthy', 'injured', 'incapacitated']:
-        output += '{}: '.format(level.capitalize())
+        size = health_state['levels'][level]
+        level_aggravated = min(aggravated, size)
+        level_normal = min(normal, size - level_aggravated)
+        aggravated -= level_aggravated
+        normal -= level_normal
 
-        for _ in range(health_state['levels'][level]):
-            if damage_applied < len(health_state['damage']):
-                damage_type = health_state['damage'][damage_applied]
-                if damage_type == 'normal':
-                    output += NO_DOT
-                else:
-                    output += SKULL
-                damage_applied += 1
-            else:
-                output += DOT
+        output += '{}: '.format(level.capitalize())
+        output += SKULL * level_aggravated
+        output += NO_DOT * level_normal
+        output += DOT * (size - level_aggravated - level_normal)
         output += '\n'
 
-    if damage_applied < len(health_state['damage']):
+    if aggravated or normal:
         output += 'Excess: '
-        for damage_type in health_state['damage'][damage_applied:]:
-            if damage_type == 'normal':
-                output += NO_DOT
-            else:
-                output += SKULL
+        output += SKULL * aggravated
+        output += NO_DOT * normal
 
     return output
 
 
 def _format_morality(morality_state):
     """Format morality for display."""
-    output = ''
-
-    for pos in range(morality_state['max']):
-        if pos % 5 == 0 and pos > 0:
-            output += ' '
-
-        output += DOT if pos < morality_state['current'] else NO_DOT
+    output = _resource_dots(morality_state['current'], morality_state['max'],
+                            GROUPED_DOTS, None)
     output += '\n\n'
     output += '**Beast traits**\n'
-    if morality_state['beast traits']:
-        for pos in range(morality_state['beast traits']):
-            if pos % 5 == 0 and pos > 0:
-                output += ' '
-
-            output += DOT
+    beast_traits = morality_state['beast traits']
+    if beast_traits:
+        output += _resource_dots(beast_traits, beast_traits, GROUPED_DOTS,
+                                 None)
     else:
         output += 'None'
     return output
 
 
-@show.command('character')
-async def show_character(ctx): # pylint: disable=R0914
-    """Show a character sheet."""
-    embed = Embed(
-        title='Character sheet',
-    )
-    character = SESSION.get_player_dict(ctx.message.author.id)
-
+def _character_fields(character, player_name,  # pylint: disable=R0914
+                      health_level):
+    """Build the fields of a character sheet embed, as add_field arguments."""
+    fields = []
     # Add header
     header = character['header']
     sect = header['sect'] or 'unaligned'
     title = header['title'] or 'none'
-    embed.add_field(
+    fields.append(dict(
         name=(
             '~~\u200b    \u200b~~**Character**~~\u200b    \u200b~~'
         ),
@@ -800,11 +1693,11 @@ async def show_character(ctx): # pylint: disable=R0914
             'Archetype: {archetype}\n'
         ).format(
             name=header['character'],
-            player=ctx.message.author.display_name,
+            player=player_name,
             archetype=header['archetype'].title(),
         ),
-    )
-    embed.add_field(
+    ))
+    fields.append(dict(
         name='\u200b',
         value=(
             'Clan: {clan}\n'
@@ -815,8 +1708,8 @@ async def show_character(ctx): # pylint: disable=R0914
             sect=sect.title(),
             title=title.title(),
         ),
-    )
-    embed.add_field(
+    ))
+    fields.append(dict(
         name='\u200b',
         value=(
             '**XP**\n'
@@ -826,51 +1719,51 @@ async def show_character(ctx): # pylint: disable=R0914
             unspent=character['xp']['current'],
             total=character['xp']['total'],
         ),
-    )
+    ))
 
     # Show status
     if character['state']['status']:
-        embed.add_field(
+        fields.append(dict(
             name='Status',
             value=', '.join(status.title()
                             for status in character['state']['status']),
             inline=False,
-        )
+        ))
 
     attributes = character['attributes']
-    embed.add_field(
+    fields.append(dict(
         name=(
             '~~\u200b    \u200b~~**Attributes**~~\u200b    \u200b~~\n'
             'Physical'
         ),
         value=_format_attribute(attributes['physical']),
-    )
-    embed.add_field(
+    ))
+    fields.append(dict(
         name='\u200b\nMental',
         value=_format_attribute(attributes['mental']),
-    )
-    embed.add_field(
+    ))
+    fields.append(dict(
         name='\u200b\nSocial',
         value=_format_attribute(attributes['social']),
-    )
+    ))
 
     # Add skills
     skills = character['skills']
     columns = _make_skill_columns(skills)
-    embed.add_field(
+    fields.append(dict(
         name=(
             '~~\u200b    \u200b~~**Skills**~~\u200b    \u200b~~'
         ),
         value=columns[0],
-    )
+    ))
     for column in columns[1:]:
-        embed.add_field(name='\u200b', value=column)
+        fields.append(dict(name='\u200b', value=column))
 
     # Add backgrounds, disciplines, merits, and flaws
     backgrounds = character['backgrounds']
     ordered_backgrounds = sorted(list(backgrounds.keys()),
                                  key=str.casefold)
-    embed.add_field(
+    fields.append(dict(
         name=(
             '~~\u200b                                \u200b~~\n'
             'Backgrounds'
@@ -879,129 +1772,243 @@ async def show_character(ctx): # pylint: disable=R0914
             _dotted_display(name, backgrounds[name])
             for name in ordered_backgrounds
         ),
-    )
+    ))
     disciplines = character['disciplines']
     ordered_disciplines = sorted(list(disciplines.keys()))
-    embed.add_field(
+    fields.append(dict(
         name='\u200b\nDisciplines',
         value='\u200b' + ''.join(
             _dotted_display(name, disciplines[name])
             for name in ordered_disciplines
         ),
-    )
+    ))
     merits = character['merits_and_flaws']['merits']
     ordered_merits = sorted(list(merits.keys()), key=str.casefold)
     flaws = character['merits_and_flaws']['flaws']
     ordered_flaws = sorted(list(flaws.keys()), key=str.casefold)
     derangements = sorted(character['merits_and_flaws']['derangements'],
                           key=str.casefold)
-    output = '\u200b'
-    for merit in ordered_merits:
-        output += '{} ({})\n'.format(merit.title(), merits[merit])
-    for flaw in ordered_flaws:
-        output += '{} (-{})\n'.format(flaw.title(), flaws[flaw])
-    for derangement in derangements:
-        output += '{}\n'.format(derangement.title())
-    embed.add_field(
-        name='\u200b\nMerits and Flaws',
-        value=output,
-    )
+    lines = ['{} ({})'.format(merit.title(), merits[merit])
+             for merit in ordered_merits]
+    lines.extend('{} (-{})'.format(flaw.title(), flaws[flaw])
+                 for flaw in ordered_flaws)
+    lines.extend(derangement.title() for derangement in derangements)
+    # Long lists continue in further fields
+    for number, output in enumerate(
+            paginate(lines or [''], EMBED_FIELD_LIMIT - 1)):
+        fields.append(dict(
+            name='\u200b\nMerits and Flaws' if number == 0 else '\u200b',
+            value='\u200b' + output,
+        ))
 
     # Add blood, willpower, morality (incl. beast traits), health
     state = character['state']
     blood_and_willpower_output = _format_resource(state['blood'])
     blood_and_willpower_output += '\n**Willpower**\n'
     blood_and_willpower_output += _format_resource(state['willpower'])
-    embed.add_field(
+    fields.append(dict(
         name=(
             '~~\u200b                                \u200b~~\n'
             'Blood ({}/round)'.format(state['blood']['rate'])
         ),
         value=blood_and_willpower_output,
-    )
-    embed.add_field(
-        name='\u200b\nHealth ({})'.format(
-            SESSION.get_health_level(ctx.message.author.id)
-        ),
+    ))
+    fields.append(dict(
+        name='\u200b\nHealth ({})'.format(health_level),
         value=_format_health(state['health']),
-    )
-    embed.add_field(
+    ))
+    fields.append(dict(
         name='\u200b\nMorality',
         value=_format_morality(state['morality']),
-    )
+    ))
 
-    await ctx.send(embed=embed)
+    return fields
+
+
+@show.command('character')
+async def show_character(ctx):
+    """Show a character sheet."""
+    session = _session(ctx)
+    player_id = ctx.message.author.id
+    player_name = ctx.message.author.display_name
+
+    def read():
+        """Get the sheet and health level of the player's character."""
+        version, character = session.get_player_view(player_id)
+        return version, character, session.get_health_level(player_id)
+
+    async with _ordering_lock(ctx):
+        version, character, health_level = await _call_session(ctx, read)
+
+        # Sheets are only formatted again when they or the player's name
+        # change
+        key = (_session_key(ctx), player_id)
+        cached = RENDERED_SHEETS.pop(key, None)
+        with _timed(ctx, 'render'):
+            if cached is not None and cached[0] == (version, player_name):
+                fields = cached[1]
+            else:
+                fields = _character_fields(character, player_name,
+                                           health_level)
+            embed = Embed(
+                title='Character sheet',
+            )
+            for field in fields:
+                embed.add_field(**field)
+        RENDERED_SHEETS[key] = ((version, player_name), fields)
+        if len(RENDERED_SHEETS) > RENDERED_SHEETS_LIMIT:
+            RENDERED_SHEETS.popitem(last=False)
+        await ctx.send(embed=embed)
 
 
 @show.command('equipment')
 async def show_equipment(ctx):
     """Show a character's equipment."""
-    character = SESSION.get_player_dict(ctx.message.author.id)
+    async with _ordering_lock(ctx):
+        character = await _call_session(
+            ctx, _session(ctx).get_player_dict, ctx.message.author.id)
 
-    owned_equipment = sorted(character['equipment'],
-                             key=str.casefold)
+        with _timed(ctx, 'render'):
+            owned_equipment = sorted(character['equipment'],
+                                     key=str.casefold)
 
-    embed = Embed(
-        title='Equipment for {}'.format(character['header']['character']),
-    )
-
-    if owned_equipment:
-        for item in owned_equipment:
-            item_details = SESSION.equipment[item]
-            details = '({})'.format(item_details['category'])
-            if item_details['qualities']:
-                details += '\n\u200b\n{}'.format(
-                    '\n'.join(quality.title()
-                              for quality in item_details['qualities']),
-                )
-
-            embed.add_field(
-                name=item,
-                value=details,
+            embed = Embed(
+                title='Equipment for {}'.format(
+                    character['header']['character']),
             )
-    else:
-        embed.description = 'None'
 
-    await ctx.send(embed=embed)
+            if owned_equipment:
+                for item in owned_equipment:
+                    item_details = _session(ctx).equipment[item]
+                    details = '({})'.format(item_details.category)
+                    if item_details.qualities:
+                        details += '\n\u200b\n{}'.format(
+                            '\n'.join(quality.title()
+                                      for quality in item_details.qualities),
+                        )
+
+                    embed.add_field(
+                        name=item,
+                        value=details,
+                    )
+            else:
+                embed.description = 'None'
 
+        await ctx.send(embed=embed)
 
-def generate_partials(group=None):
-    """Generate aliases for all partial matches of commands, recursively."""
-    if group is None:
-        group = CLIENT
-    commands = group.all_commands
 
-    groups = []
-    aliases_mapping = {}
+class _PrefixNode:  # pylint: disable=R0903
+    """A node of a trie of command names."""
+    __slots__ = ('children', 'commands')
 
-    for command_name, command in commands.items():
-        if hasattr(command, 'commands'):
-            groups.append(command_name)
-        found_unambiguous = False
-        for pos in range(1, len(command_name)):
-            sub = command_name[:pos]
-            if found_unambiguous:
-                aliases_mapping[command_name].append(sub)
-            elif any(c.startswith(sub) for c in commands
-                     if c != command_name):
-                # This would be an ambiguous alias
-                continue
-            else:
-                aliases_mapping[command_name] = [sub]
-                found_unambiguous = True
+    def __init__(self):
+        self.children = {}
+        # How many names below this node lead to each command
+        self.commands = {}
 
-    for command_name, aliases in aliases_mapping.items():
-        command = commands[command_name]
-        command.aliases.extend(aliases)
-        group.remove_command(command_name)
-        group.add_command(command)
 
-    for sub_group in groups:
-        generate_partials(commands[sub_group])
+class PrefixCommands(dict):
+    """Commands by name, which can also be found by any prefix of a name
+    that only one command's names start with.
+    Prefixes are resolved through a trie when commands are looked up, so
+    abbreviations need no aliases. Prefixes that could mean several commands
+    find a command that explains that instead.
+    """
+    def __init__(self, commands=()):
+        super().__init__()
+        self._root = _PrefixNode()
+        # Commands explaining ambiguous prefixes, by prefix
+        self._ambiguous = {}
+        for name, command in dict(commands).items():
+            self[name] = command
+
+    def _nodes(self, name):
+        """Yield the nodes along a name, creating any missing."""
+        node = self._root
+        for char in name:
+            node = node.children.setdefault(char, _PrefixNode())
+            yield node
+
+    def __setitem__(self, name, command):
+        if name in self:
+            self.pop(name)
+        super().__setitem__(name, command)
+        self._ambiguous.clear()
+        for node in self._nodes(name):
+            node.commands[command] = node.commands.get(command, 0) + 1
+
+    def __delitem__(self, name):
+        self.pop(name)
+
+    def pop(self, name, *default):
+        if name not in self:
+            return super().pop(name, *default)
+        command = super().pop(name)
+        self._ambiguous.clear()
+        for node in self._nodes(name):
+            node.commands[command] -= 1
+            if not node.commands[command]:
+                del node.commands[command]
+        return command
+
+    def get(self, name, default=None):
+        command = super().get(name)
+        if command is not None:
+            return command
+        node = self._root
+        for char in name:
+            node = node.children.get(char)
+            if node is None:
+                return default
+        if len(node.commands) == 1:
+            return next(iter(node.commands))
+        if node.commands:
+            if name not in self._ambiguous:
+                self._ambiguous[name] = _ambiguous_command(
+                    name, node.commands)
+            return self._ambiguous[name]
+        return default
+
+
+def _ambiguous_command(prefix, commands):
+    """Make a command explaining that a prefix could mean several
+    commands."""
+    async def ambiguous(ctx, *_):
+        await ctx.send('"{}" could mean any of: {}'.format(
+            prefix, ', '.join(sorted(command.name for command in commands))))
+    return Command(ambiguous, name=prefix)
+
+
+def resolve_prefixes(group=None):
+    """Let commands be abbreviated to any unambiguous prefix, recursively."""
+    if group is None:
+        group = CLIENT
+    group.all_commands = PrefixCommands(group.all_commands)
+    for command in group.commands:
+        if hasattr(command, 'commands'):
+            resolve_prefixes(command)
 
 
 if __name__ == '__main__':
     CONFIG = load_config('config.json')
-    SESSION.load(CONFIG['vamp_save_path'])
-    generate_partials()
+    USER_CACHE_TTL = CONFIG.get('user_cache_ttl', USER_CACHE_TTL)
+    EXECUTOR = ThreadPoolExecutor(CONFIG.get('worker_threads', 4),
+                                  thread_name_prefix='session')
+    SESSIONS = SessionManager(
+        CONFIG['vamp_save_path'],
+        CONFIG.get('storage'),
+        max_sessions=CONFIG.get('max_sessions', 100),
+        max_characters=CONFIG.get('max_characters', 5000),
+        idle_timeout=CONFIG.get('idle_timeout', 3600),
+        snapshot_interval=CONFIG.get('snapshot_interval', 30),
+        undo_depth=CONFIG.get('undo_depth', 10),
+        xp_log_limit=CONFIG.get('xp_log_limit', 200),
+        # A save from before there were multiple games can be kept in place
+        # for the guild it belongs to.
+        paths=(
+            {CONFIG['legacy_guild_id']: CONFIG['vamp_save_path']}
+            if 'legacy_guild_id' in CONFIG else None
+        ),
+    )
+    resolve_prefixes()
     CLIENT.run(CONFIG['token'])
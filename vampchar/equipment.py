@@ -0,0 +1,197 @@
+"""The pool of equipment available in a game."""
+from bisect import bisect_left, insort
+
+from .tracking import record, recording, revert
+
+
+class Item:
+    """An item of equipment, with its qualities kept in the order added."""
+    __slots__ = ('name', 'category', 'qualities')
+
+    def __init__(self, name, category, qualities=()):
+        self.name = name
+        self.category = category
+        # A dict is used as an ordered set
+        self.qualities = dict.fromkeys(qualities)
+
+    def to_dict(self):
+        """Return the dict of this item."""
+        return {
+            'category': self.category,
+            'qualities': list(self.qualities),
+        }
+
+    def __repr__(self):
+        return 'Item({!r}, {!r}, {!r})'.format(
+            self.name, self.category, list(self.qualities))
+
+
+def _sort_key(name):
+    """Key equipment names are sorted and searched by."""
+    return (name.casefold(), name)
+
+
+class EquipmentCatalog:
+    """Items of equipment by name, indexed by category and by sorted name
+    for paging and prefix searches.
+    Changes are recorded so that they can be undone.
+    """
+    def __init__(self):
+        self._items = {}
+        self._sorted = []
+        # Sorted names in each category, by casefolded category
+        self._categories = {}
+
+    def __contains__(self, name):
+        return name in self._items
+
+    def __getitem__(self, name):
+        return self._items[name]
+
+    def __iter__(self):
+        return (name for _, name in self._sorted)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __eq__(self, other):
+        if isinstance(other, EquipmentCatalog):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    __hash__ = None
+
+    def create(self, name, category, qualities=()):
+        """Add an item of equipment, which must not already exist."""
+        self._add(Item(name, category, qualities))
+        record(self.destroy, name)
+
+    def _add(self, item):
+        """Add an item to the catalog and its indexes."""
+        self._items[item.name] = item
+        key = _sort_key(item.name)
+        insort(self._sorted, key)
+        insort(self._categories.setdefault(item.category.casefold(), []),
+               key)
+
+    def _restore(self, item):
+        """Put back a destroyed item."""
+        self._add(item)
+        record(self.destroy, item.name)
+
+    def destroy(self, name):
+        """Remove an item of equipment, which must exist. Returns it."""
+        item = self._items.pop(name)
+        key = _sort_key(name)
+        _remove_sorted(self._sorted, key)
+        category = item.category.casefold()
+        _remove_sorted(self._categories[category], key)
+        if not self._categories[category]:
+            del self._categories[category]
+        record(self._restore, item)
+        return item
+
+    def add_quality(self, name, quality):
+        """Add a quality to an item."""
+        self._items[name].qualities[quality] = None
+        record(self.remove_quality, name, quality)
+
+    def remove_quality(self, name, quality):
+        """Remove a quality from an item."""
+        qualities = self._items[name].qualities
+        position = list(qualities).index(quality)
+        del qualities[quality]
+        record(self._insert_quality, name, quality, position)
+
+    def _insert_quality(self, name, quality, position):
+        """Put back a quality where it was in an item's qualities."""
+        item = self._items[name]
+        qualities = list(item.qualities)
+        qualities.insert(position, quality)
+        item.qualities = dict.fromkeys(qualities)
+        record(self.remove_quality, name, quality)
+
+    def categories(self):
+        """Return the categories of equipment, sorted. Categories differing
+        only in case are listed once."""
+        return [
+            self._items[keys[0][1]].category
+            for _, keys in sorted(self._categories.items())
+        ]
+
+    def search(self, prefix):
+        """Return the names starting with a prefix, ignoring case, in
+        order."""
+        prefix = prefix.casefold()
+        start = bisect_left(self._sorted, (prefix,))
+        names = []
+        for folded, name in self._sorted[start:]:
+            if not folded.startswith(prefix):
+                break
+            names.append(name)
+        return names
+
+    def page(self, page, per_page, category=None):
+        """Return the items on one page of the catalog, counting from page
+        1, optionally only those in a category, and the number of pages."""
+        if category is None:
+            keys = self._sorted
+        else:
+            keys = self._categories.get(category.casefold(), [])
+        pages = max(-(-len(keys) // per_page), 1)
+        start = (page - 1) * per_page
+        return [
+            self._items[name] for _, name in keys[start:start + per_page]
+        ], pages
+
+    def to_dict(self):
+        """Return the dict of all items, by name."""
+        return {name: item.to_dict() for name, item in self._items.items()}
+
+    @classmethod
+    def from_dict(cls, equipment):
+        """Create a catalog from a dict of items by name."""
+        catalog = cls()
+        for name, details in equipment.items():
+            catalog._add(Item(  # pylint: disable=W0212
+                name, details['category'], details['qualities']))
+        return catalog
+
+
+def _remove_sorted(keys, key):
+    """Remove a key from a sorted list."""
+    del keys[bisect_left(keys, key)]
+
+
+def _test_catalog():
+    print('Checking equipment catalog...', end='')
+    catalog = EquipmentCatalog.from_dict({
+        'Stake': {'category': 'weapon', 'qualities': ['wood']},
+        'shotgun': {'category': 'Weapon', 'qualities': []},
+        'Silver mirror': {'category': 'tool', 'qualities': []},
+    })
+    assert list(catalog) == ['shotgun', 'Silver mirror', 'Stake']
+    assert catalog.search('S') == ['shotgun', 'Silver mirror', 'Stake']
+    assert catalog.search('st') == ['Stake']
+    assert catalog.search('x') == []
+    items, pages = catalog.page(1, 1, 'WEAPON')
+    assert [item.name for item in items] == ['shotgun']
+    assert pages == 2
+    assert catalog.page(3, 1, 'tool') == ([], 1)
+    assert catalog.categories() == ['tool', 'Weapon']
+
+    before = catalog.to_dict()
+    with recording() as changes:
+        catalog.add_quality('Stake', 'sharp')
+        catalog.remove_quality('Stake', 'wood')
+        catalog.destroy('shotgun')
+        catalog.create('Garlic', 'tool')
+    assert list(catalog['Stake'].qualities) == ['sharp']
+    revert(changes)
+    assert catalog == before
+    assert list(catalog) == ['shotgun', 'Silver mirror', 'Stake']
+    print(' OK.')
+
+
+if __name__ == '__main__':
+    _test_catalog()
@@ -0,0 +1,123 @@
+"""Append-only journal of session changes, replayed on top of the last save."""
+import json
+import os
+import tempfile
+import time
+
+JOURNAL_NAME = 'session.journal'
+
+
+class Journal:
+    """Write-ahead journal of successful session operations.
+
+    Each record is one line of compact JSON, numbered with an increasing
+    sequence number so that a save can note which records it includes.
+    Records are flushed to the OS as soon as they are written, but only
+    fsynced every `sync_every` records or `sync_interval` seconds, whichever
+    comes first.
+    """
+    def __init__(self, path, sequence=0, sync_every=20, sync_interval=1.0):
+        self.path = path
+        self.sequence = sequence
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._handle = open(  # pylint: disable=R1732
+            path, 'a', encoding='utf-8')
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def append(self, operation, args, kwargs):
+        """Append a record of an operation to the journal."""
+        self.sequence += 1
+        record = {
+            'seq': self.sequence,
+            'ts': time.time(),
+            'op': operation,
+            'args': list(args),
+        }
+        if kwargs:
+            record['kwargs'] = kwargs
+        self._handle.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._handle.flush()
+        self._unsynced += 1
+        if (
+            self._unsynced >= self.sync_every
+            or time.monotonic() - self._last_sync >= self.sync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        """Make sure everything written so far is on disk."""
+        if self._unsynced:
+            os.fsync(self._handle.fileno())
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def truncate(self):
+        """Discard all records, e.g. because a full save now covers them."""
+        self._handle.seek(0)
+        self._handle.truncate()
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """Sync and close the journal."""
+        self.sync()
+        self._handle.close()
+
+
+def read_journal(path):
+    """Yield the records from a journal.
+    A partially written final record (e.g. from a crash mid-write) is
+    ignored.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as journal_handle:
+        for line in journal_handle:
+            if not line.endswith('\n'):
+                break
+            yield json.loads(line)
+
+
+def _test_round_trip():
+    print('Checking journal round trip...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, JOURNAL_NAME)
+        journal = Journal(path, sync_every=2)
+        journal.append('set_skill', (1, 'Brawl', '3'), {})
+        journal.append('increase_skill', (1, 'brawl'),
+                       {'exceed_maximum': True})
+        journal.close()
+        with open(path, 'a', encoding='utf-8') as torn:
+            torn.write('{"ts":1,"op":"set_')
+        records = list(read_journal(path))
+        assert [record['op'] for record in records] == [
+            'set_skill', 'increase_skill']
+        assert [record['seq'] for record in records] == [1, 2]
+        assert records[0]['args'] == [1, 'Brawl', '3']
+        assert 'kwargs' not in records[0]
+        assert records[1]['kwargs'] == {'exceed_maximum': True}
+    print(' OK.')
+
+
+def _test_truncate():
+    print('Checking journal truncation...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, JOURNAL_NAME)
+        journal = Journal(path, sequence=5)
+        journal.append('add_note', (1, 'first'), {})
+        journal.truncate()
+        journal.append('add_note', (1, 'second'), {})
+        journal.close()
+        records = list(read_journal(path))
+        assert [record['args'][1] for record in records] == ['second']
+        assert records[0]['seq'] == 7
+    print(' OK.')
+
+
+if __name__ == '__main__':
+    _test_round_trip()
+    _test_truncate()
@@ -0,0 +1,160 @@
+"""Locks for sharing sessions between threads."""
+from contextlib import contextmanager
+import threading
+
+
+class SharedLock:
+    """A reentrant lock that may be held shared by many threads at once, or
+    exclusively by one.
+
+    Using it as a context manager holds it exclusively. A thread holding it
+    exclusively may also take it shared, but a thread holding it only shared
+    can't take it exclusively. Threads waiting to take it exclusively are
+    let in before any more threads take it shared.
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._owner = None
+        self._depth = 0
+        # Shared holds by thread ident
+        self._shared = {}
+        self._waiting = 0
+
+    def acquire(self):
+        """Take the lock exclusively."""
+        me = threading.get_ident()
+        with self._condition:
+            if self._owner == me:
+                self._depth += 1
+                return
+            if me in self._shared:
+                raise RuntimeError(
+                    'Cannot take a shared lock exclusively while sharing it.')
+            self._waiting += 1
+            try:
+                self._condition.wait_for(
+                    lambda: self._owner is None and not self._shared)
+            finally:
+                self._waiting -= 1
+            self._owner = me
+            self._depth = 1
+
+    def release(self):
+        """Release an exclusive hold of the lock."""
+        with self._condition:
+            if self._owner != threading.get_ident():
+                raise RuntimeError('Cannot release an unheld lock.')
+            self._depth -= 1
+            if not self._depth:
+                self._owner = None
+                self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire_shared(self):
+        """Take the lock shared."""
+        me = threading.get_ident()
+        with self._condition:
+            if self._owner != me and me not in self._shared:
+                self._condition.wait_for(
+                    lambda: self._owner is None and not self._waiting)
+            self._shared[me] = self._shared.get(me, 0) + 1
+
+    def release_shared(self):
+        """Release a shared hold of the lock."""
+        me = threading.get_ident()
+        with self._condition:
+            if me not in self._shared:
+                raise RuntimeError('Cannot release an unheld lock.')
+            self._shared[me] -= 1
+            if not self._shared[me]:
+                del self._shared[me]
+                self._condition.notify_all()
+
+    @contextmanager
+    def shared(self):
+        """Hold the lock shared in this context."""
+        self.acquire_shared()
+        try:
+            yield self
+        finally:
+            self.release_shared()
+
+
+class KeyedLocks:
+    """Reentrant locks created on demand, one per key."""
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            with self._lock:
+                lock = self._locks.setdefault(key, threading.RLock())
+        return lock
+
+
+def _test_shared_lock():
+    print('Checking shared locks...', end='')
+    lock = SharedLock()
+    order = []
+
+    def write():
+        with lock:
+            order.append('writer')
+
+    def read():
+        with lock.shared():
+            order.append('reader')
+
+    with lock.shared():
+        with lock.shared():
+            writer = threading.Thread(target=write)
+            writer.start()
+            writer.join(0.1)
+            assert writer.is_alive()
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(0.1)
+            # New readers wait behind the waiting writer
+            assert reader.is_alive()
+        try:
+            lock.acquire()
+            assert False
+        except RuntimeError:
+            pass
+    writer.join()
+    reader.join()
+    assert order == ['writer', 'reader']
+
+    with lock:
+        with lock.shared():
+            with lock:
+                pass
+    reader = threading.Thread(target=read)
+    reader.start()
+    reader.join(1)
+    assert not reader.is_alive()
+    print(' OK.')
+
+
+def _test_keyed_locks():
+    print('Checking keyed locks...', end='')
+    locks = KeyedLocks()
+    assert locks[1] is locks[1]
+    assert locks[1] is not locks[2]
+    with locks[1]:
+        with locks[1]:
+            pass
+    print(' OK.')
+
+
+if __name__ == '__main__':
+    _test_shared_lock()
+    _test_keyed_locks()
@@ -0,0 +1,259 @@
+"""Management of many concurrent vampire sessions."""
+import asyncio
+from collections import OrderedDict
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from .session import Session
+from .snapshot import SnapshotService
+
+
+class SessionManager:  # pylint: disable=R0902
+    """Sessions for many games, e.g. one per guild, loaded on demand.
+
+    Each game is saved in its own directory under `save_path`, named after
+    its key, unless it has been given a path in `paths`.
+    Sessions not used for `idle_timeout` seconds are saved and unloaded, as
+    are the least recently used ones whenever more than `max_sessions`
+    sessions or `max_characters` characters are loaded. Sessions held by
+    `get` are never unloaded until released.
+    """
+    def __init__(  # pylint: disable=R0913
+            self, save_path, storage_backend=None, max_sessions=100,
+            max_characters=5000, idle_timeout=3600, snapshot_interval=30,
+            undo_depth=10, xp_log_limit=200, paths=None):
+        self.save_path = save_path
+        self.storage_backend = storage_backend
+        self.max_sessions = max_sessions
+        self.max_characters = max_characters
+        self.idle_timeout = idle_timeout
+        self.snapshot_interval = snapshot_interval
+        self.undo_depth = undo_depth
+        self.xp_log_limit = xp_log_limit
+        self.paths = paths or {}
+        self.sessions = OrderedDict()
+        self.snapshots = {}
+        self.last_used = {}
+        # How many holds there are on each session
+        self.in_use = {}
+        self._lock = threading.Lock()
+        self._task = None
+
+    def session_path(self, key):
+        """Get the save path for a game."""
+        return self.paths.get(key) or os.path.join(self.save_path, str(key))
+
+    def get(self, key, hold=False):
+        """Get the session for a game, loading it if needed.
+        If `hold` is set, the session stays loaded until `release` is called
+        for it."""
+        with self._lock:
+            session = self.sessions.get(key)
+            if session is None:
+                path = self.session_path(key)
+                os.makedirs(path, exist_ok=True)
+                session = Session(self.undo_depth, self.xp_log_limit)
+                session.load(path, self.storage_backend)
+                self.sessions[key] = session
+                self.snapshots[key] = SnapshotService(
+                    session, path, self.snapshot_interval)
+                if self._task is not None:
+                    self.snapshots[key].start()
+            self.sessions.move_to_end(key)
+            self.last_used[key] = time.monotonic()
+            if hold:
+                self.in_use[key] = self.in_use.get(key, 0) + 1
+            return session
+
+    def release(self, key):
+        """Release a hold on a session from `get`."""
+        with self._lock:
+            self.in_use[key] -= 1
+            if not self.in_use[key]:
+                del self.in_use[key]
+
+    def loaded_characters(self):
+        """Count the characters currently loaded across all sessions."""
+        return sum(
+            len(session.player_characters.loaded())
+            for session in self.sessions.values()
+        )
+
+    def _choose_evictions(self, now=None):
+        """Pick sessions to unload: those that are idle, then the least
+        recently used until within budget. The most recently used session and
+        those held are never chosen."""
+        if now is None:
+            now = time.monotonic()
+        keys = [key for key in list(self.sessions)[:-1]
+                if key not in self.in_use]
+        chosen = [
+            key for key in keys
+            if now - self.last_used[key] > self.idle_timeout
+        ]
+        remaining = len(self.sessions) - len(chosen)
+        characters = self.loaded_characters() - sum(
+            len(self.sessions[key].player_characters.loaded())
+            for key in chosen
+        )
+        for key in keys:
+            if key in chosen:
+                continue
+            if (
+                    remaining <= self.max_sessions
+                    and characters <= self.max_characters
+            ):
+                break
+            chosen.append(key)
+            remaining -= 1
+            characters -= len(self.sessions[key].player_characters.loaded())
+        return chosen
+
+    async def evict(self, key, force=False):
+        """Save and unload a session.
+        If the session is held, or is used again while it is being saved, it
+        is left loaded unless `force` is set. Returns whether it was unloaded.
+        """
+        session = self.sessions[key]
+        snapshots = self.snapshots[key]
+        last_used = self.last_used[key]
+        await snapshots.stop()
+        with self._lock:
+            in_use = (
+                key in self.in_use or self.last_used[key] != last_used
+            )
+            if session.dirty or in_use:
+                if not force:
+                    if self._task is not None:
+                        snapshots.start()
+                    return False
+                session.save(self.session_path(key))
+            self.sessions.pop(key)
+            self.snapshots.pop(key)
+            self.last_used.pop(key)
+        session.close()
+        return True
+
+    async def evict_idle(self, now=None):
+        """Unload idle sessions and any over budget.
+        Returns the keys of unloaded sessions."""
+        evicted = []
+        for key in self._choose_evictions(now):
+            if await self.evict(key):
+                evicted.append(key)
+        return evicted
+
+    def start(self, interval=60):
+        """Start saving sessions and unloading idle ones in the background."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run(interval))
+            for snapshots in self.snapshots.values():
+                snapshots.start()
+
+    async def _run(self, interval):
+        """Unload idle sessions every interval, carrying on if that fails."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict_idle()
+            except Exception as err:  # pylint: disable=W0703
+                sys.stderr.write('Could not unload sessions: {!r}\n'.format(
+                    err))
+
+    async def close(self):
+        """Save and unload all sessions."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for key in list(self.sessions):
+            await self.evict(key, force=True)
+
+    def save_all(self):
+        """Save all sessions immediately, e.g. when exiting."""
+        with self._lock:
+            for key, session in self.sessions.items():
+                session.save(self.session_path(key))
+
+
+def _test_load_on_demand():
+    print('Checking sessions are loaded on demand...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = SessionManager(tmp)
+        first = manager.get(1)
+        first.add_player(10, 'Alice')
+        assert manager.get(1) is first
+        second = manager.get(2)
+        assert second is not first
+        assert 10 not in second.player_characters
+        asyncio.run(manager.close())
+        assert not manager.sessions
+
+        manager = SessionManager(tmp)
+        assert 10 in manager.get(1).player_characters
+        assert 10 not in manager.get(2).player_characters
+        asyncio.run(manager.close())
+    print(' OK.')
+
+
+def _test_eviction():
+    print('Checking idle and excess sessions are unloaded...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = SessionManager(tmp, max_sessions=2, idle_timeout=100)
+        for key in range(4):
+            manager.get(key).add_player(key, 'Player')
+        manager.last_used[0] -= 200
+        assert manager._choose_evictions() == [0, 1]  # pylint: disable=W0212
+        assert asyncio.run(manager.evict_idle()) == [0, 1]
+        assert list(manager.sessions) == [2, 3]
+
+        manager.max_characters = 0
+        manager.get(2)
+        assert asyncio.run(manager.evict_idle()) == [3]
+        assert 3 in manager.get(3).player_characters
+
+        # Held sessions stay loaded until released
+        manager.get(2, hold=True)
+        manager.get(3)
+        assert asyncio.run(manager.evict_idle()) == []
+        assert not asyncio.run(manager.evict(2))
+        manager.release(2)
+        assert asyncio.run(manager.evict_idle()) == [2]
+        asyncio.run(manager.close())
+    print(' OK.')
+
+
+def _test_failed_eviction():
+    print('Checking unloading carries on after failing...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = SessionManager(tmp)
+        attempts = []
+
+        async def evict_idle():
+            attempts.append(len(attempts))
+            if len(attempts) == 1:
+                raise OSError('Disk full')
+            return []
+
+        async def run():
+            manager.start(0.01)
+            await asyncio.sleep(0.1)
+            await manager.close()
+
+        manager.evict_idle = evict_idle
+        stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+        try:
+            asyncio.run(run())
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        assert len(attempts) > 1
+    print(' OK.')
+
+
+if __name__ == '__main__':
+    _test_load_on_demand()
+    _test_eviction()
+    _test_failed_eviction()
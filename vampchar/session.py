@@ -1,103 +1,570 @@
 """Session management for vampire sessions."""
+from contextlib import contextmanager
 from copy import deepcopy
+from datetime import datetime
+from functools import wraps
+from inspect import signature
 import json
 import os
+import re
+import shlex
 import sys
-
-from .sheet import Character
-
-SAVE_NAME = 'session.save'
+import tempfile
+import threading
+
+from .equipment import EquipmentCatalog
+from .journal import JOURNAL_NAME, Journal, read_journal
+from .locks import KeyedLocks, SharedLock
+from .sheet import DAMAGE_TYPES, Character, replaying_at
+from .sqlstorage import SQLiteStorage
+from .storage import LEGACY_SAVE_NAME, LazyCharacters, ShardedStorage
+from .tracking import History, PointsDict, recording, revert
+
+STORAGE_BACKENDS = {
+    'files': ShardedStorage,
+    'sqlite': SQLiteStorage,
+}
+
+
+def journalled(func):
+    """Record successful calls of this function in the session journal.
+    Functions taking a player ID mark that player as needing to be saved,
+    and only lock that player, so that different players' changes can be
+    made at the same time. Other functions lock the whole session.
+    """
+    per_player = list(signature(func).parameters)[1:2] == ['player_id']
+
+    @wraps(func)
+    def run_and_record(*args, **kwargs):
+        """Run the function, then record it if it succeeded."""
+        self = args[0]
+        with self.lock_for(args[1] if per_player else None):
+            state = self._state  # pylint: disable=W0212
+            state.journal_depth += 1
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                state.journal_depth -= 1
+                if per_player:
+                    self.changed_players.add(args[1])
+            self._record(  # pylint: disable=W0212
+                func.__name__, args[1:], kwargs)
+        return result
+    run_and_record.journalled = True
+    return run_and_record
 
 
 def support_undo(func):
-    """Make this function support undo."""
-    def set_undo_point_and_run(*args, **kwargs):
-        """Set the undo point and run the function."""
+    """Make this function support undo and redo.
+    If the function fails, any changes it made are reversed.
+    """
+    @wraps(func)
+    def record_changes_and_run(*args, **kwargs):
+        """Record how to reverse the changes made by the function."""
         self = args[0]
         player_id = args[1]
-        self.undo_points[player_id] = deepcopy(
-            self.player_characters[player_id])
-        return func(*args, **kwargs)
-    return set_undo_point_and_run
+        try:
+            with recording() as changes:
+                result = func(*args, **kwargs)
+        except Exception:
+            revert(changes)
+            raise
+        if changes:
+            history = self.history_for(player_id)
+            transaction = self._state.transaction  # pylint: disable=W0212
+            if (
+                    transaction is not None
+                    and history not in transaction['histories']
+            ):
+                transaction['histories'][history] = (
+                    history.undo_stack.copy(), history.redo_stack.copy())
+            history.push(changes)
+        return result
+    return record_changes_and_run
+
+
+_MENTION = re.compile(r'<@!?(\d+)>$')
+# Operations that can't be part of a batch, e.g. because they are only
+# journalled to replay something else
+_UNBATCHED = {'restore_character'}
+# Operations whose player doesn't need to be playing yet
+_NEW_PLAYER_OPERATIONS = {'add_player'}
+
+
+def parse_batch(script):
+    """Parse a batch script into a list of [operation, args, kwargs].
+    Each line is an operation name followed by its arguments, quoted where
+    they contain spaces. Arguments of the form name=value are passed by
+    name. Blank lines and lines starting with # are skipped.
+    """
+    operations = []
+    for number, line in enumerate(script.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            words = shlex.split(line)
+        except ValueError as err:
+            raise BadInput(  # pylint: disable=W0707
+                'Line {}: {}.'.format(number, err))
+        args = []
+        kwargs = {}
+        for word in words[1:]:
+            name, equals, value = word.partition('=')
+            if equals and name.isidentifier():
+                if value.lower() in ('true', 'false'):
+                    value = value.lower() == 'true'
+                kwargs[name] = value
+            else:
+                args.append(word)
+        operations.append([words[0], args, kwargs])
+    return operations
+
+
+def _format_xp_entry(entry):
+    """Format an XP log entry for display."""
+    if entry.code == 'legacy':
+        return entry.reason
+    if entry.code == 'checkpoint':
+        output = '{}: {:+} XP from earlier entries'.format(
+            entry.time, entry.amount)
+    else:
+        output = '{}: {:+} XP for {}'.format(
+            entry.time, entry.amount, entry.reason)
+    if entry.current is not None:
+        output += ' ({} unspent, {} total)'.format(
+            entry.current, entry.total)
+    return output
+
+
+def _page_of(items, page, per_page, name):
+    """Return one page of a list, counting from page 1, and the number of
+    pages. Complains about pages that don't exist."""
+    pages = max(-(-len(items) // per_page), 1)
+    if not 1 <= page <= pages:
+        raise BadInput('There are only {} pages of {}.'.format(pages, name))
+    start = (page - 1) * per_page
+    return items[start:start + per_page], pages
+
+
+def _format_item(item):
+    """Format an item of equipment for a listing."""
+    output = '{name} [{category}]'.format(
+        name=item.name,
+        category=item.category,
+    )
+    if item.qualities:
+        output += ' ({})'.format(', '.join(item.qualities))
+    return output
 
 
 class BadInput(Exception):
     """Raised when bad input is supplied by the frontend."""
 
 
-class Session: # pylint: disable=R0904
-    """Vampire session manager."""
-    player_characters = {}
-    undo_points = {}
-    equipment = {}
-
-    def load(self, session_save_path):
-        """Load the game from its save path."""
-        save_path = os.path.join(session_save_path, SAVE_NAME)
-        if not os.path.exists(save_path):
-            return
-
-        with open(save_path, encoding='utf-8') as save_handle:
-            data = json.load(save_handle)
+class _OperationState(threading.local):
+    """What the current thread is doing in a session."""
+    def __init__(self):
+        super().__init__()
+        # How deeply journalled operations are nested
+        self.journal_depth = 0
+        # Operations and undo histories changed by the current transaction
+        self.transaction = None
 
-        self.equipment = data['equipment']
-        for player_id, character_data in data['player_characters'].items():
-            character = Character()
-            character.from_dict(character_data)
-            self.player_characters[int(player_id)] = character
 
-    def save(self, session_save_path):
-        """Save the game to its save path."""
-        save_data = json.dumps({
-            'equipment': self.equipment,
-            'player_characters': {
-                player_id: sheet.to_dict()
-                for player_id, sheet in self.player_characters.items()
-            },
-        })
+class Session: # pylint: disable=R0902,R0904
+    """Vampire session manager."""
+    storage_backend = 'files'
+
+    def __init__(self, undo_depth=10, xp_log_limit=200, archive_xp=True):
+        self.player_characters = LazyCharacters()
+        self.undo_depth = undo_depth
+        # XP logs longer than this are compacted to half of it when saving,
+        # with the older entries archived if archive_xp is set
+        self.xp_log_limit = xp_log_limit
+        self.archive_xp = archive_xp
+        self.histories = {}
+        self.equipment = EquipmentCatalog()
+        self.storage = None
+        self.journal = None
+        self.dirty = False
+        # Players and equipment changed since the last save
+        self.changed_players = set()
+        self.equipment_changed = False
+        # Who holds each item of equipment, as {item: {player_id: count}},
+        # built when first needed
+        self._holders = None
+        # Held exclusively while changing several players or the equipment,
+        # or saving the session, so saves are consistent. Changes to one
+        # player hold it shared, along with that player's lock.
+        self.lock = SharedLock()
+        self.player_locks = KeyedLocks()
+        self._journal_lock = threading.Lock()
+        self._holders_lock = threading.RLock()
+        self._state = _OperationState()
+
+    def load(self, session_save_path, storage_backend=None):
+        """Load the game from its save path, then replay any changes
+        journalled since it was last saved.
+        Characters are only read from disk when they are first used.
+        """
+        if storage_backend is not None:
+            if storage_backend not in STORAGE_BACKENDS:
+                raise ValueError('Unknown storage backend {}. Try: {}'.format(
+                    storage_backend, ', '.join(STORAGE_BACKENDS)))
+            self.storage_backend = storage_backend
+        self.storage = STORAGE_BACKENDS[self.storage_backend](
+            session_save_path)
+        equipment, self.player_characters, saved_sequence = (
+            self.storage.load())
+        self.equipment = EquipmentCatalog.from_dict(equipment)
+        self._holders = None
+        if self.storage.needs_full_save():
+            self.changed_players = set(self.player_characters)
+            self.equipment_changed = True
+
+        journal_path = os.path.join(session_save_path, JOURNAL_NAME)
+        sequence = self._replay(journal_path, saved_sequence)
+        self.journal = Journal(journal_path, sequence)
+
+    def close(self):
+        """Close the session's journal and storage.
+        Any unsaved changes are still in the journal.
+        """
+        with self.lock, self._journal_lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if self.storage is not None:
+                self.storage.close()
+
+    def sync_journal(self):
+        """Make sure every journalled operation is on disk."""
+        with self._journal_lock:
+            if self.journal is not None:
+                self.journal.sync()
+
+    @contextmanager
+    def lock_for(self, player_id=None):
+        """Lock the session for changes to a player, or for changes to
+        anything if no player is given."""
+        if player_id is None:
+            with self.lock:
+                yield
+        else:
+            with self.lock.shared(), self.player_locks[player_id]:
+                yield
+
+    def history_for(self, player_id):
+        """Get the undo history for a player."""
+        history = self.histories.get(player_id)
+        if history is None:
+            history = self.histories[player_id] = History(self.undo_depth)
+        return history
+
+    def _replay(self, journal_path, saved_sequence):
+        """Reapply journalled operations that are newer than the save, in
+        order. Returns the last sequence number seen."""
+        sequence = saved_sequence
+        for record in read_journal(journal_path):
+            if record.get('seq', sequence + 1) <= saved_sequence:
+                continue
+            sequence = record.get('seq', sequence)
+            operation = getattr(self, record['op'])
+            with replaying_at(datetime.fromtimestamp(record['ts'])):
+                try:
+                    operation(*record['args'], **record.get('kwargs', {}))
+                except BadInput as err:
+                    sys.stderr.write('Could not replay {}: {}\n'.format(
+                        record, err))
+        return sequence
+
+    def _record(self, operation, args, kwargs):
+        """Journal an operation, unless it was called by another one.
+        Operations in a transaction are journalled together when it ends."""
+        if self._state.journal_depth:
+            return
+        if self._state.transaction is not None:
+            self._state.transaction['operations'].append(
+                [operation, list(args), kwargs])
+            return
+        with self._journal_lock:
+            self.dirty = True
+            if self.journal is not None:
+                self.journal.append(operation, args, kwargs)
+
+    @contextmanager
+    def transaction(self):
+        """Make a group of changes atomically.
+        If anything in the group fails, every change made in it is reversed.
+        Otherwise the operations are journalled together as one batch, so
+        they are replayed as a unit. Transactions inside another one join
+        it.
+        """
+        with self.lock:
+            if self._state.transaction is not None:
+                yield
+                return
+            transaction = self._state.transaction = {
+                'operations': [],
+                # Copies of the undo and redo stacks of each history changed
+                'histories': {},
+            }
+            histories = dict(self.histories)
+            try:
+                with recording() as changes:
+                    yield
+            except Exception:
+                revert(changes)
+                for history, stacks in transaction['histories'].items():
+                    history.undo_stack, history.redo_stack = stacks
+                self.histories = histories
+                self._holders = None
+                raise
+            finally:
+                self._state.transaction = None
+            if transaction['operations']:
+                self._record('batch', (transaction['operations'],), {})
+
+    def batch(self, operations):
+        """Apply a list of [operation, args, kwargs] in one transaction.
+        Every operation is checked before any is applied, and if any fails
+        none of them take effect."""
+        calls = [
+            self._prepare_batch_call(number, *operation)
+            for number, operation in enumerate(operations, 1)
+        ]
+        results = []
+        with self.transaction():
+            for number, (method, args, kwargs, player_id) in enumerate(
+                    calls, 1):
+                # Checked now as earlier operations may add or remove players
+                if (
+                        player_id is not None
+                        and player_id not in self.player_characters
+                ):
+                    raise BadInput(
+                        'Operation {} ({}) failed: {} is not playing. '
+                        'No changes were made.'.format(
+                            number, method.__name__, player_id))
+                try:
+                    results.append(method(*args, **kwargs))
+                except Exception as err:  # pylint: disable=W0703
+                    if isinstance(err, KeyError):
+                        reason = '{} not found.'.format(err.args[0])
+                    else:
+                        reason = str(err) or type(err).__name__
+                    raise BadInput(  # pylint: disable=W0707
+                        'Operation {} ({}) failed: {} '
+                        'No changes were made.'.format(
+                            number, method.__name__, reason))
+        return 'Applied {} operations:\n{}'.format(len(results), '\n'.join(
+            '{}. {}'.format(number, result or 'Done.')
+            for number, result in enumerate(results, 1)
+        ))
+
+    def _prepare_batch_call(self, number, operation, args=(), kwargs=None):
+        """Check one operation of a batch, returning the method to call, its
+        arguments, and the player who must be playing when it is called, if
+        any."""
+        kwargs = kwargs or {}
+        method = getattr(self, operation, None)
+        if (
+                operation.startswith('_') or operation in _UNBATCHED
+                or not getattr(method, 'journalled', False)
+        ):
+            raise BadInput('Operation {}: {} is not an operation.'.format(
+                number, operation))
+        args = list(args)
+        parameters = list(signature(method).parameters)
+        player_id = None
+        if args and parameters[0] == 'player_id':
+            mention = _MENTION.match(str(args[0]))
+            try:
+                args[0] = int(mention.group(1) if mention else args[0])
+            except ValueError:
+                raise BadInput(  # pylint: disable=W0707
+                    'Operation {}: {} is not a player.'.format(
+                        number, args[0]))
+            if operation not in _NEW_PLAYER_OPERATIONS:
+                player_id = args[0]
         try:
-            save_path = os.path.join(session_save_path, SAVE_NAME)
-            with open(save_path, 'w', encoding='utf-8') as save_handle:
-                save_handle.write(save_data + '\n')
-        except Exception as _:  # pylint: disable=W0703
-            sys.stderr.write('Failed to write save data:\n')
-            sys.stderr.write('Save data: {}\n'.format(save_data))
-            raise
+            signature(method).bind(*args, **kwargs)
+        except TypeError:
+            raise BadInput(  # pylint: disable=W0707
+                'Operation {}: {} takes: {}'.format(
+                    number, operation, ' '.join(parameters)))
+        return method, args, kwargs, player_id
 
+    def save(self, session_save_path):
+        """Save changes to the game to its save path.
+        Only players and equipment changed since the last save are written.
+        """
+        with self.lock:
+            if (
+                    self.storage is None
+                    or self.storage.save_path != session_save_path
+            ):
+                self.storage = STORAGE_BACKENDS[self.storage_backend](
+                    session_save_path)
+                self.changed_players = set(self.player_characters)
+                self.equipment_changed = True
+            sequence = 0
+            if self.journal is not None:
+                sequence = self.journal.sequence
+            try:
+                self._compact_xp_logs()
+                self.storage.save(
+                    (
+                        self.equipment.to_dict() if self.equipment_changed
+                        else None
+                    ),
+                    self.player_characters,
+                    self.changed_players,
+                    sequence,
+                )
+            except Exception as _:  # pylint: disable=W0703
+                sys.stderr.write('Failed to write save data to {}\n'.format(
+                    session_save_path))
+                raise
+            self.changed_players = set()
+            self.equipment_changed = False
+            with self._journal_lock:
+                self.dirty = False
+                if self.journal is not None:
+                    self.journal.truncate()
+
+    def _holder_index(self):
+        """Get the index of who holds each item of equipment, building it
+        if needed. Building it loads every character."""
+        with self._holders_lock:
+            if self._holders is None:
+                holders = {}
+                for player_id, character in self.player_characters.items():
+                    for item, count in character.equipment.items():
+                        holders.setdefault(item, {})[player_id] = count
+                self._holders = holders
+            return self._holders
+
+    def _update_holdings(self, player_id, items=None):
+        """Update the holder index for a player's equipment.
+        Only the given items are updated, unless the player's character may
+        have been replaced, in which case all of them are."""
+        with self._holders_lock:
+            if self._holders is None:
+                return
+            equipment = {}
+            if player_id in self.player_characters:
+                equipment = self.player_characters[player_id].equipment
+            if items is None:
+                for holders in self._holders.values():
+                    holders.pop(player_id, None)
+                items = equipment
+            for item in items:
+                count = equipment.get(item, 0)
+                holders = self._holders.setdefault(item, {})
+                if count:
+                    holders[player_id] = count
+                else:
+                    holders.pop(player_id, None)
+                if not holders:
+                    del self._holders[item]
+
+    def _compact_xp_logs(self):
+        """Compact the XP logs of changed characters that have grown too
+        long, archiving the entries removed."""
+        if not self.xp_log_limit:
+            return
+        loaded = self.player_characters.loaded()
+        for player_id in self.changed_players:
+            character = loaded.get(player_id)
+            if (
+                    character is None
+                    or len(character.experience.log) <= self.xp_log_limit
+            ):
+                continue
+            removed = character.experience.log.compact(
+                self.xp_log_limit // 2)
+            if self.archive_xp:
+                self.storage.archive_xp_log(player_id, removed)
+
+    @journalled
     def add_player(self, player_id, player_name, reset=False):
         """Add a player to the game."""
         if player_id in self.player_characters:
             raise BadInput("{} has already joined.".format(player_name))
         self.player_characters[player_id] = Character()
         self.player_characters[player_id].player = player_name
+        self._update_holdings(player_id)
         if reset:
             return "Reset {}.".format(player_name)
         return "Added {}.".format(player_name)
 
+    @journalled
     def remove_player(self, player_id, player_name):
         """Remove a player from the game."""
         if player_id not in self.player_characters:
             raise BadInput('{} was not a member.'.format(player_name))
         self.player_characters.pop(player_id)
+        self.histories.pop(player_id, None)
+        self._update_holdings(player_id)
         return "Removed {}".format(player_name)
 
+    @journalled
     def award_xp(self, amount, reason):
         """Award all players some XP for a given reason."""
         amount = self._check_int(amount)
-        for character in self.player_characters.values():
-            character.award_xp(amount, reason)
+        with self.transaction():
+            for character in self.player_characters.values():
+                character.award_xp(amount, reason)
+        self.changed_players.update(self.player_characters)
         return "All characters received {} XP for {}".format(
             amount, reason,
         )
 
+    def player_names(self):
+        """Get the player name on each character's sheet, by player ID."""
+        names = {}
+        with self.lock.shared():
+            for player_id in sorted(self.player_characters):
+                with self.player_locks[player_id]:
+                    names[player_id] = self.player_characters[player_id].player
+        return names
+
+    def get_xp_history(self, player_id, page=1, per_page=10):
+        """Show one page of a character's XP log, newest first."""
+        page = self._check_int(page)
+        log = self.player_characters[player_id].experience.log
+        pages = log.page_count(per_page)
+        if not 1 <= page <= pages:
+            raise BadInput('There are only {} pages of XP history.'.format(
+                pages))
+        entries = log.page(page, per_page)
+        if not entries:
+            return 'You have no XP history.'
+        return 'XP history (page {} of {}):\n{}'.format(
+            page, pages, '\n'.join(
+                '  ' + _format_xp_entry(entry) for entry in entries),
+        )
+
     def get_player_json(self, player_id):
         """Get the json of a particular player's character sheet."""
-        return self.player_characters[player_id].to_json()
+        with self.lock_for(player_id):
+            return self.player_characters[player_id].to_json()
 
     def get_player_dict(self, player_id):
-        """Get the dict of a particular player's character sheet."""
-        return self.player_characters[player_id].to_dict()
-
+        """Get a read-only dict of a particular player's character sheet."""
+        with self.lock_for(player_id):
+            return self.player_characters[player_id].view()
+
+    def get_player_view(self, player_id):
+        """Get the version of a player's character sheet, which changes
+        whenever the sheet does, along with its read-only dict."""
+        with self.lock_for(player_id):
+            character = self.player_characters[player_id]
+            return character.version, character.view()
+
+    @journalled
     @support_undo
     def add_focus(self, player_id, attribute, focus):
         """Add a focus on a given attribute."""
@@ -106,13 +573,14 @@ class Session: # pylint: disable=R0904
             raise BadInput(
                 "Focuses cannot be added after character creation.")
         self._validate_attribute(player_id, attribute)
-        if focus in character.attributes[attribute]['focuses']:
+        if focus in character.attributes[attribute].focuses:
             raise BadInput("You already have focus {} in attribute {}".format(
                 focus, attribute,
             ))
-        character.attributes[attribute]['focuses'].append(focus)
+        character.attributes[attribute].focuses.append(focus)
         return "Added {} to {} focuses.".format(focus, attribute)
 
+    @journalled
     @support_undo
     def remove_focus(self, player_id, attribute, focus):
         """Remove a focus from a given attribute."""
@@ -121,13 +589,14 @@ class Session: # pylint: disable=R0904
             raise BadInput(
                 "Focuses cannot be removed after character creation.")
         self._validate_attribute(player_id, attribute)
-        if focus not in character.attributes[attribute]['focuses']:
+        if focus not in character.attributes[attribute].focuses:
             return "You did not have focus {} in attribute {}".format(
                 focus, attribute,
             )
-        character.attributes[attribute]['focuses'].remove(focus)
+        character.attributes[attribute].focuses.remove(focus)
         return "Removed {} from {} focuses.".format(focus, attribute)
 
+    @journalled
     @support_undo
     def set_attribute(self, player_id, attribute, value):
         """Set an attribute to a specified value."""
@@ -137,9 +606,10 @@ class Session: # pylint: disable=R0904
                 "Attributes can not be set after character creation.")
         self._validate_attribute(player_id, attribute)
         value = self._check_int(value)
-        character.attributes[attribute]['value'] = value
+        character.attributes[attribute].value = value
         return "{} set to {}".format(attribute, value)
 
+    @journalled
     @support_undo
     def set_skill(self, player_id, skill, value):
         """Set a skill to a specified value."""
@@ -147,6 +617,7 @@ class Session: # pylint: disable=R0904
         if not character.character_creation:
             raise BadInput("Skills can not be set after character creation.")
         value = self._check_int(value)
+        skill = character.skills.resolve(skill)
         if value == 0:
             if skill not in character.skills:
                 raise BadInput(
@@ -159,6 +630,7 @@ class Session: # pylint: disable=R0904
         character.skills[skill] = value
         return "Set {} to {}".format(skill, value)
 
+    @journalled
     @support_undo
     def set_background(self, player_id, background, value):
         """Set a background to a specified value."""
@@ -167,6 +639,7 @@ class Session: # pylint: disable=R0904
             raise BadInput(
                 "Backgrounds can not be set after character creation.")
         value = self._check_int(value)
+        background = character.backgrounds.resolve(background)
         if value == 0:
             if background not in character.backgrounds:
                 raise BadInput(
@@ -185,11 +658,12 @@ class Session: # pylint: disable=R0904
                 4: (20, 4),
                 5: (30, 5),
             }[value]
-            character.blood['max'] = max_blood
-            character.blood['current'] = max_blood
-            character.blood['rate'] = blood_rate
+            character.blood.max = max_blood
+            character.blood.current = max_blood
+            character.blood.rate = blood_rate
         return "Set {} to {}".format(background, value)
 
+    @journalled
     @support_undo
     def set_discipline(self, player_id, discipline, value):
         """Set a discipline to a specified value."""
@@ -197,6 +671,7 @@ class Session: # pylint: disable=R0904
         if not character.character_creation:
             return "Backgrounds can not be set after character creation."
         value = self._check_int(value)
+        discipline = character.disciplines.resolve(discipline)
         if value == 0:
             if discipline not in character.disciplines:
                 raise BadInput (
@@ -209,38 +684,42 @@ class Session: # pylint: disable=R0904
         character.disciplines[discipline] = value
         return "Set {} to {}".format(discipline, value)
 
+    @journalled
     @support_undo
     def set_blood_burn_rate(self, player_id, rate):
         """Set the character's maximum blood burn rate per round."""
         rate = self._check_int(rate)
-        self.player_characters[player_id].blood['rate'] = rate
+        self.player_characters[player_id].blood.rate = rate
         return "Set blood burn rate to {}".format(rate)
 
+    @journalled
     @support_undo
     def set_healthy_count(self, player_id, count):
         """SEt the amount of healthy levels this character has."""
         count = self._check_int(count)
-        self.player_characters[player_id].health_levels['healthy'] = count
+        self.player_characters[player_id].health_levels.healthy = count
         return "You now have {} healthy levels.".format(count)
 
+    @journalled
     @support_undo
     def set_unhealthy_counts(self, player_id, count):
         """Set the amount of injured and incap levels this character has."""
         count = self._check_int(count)
-        self.player_characters[player_id].health_levels['injured'] = count
-        self.player_characters[player_id].health_levels[
-            'incapacitated'] = count
+        self.player_characters[player_id].health_levels.injured = count
+        self.player_characters[player_id].health_levels.incapacitated = (
+            count)
         return "You now have {} injured and incapacitated levels.".format(
             count)
 
+    @journalled
     @support_undo
     def set_max_willpower(self, player_id, maximum):
         """Set the max willpower for this character."""
         maximum = self._check_int(maximum)
         character = self.player_characters[player_id]
-        character.willpower['max'] = maximum
+        character.willpower.max = maximum
         if character.character_creation:
-            character.willpower['current'] = maximum
+            character.willpower.current = maximum
         return "Your maximum willpower is now {}.".format(maximum)
 
     def _validate_attribute(self, player_id, attribute):
@@ -269,34 +748,41 @@ class Session: # pylint: disable=R0904
     def _check_xp_available(self, player_id, cost):
         """Check the character has enough experience for something."""
         experience = self.player_characters[player_id].experience
-        if cost > experience['current']:
+        if cost > experience.current:
             raise BadInput(
                 "You need at least {} XP, but you only have {}".format(
-                    cost, experience['current'],
+                    cost, experience.current,
                 )
             )
 
     def _get_generation(self, player_id):
         """Get the generation of the character."""
         bgs = self.player_characters[player_id].backgrounds
-        return bgs.get('generation') or bgs.get('Generation')
+        return bgs.get(bgs.resolve('generation'))
 
+    @journalled
     @support_undo
     def add_note(self, player_id, content):
         """Add a note to a character."""
         self.player_characters[player_id].notes.append(content)
         return "Note added."""
 
-    def list_notes(self, player_id):
-        """List notes on a character."""
+    def list_notes(self, player_id, page=1, per_page=20):
+        """List one page of the notes on a character."""
+        page = self._check_int(page)
         notes = self.player_characters[player_id].notes
-        if notes:
-            return "Your notes:\n" + "\n".join([
-                '  {}: {}'.format(pos, note)
-                for pos, note in enumerate(notes, start=1)
-            ])
-        return "You have no notes."
-
+        numbered, pages = _page_of(
+            list(enumerate(notes, start=1)), page, per_page, 'notes')
+        if not notes:
+            return "You have no notes."
+        output = 'Your notes'
+        if pages > 1:
+            output += ' (page {} of {})'.format(page, pages)
+        return output + ':\n' + '\n'.join([
+            '  {}: {}'.format(pos, note) for pos, note in numbered
+        ])
+
+    @journalled
     @support_undo
     def remove_note(self, player_id, pos):
         """Remove a note from a character (1-indexed for non-techies)."""
@@ -311,6 +797,7 @@ class Session: # pylint: disable=R0904
         content = notes.pop(pos - 1)
         return "Removed note {}: {}".format(pos, content)
 
+    @journalled
     @support_undo
     def set_clan(self, player_id, clan):
         """Set a character's clan."""
@@ -320,6 +807,7 @@ class Session: # pylint: disable=R0904
         character.clan = clan
         return "Clan set to {}".format(clan)
 
+    @journalled
     @support_undo
     def set_name(self, player_id, name):
         """Set a player's (character) name."""
@@ -327,6 +815,7 @@ class Session: # pylint: disable=R0904
         character.character = name
         return "Name set to {}".format(name)
 
+    @journalled
     @support_undo
     def set_archetype(self, player_id, archetype):
         """Set a player's archetype."""
@@ -334,6 +823,7 @@ class Session: # pylint: disable=R0904
         character.archetype = archetype
         return "Archetype set to {}".format(archetype)
 
+    @journalled
     @support_undo
     def increase_attribute(self, player_id, attribute):
         """Spend XP to increase an attribute on a character."""
@@ -341,47 +831,41 @@ class Session: # pylint: disable=R0904
         self._check_generation_is_set(player_id)
         character = self.player_characters[player_id]
 
-        cost = character.get_xp_costs()['Attribute']
+        cost = character.cost_of('Attribute',
+                                 character.attributes[attribute].value)
         self._check_xp_available(player_id, cost)
 
         attributes = self.player_characters[player_id].attributes
         gen = self._get_generation(player_id)
         bonuses_spent = 0
         for current_attr in attributes.values():
-            if current_attr['value'] > 10:
-                bonuses_spent += (current_attr['value'] - 10)
+            if current_attr.value > 10:
+                bonuses_spent += (current_attr.value - 10)
 
         if (
             (bonuses_spent + 1) > gen
-            and attributes[attribute]['value'] >= 10
+            and attributes[attribute].value >= 10
         ):
             raise BadInput(
                 "You don't have enough bonus points to raise {} any "
                 "further.".format(attribute)
             )
 
-        attributes[attribute]['value'] += 1
+        attributes[attribute].value += 1
         message = "Raised {} to {}".format(
-            attribute, attributes[attribute]['value']
+            attribute, attributes[attribute].value
         )
         character.spend_xp(cost, message)
         return message
 
-    def _get_correct_case_entry(self, entry, current_list):  # pylint: disable=R0201
-        """Normalise skill/discipline/background increases using an existing
-        skill/discipline/background entry if it exists with a different case.
-        """
-        for current_value in current_list:
-            if entry.lower() == current_value.lower():
-                return current_value
-        return entry
-
+    @journalled
     @support_undo
     def increase_skill(self, player_id, skill, exceed_maximum=False):
         """Increase a skill using xp."""
         return self._increase_scaling_cost_things('skill', player_id, skill,
                                                   exceed_maximum)
 
+    @journalled
     @support_undo
     def increase_background(self, player_id, background):
         """Increase a background using xp."""
@@ -394,6 +878,7 @@ class Session: # pylint: disable=R0904
         return self._increase_scaling_cost_things('background', player_id,
                                                   background)
 
+    @journalled
     @support_undo
     def increase_discipline(self, player_id, discipline, out_of_clan=False):
         """Increase a discipline."""
@@ -415,14 +900,11 @@ class Session: # pylint: disable=R0904
             'in-clan discipline': character.disciplines,
             'out-of-clan discipline': character.disciplines,
         }[thing_type]
-        thing = self._get_correct_case_entry(thing, things)
+        thing = things.resolve(thing)
 
         current_level = things.get(thing, 0)
 
-        cost_multiplier = int(
-            character.get_xp_costs()[thing_type.capitalize()].split('x ')[1]
-        )
-        cost = (current_level +1)  * cost_multiplier
+        cost = character.cost_of(thing_type.capitalize(), current_level)
         self._check_xp_available(player_id, cost)
 
         if current_level == 5 and not exceed_maximum:
@@ -437,16 +919,17 @@ class Session: # pylint: disable=R0904
         character.spend_xp(cost, message)
         return message + " for {} XP".format(cost)
 
+    @journalled
     @support_undo
     def add_merit(self, player_id, merit_name, cost):
         """Add a merit to a character."""
         character = self.player_characters[player_id]
         cost = self._check_int(cost)
 
-        if merit_name.lower() in [item.lower() for item in character.merits]:
+        if character.merits.find(merit_name) is not None:
             raise BadInput('You already have the merit {}'.format(merit_name))
 
-        current_merits_total = sum(character.merits.values())
+        current_merits_total = character.merits.total()
 
         if current_merits_total + cost > 7:
             raise BadInput(
@@ -462,6 +945,7 @@ class Session: # pylint: disable=R0904
         character.spend_xp(cost, message)
         return message + " with cost {}".format(cost)
 
+    @journalled
     @support_undo
     def add_flaw(self, player_id, flaw_name, value):
         """Add a flaw to the character.
@@ -471,7 +955,7 @@ class Session: # pylint: disable=R0904
         character = self.player_characters[player_id]
         value = self._check_int(value)
 
-        if flaw_name.lower() in [item.lower() for item in character.flaws]:
+        if character.flaws.find(flaw_name) is not None:
             raise BadInput('You already have the flaw {}'.format(flaw_name))
 
         if character.character_creation:
@@ -484,6 +968,7 @@ class Session: # pylint: disable=R0904
         character.flaws[flaw_name] = value
         return "Inflicted flaw {} with value {}.".format(flaw_name, value)
 
+    @journalled
     @support_undo
     def add_derangement(self, player_id, derangement):
         """Add a derangement to the character.
@@ -492,15 +977,13 @@ class Session: # pylint: disable=R0904
         Later on, they do not award bonus XP, and have no limit."""
         character = self.player_characters[player_id]
 
-        if derangement.lower() in [item.lower()
-                                   for item in character.derangements]:
+        if character.derangements.find(derangement) is not None:
             raise BadInput('You already have the derangement {}'.format(
                 derangement))
 
         if character.character_creation:
-            is_malkavian = character.clan.lower() == 'malkavian'
             value = 2
-            if is_malkavian and len(character.derangements) == 0:
+            if character.is_malkavian() and not character.derangements:
                 value = 0
             self._check_flaws_and_derangements_limit(player_id, value)
             character.derangements.append(derangement)
@@ -519,12 +1002,7 @@ class Session: # pylint: disable=R0904
         if not character.clan:
             raise BadInput(
                 "You must set your clan before adding derangements or flaws.")
-        is_malkavian = character.clan.lower() == 'malkavian'
-        current_flaws_total = sum(character.flaws.values())
-        derangement_count = len(character.derangements)
-        if is_malkavian:
-            derangement_count = max(0, derangement_count - 1)
-        current_flaws_total += (2 * derangement_count)
+        current_flaws_total = character.flaw_points()
         if current_flaws_total + value > 7:
             raise BadInput(
                 'You may have at most 7 points of flaws and '
@@ -535,16 +1013,17 @@ class Session: # pylint: disable=R0904
                 )
             )
 
+    @journalled
     @support_undo
     def remove_merit(self, player_id, merit):
         """Remove a merit."""
         character = self.player_characters[player_id]
-        merit = self._get_correct_case_entry(merit, character.merits)
+        merit = character.merits.resolve(merit)
 
         try:
             value = character.merits.pop(merit)
             if character.character_creation:
-                character.experience['current'] += value
+                character.experience.current += value
                 return "Removed {} and refunded {} XP".format(merit, value)
             return "Removed {}".format(merit)
         except KeyError:
@@ -552,11 +1031,12 @@ class Session: # pylint: disable=R0904
                 'You did not have the merit {}'.format(merit)
             )
 
+    @journalled
     @support_undo
     def remove_flaw(self, player_id, flaw):
         """Remove or buy-off a flaw."""
         character = self.player_characters[player_id]
-        flaw = self._get_correct_case_entry(flaw, character.flaws)
+        flaw = character.flaws.resolve(flaw)
 
         if flaw not in character.flaws:
             raise BadInput("You did not have the flaw {}".format(flaw))
@@ -565,27 +1045,27 @@ class Session: # pylint: disable=R0904
         value = character.flaws[flaw]
         if character.character_creation:
             character.flaws.pop(flaw)
-            character.experience['current'] -= value
-            character.experience['total'] -= value
+            character.experience.current -= value
+            character.experience.total -= value
             return message + ' removing {} XP'.format(value)
         self._check_xp_available(player_id, value)
         character.flaws.pop(flaw)
         character.spend_xp(value, message)
         return message + " for {} XP".format(value)
 
+    @journalled
     @support_undo
     def remove_derangement(self, player_id, derangement):
         """Remove or buy-off a derangement."""
         character = self.player_characters[player_id]
-        derangement = self._get_correct_case_entry(
-            derangement, character.derangements)
+        derangement = character.derangements.resolve(derangement)
 
         if derangement not in character.derangements:
             raise BadInput("You did not have the derangement {}".format(
                 derangement))
 
         if (
-            character.clan.lower() == 'malkavian'
+            character.is_malkavian()
             and len(character.derangements) == 1
         ):
             raise BadInput("You cannot be any less deranged as a Malkavian.")
@@ -594,19 +1074,21 @@ class Session: # pylint: disable=R0904
         value = 2
         if character.character_creation:
             character.derangements.remove(derangement)
-            character.experience['current'] -= value
-            character.experience['total'] -= value
+            character.experience.current -= value
+            character.experience.total -= value
             return message + ' removing {} XP'.format(value)
         self._check_xp_available(player_id, value)
         character.derangements.remove(derangement)
         character.spend_xp(value, message)
         return message + ' for {} XP'.format(value)
 
+    @journalled
     @support_undo
     def spend_willpower(self, player_id, amount):
         """Spend some willpower."""
         return self._spend_resource('willpower', player_id, amount)
 
+    @journalled
     @support_undo
     def spend_blood(self, player_id, amount):
         """Spend some blood."""
@@ -620,33 +1102,36 @@ class Session: # pylint: disable=R0904
             'willpower': character.willpower,
         }[resource_type]
         amount = self._check_int(amount)
-        if resource['current'] < amount:
+        if resource.current < amount:
             raise BadInput(
                 'You cannot spend {} {}, you only have {}/{}'.format(
-                    amount, resource_type, resource['current'],
-                    resource['max'],
+                    amount, resource_type, resource.current,
+                    resource.max,
                 )
             )
-        resource['current'] -= amount
+        resource.current -= amount
         return "You spent {} {} and have {}/{} remaining.".format(
-            amount, resource_type, resource['current'], resource['max'],
+            amount, resource_type, resource.current, resource.max,
         )
 
+    @journalled
     @support_undo
     def gain_willpower(self, player_id, amount):
         """Gain some willpower."""
         return self._gain_resource('willpower', player_id, amount)
 
+    @journalled
     @support_undo
     def gain_blood(self, player_id, amount):
         """Gain some blood."""
         return self._gain_resource('blood', player_id, amount)
 
+    @journalled
     @support_undo
     def gain_morality(self, player_id):
         """Gain a point of morality."""
         character = self.player_characters[player_id]
-        if character.morality['current'] == character.morality['max']:
+        if character.morality.current == character.morality.max:
             raise BadInput('Your morality is at maximum already!')
         cost = 10
         message = 'Gain morality'
@@ -654,12 +1139,13 @@ class Session: # pylint: disable=R0904
         message = self._gain_resource('morality', player_id, 1)
         return message + " You spent 10 XP"
 
+    @journalled
     @support_undo
     def remove_morality(self, player_id):
         """Remove a point of morality."""
         character = self.player_characters[player_id]
-        character.morality['current'] -= 1
-        remaining = character.morality['current']
+        character.morality.current -= 1
+        remaining = character.morality.current
         message = "You lost 1 morality and now have {}.".format(remaining)
         if remaining == 0:
             message += " You have entered wassail, the final frenzy!"
@@ -679,12 +1165,12 @@ class Session: # pylint: disable=R0904
             'morality': character.morality,
         }[resource_type]
         amount = self._check_int(amount)
-        total = amount + resource['current']
-        remaining = max(total - resource['max'], 0)
+        total = amount + resource.current
+        remaining = max(total - resource.max, 0)
         gained = amount - remaining
-        resource['current'] += gained
+        resource.current += gained
         message = "You gain {} {} and now have {}/{}.".format(
-            gained, resource_type, resource['current'], resource['max'],
+            gained, resource_type, resource.current, resource.max,
         )
         if remaining:
             message += (
@@ -694,46 +1180,50 @@ class Session: # pylint: disable=R0904
             )
         return message
 
+    @journalled
     @support_undo
     def gain_beast_traits(self, player_id, amount):
         """Gain beast traits."""
         character = self.player_characters[player_id]
         amount = self._check_int(amount)
 
-        character.morality['beast traits'] += amount
+        character.morality.beast_traits += amount
         return (
             "You have gained {} beast traits. You now have {}.".format(
-                amount, character.morality['beast traits'],
+                amount, character.morality.beast_traits,
             )
         )
 
+    @journalled
     @support_undo
     def remove_beast_traits(self, player_id, amount):
         """Lose beast traits."""
         character = self.player_characters[player_id]
         amount = self._check_int(amount)
 
-        character.morality['beast traits'] = max(
-            character.morality['beast traits'] - amount,
+        character.morality.beast_traits = max(
+            character.morality.beast_traits - amount,
             0
         )
         return (
             "You have lost {} beast traits. You now have {}.".format(
-                amount, character.morality['beast traits'],
+                amount, character.morality.beast_traits,
             )
         )
 
+    @journalled
     @support_undo
     def inflict_damage(self, player_id, damage_type, amount):
         """Inflict damage on a character."""
         character = self.player_characters[player_id]
         amount = self._check_int(amount)
-        if damage_type not in ['aggravated', 'normal']:
+        if damage_type not in DAMAGE_TYPES:
             raise BadInput(
                 'Damage type must be normal or aggravated.'
             )
-        for _ in range(amount):
-            character.damage_taken.append(damage_type)
+        if amount < 0:
+            raise BadInput('You cannot inflict negative damage.')
+        character.inflict_damage(damage_type, amount)
         health_state = character.get_health_level()
         return (
             "You have taken {} {} damage, and are {}".format(
@@ -741,15 +1231,18 @@ class Session: # pylint: disable=R0904
             )
         )
 
+    @journalled
     @support_undo
     def heal_damage(self, player_id, damage_type):
         """Heal damage on a character."""
         character = self.player_characters[player_id]
-        if damage_type not in character.damage_taken:
+        if (
+                damage_type not in DAMAGE_TYPES
+                or not character.heal_damage(damage_type)
+        ):
             raise BadInput("You had no {} damage.".format(damage_type))
-        character.damage_taken.remove(damage_type)
-        normal = character.damage_taken.count('normal')
-        aggravated = character.damage_taken.count('aggravated')
+        normal = character.damage_taken.normal
+        aggravated = character.damage_taken.aggravated
         health_state = character.get_health_level()
         return (
             "You healed a point of {} damage. "
@@ -761,8 +1254,10 @@ class Session: # pylint: disable=R0904
 
     def get_health_level(self, player_id):
         """Return the current health level of the character."""
-        return self.player_characters[player_id].get_health_level()
+        with self.lock_for(player_id):
+            return self.player_characters[player_id].get_health_level()
 
+    @journalled
     @support_undo
     def finish_character_creation(self, player_id):
         """End character creation, begin the game proper!"""
@@ -770,6 +1265,7 @@ class Session: # pylint: disable=R0904
         character.character_creation = False
         return "Character creation complete."
 
+    @journalled
     @support_undo
     def reset(self, player_id):
         """Reset a character to a blank sheet."""
@@ -779,31 +1275,61 @@ class Session: # pylint: disable=R0904
 
     def undo(self, player_id):
         """Roll back the last change to a character."""
-        if player_id not in self.undo_points:
-            return "No recent action found to undo."""
-        self.player_characters[player_id] = self.undo_points.pop(player_id)
-        return "Rolled back last change."
-
+        with self.lock_for(player_id):
+            if not self.history_for(player_id).undo():
+                return "No recent action found to undo."""
+            self._update_holdings(player_id)
+            self._record_restore(player_id)
+            return "Rolled back last change."
+
+    def redo(self, player_id):
+        """Reapply the last change to a character that was rolled back."""
+        with self.lock_for(player_id):
+            if not self.history_for(player_id).redo():
+                return "No rolled back action found to redo."
+            self._update_holdings(player_id)
+            self._record_restore(player_id)
+            return "Reapplied last rolled back change."
+
+    def _record_restore(self, player_id):
+        """Journal the result of an undo or redo.
+        Undo history is not saved, so the resulting sheet is journalled
+        rather than the undo or redo itself."""
+        self.changed_players.add(player_id)
+        self._record('restore_character', (
+            player_id, self.player_characters[player_id].to_dict()), {})
+
+    @journalled
+    def restore_character(self, player_id, character_data):
+        """Replace a character's sheet with a previously saved one."""
+        character = Character()
+        character.from_dict(deepcopy(character_data))
+        self.player_characters[player_id] = character
+        self.histories.pop(player_id, None)
+        self._update_holdings(player_id)
+
+    @journalled
     def create_equipment(self, equipment_name, category):
         """Create an item of equipment in the pool."""
         if equipment_name in self.equipment:
             raise BadInput("{} already exists.".format(equipment_name))
-        self.equipment[equipment_name] = {
-            'category': category,
-            'qualities': [],
-        }
+        self.equipment.create(equipment_name, category)
+        self.equipment_changed = True
         return "{} created.".format(equipment_name)
 
+    @journalled
     def destroy_equipment(self, equipment_name):
         """Remove an item of equipment from the pool."""
         if equipment_name not in self.equipment:
             raise BadInput("{} does not exist.".format(equipment_name))
         removed_from = set()
-        for character in self.player_characters.values():
-            for _ in range(character.equipment.count(equipment_name)):
-                character.equipment.remove(equipment_name)
-                removed_from.add(character.character)
-        self.equipment.pop(equipment_name)
+        for player_id in self._holder_index().pop(equipment_name, {}):
+            character = self.player_characters[player_id]
+            character.equipment.pop(equipment_name)
+            removed_from.add(character.character)
+            self.changed_players.add(player_id)
+        self.equipment.destroy(equipment_name)
+        self.equipment_changed = True
         message = "{} destroyed.".format(equipment_name)
         if removed_from:
             removed_from = sorted(list(removed_from))
@@ -811,57 +1337,561 @@ class Session: # pylint: disable=R0904
                 ', '.join(removed_from))
         return message
 
+    @journalled
     def add_quality_to_equipment(self, equipment_name, quality):
         """Add a quality to a piece of equipment."""
         if equipment_name not in self.equipment:
             raise BadInput("{} does not exist.".format(equipment_name))
-        if quality in self.equipment[equipment_name]['qualities']:
+        if quality in self.equipment[equipment_name].qualities:
             raise BadInput("{} already has the property {}".format(
                 equipment_name, quality))
-        self.equipment[equipment_name]['qualities'].append(quality)
+        self.equipment.add_quality(equipment_name, quality)
+        self.equipment_changed = True
         return "Added {} to {}".format(quality, equipment_name)
 
+    @journalled
     def remove_quality_from_equipment(self, equipment_name, quality):
         """Remove a quality from a piece of equipment."""
         if equipment_name not in self.equipment:
             raise BadInput("{} does not exist.".format(equipment_name))
-        if quality not in self.equipment[equipment_name]['qualities']:
+        if quality not in self.equipment[equipment_name].qualities:
             raise BadInput("{} does not have the property {}".format(
                 equipment_name, quality))
-        self.equipment[equipment_name]['qualities'].remove(quality)
+        self.equipment.remove_quality(equipment_name, quality)
+        self.equipment_changed = True
         return "Removed {} from {}".format(quality, equipment_name)
 
-    def list_equipment(self):
-        """List items of equipment."""
-        output = 'Equipment available:\n'
-        for equipment, details in self.equipment.items():
-            output += '{name} [{category}]'.format(
-                name=equipment,
-                category=details['category'],
-            )
-            if details['qualities']:
-                output += ' ({})'.format(', '.join(details['qualities']))
-            output += '\n'
-        if not self.equipment:
+    def list_equipment(self, category=None, page=1, per_page=20):
+        """List one page of the items of equipment, optionally only those in
+        a category."""
+        page = self._check_int(page)
+        items, pages = self.equipment.page(page, per_page, category)
+        if not 1 <= page <= pages:
+            raise BadInput('There are only {} pages of equipment.'.format(
+                pages))
+        output = 'Equipment available'
+        if category:
+            output += ' in {}'.format(category)
+        if pages > 1:
+            output += ' (page {} of {})'.format(page, pages)
+        output += ':\n'
+        for item in items:
+            output += _format_item(item) + '\n'
+        if not items:
             output += 'None'
+            if category and self.equipment:
+                output += '. Categories: {}'.format(
+                    ', '.join(self.equipment.categories()))
         return output
 
+    def search_equipment(self, prefix, page=1, per_page=20):
+        """List one page of the items of equipment whose names start with a
+        prefix."""
+        page = self._check_int(page)
+        names, pages = _page_of(
+            self.equipment.search(prefix), page, per_page, 'matches')
+        if not names:
+            return "No equipment starts with {}.".format(prefix)
+        output = 'Equipment matching {}'.format(prefix)
+        if pages > 1:
+            output += ' (page {} of {})'.format(page, pages)
+        return output + ':\n' + ''.join(
+            _format_item(self.equipment[name]) + '\n' for name in names)
+
+    @journalled
     def take_equipment(self, player_id, equipment_name):
         """Take a piece of equipment for your character."""
         if equipment_name not in self.equipment:
             raise BadInput("{} does not exist.".format(equipment_name))
         character = self.player_characters[player_id]
-        character.equipment.append(equipment_name)
-        amount = character.equipment.count(equipment_name)
+        amount = character.equipment.add(equipment_name)
+        self._update_holdings(player_id, (equipment_name,))
         return "You now possess {} {}".format(amount, equipment_name)
 
+    @journalled
     def drop_equipment(self, player_id, equipment_name):
         """Drop a piece of equipment from your character."""
         character = self.player_characters[player_id]
         if equipment_name not in character.equipment:
             raise BadInput("You did not possess a {}".format(equipment_name))
-        character.equipment.remove(equipment_name)
-        amount = character.equipment.count(equipment_name)
+        amount = character.equipment.remove(equipment_name)
+        self._update_holdings(player_id, (equipment_name,))
         return "You have dropped 1 {}, and now have {}".format(
             equipment_name, amount,
         )
+
+    def list_holders(self, equipment_name, page=1, per_page=50):
+        """List one page of the characters holding an item of equipment."""
+        page = self._check_int(page)
+        if equipment_name not in self.equipment:
+            raise BadInput("{} does not exist.".format(equipment_name))
+        with self._holders_lock:
+            holders = dict(self._holder_index().get(equipment_name, {}))
+        holders, pages = _page_of(sorted(
+            '{} ({})'.format(
+                self.player_characters[player_id].character or 'unnamed',
+                count,
+            )
+            for player_id, count in holders.items()
+        ), page, per_page, 'holders')
+        if not holders:
+            return "Nobody holds {}.".format(equipment_name)
+        output = '{} is held by'.format(equipment_name)
+        if pages > 1:
+            output += ' (page {} of {})'.format(page, pages)
+        return output + ': ' + ', '.join(holders)
+
+
+def _test_journal_replay():
+    print('Checking journal replay...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        session = Session()
+        session.load(tmp)
+        session.add_player(1, 'Alice')
+        session.set_skill(1, 'Brawl', '2')
+        session.set_background(1, 'Generation', '2')
+        session.increase_skill(1, 'brawl')
+        session.add_note(1, 'Owes a boon')
+        session.add_note(1, 'Mistake')
+        session.undo(1)
+        session.reset(1)
+        session.set_name(1, 'Alucard')
+        session.create_equipment('Stake', 'weapon')
+        session.take_equipment(1, 'Stake')
+        try:
+            session.drop_equipment(1, 'Sword')
+        except BadInput:
+            pass
+        session.close()
+        expected = session.get_player_json(1)
+
+        replayed = Session()
+        replayed.load(tmp)
+        assert replayed.get_player_json(1) == expected
+        assert replayed.equipment == session.equipment
+        replayed.save(tmp)
+        assert os.path.getsize(os.path.join(tmp, JOURNAL_NAME)) == 0
+        replayed.close()
+
+        reloaded = Session()
+        reloaded.load(tmp)
+        assert reloaded.get_player_json(1) == expected
+        reloaded.close()
+    print(' OK.')
+
+
+def _test_undo_redo():
+    print('Checking undo and redo...', end='')
+    session = Session(undo_depth=3)
+    session.add_player(1, 'Alice')
+    session.set_name(1, 'Alucard')
+    session.set_skill(1, 'Brawl', '2')
+    session.add_note(1, 'First')
+    session.add_note(1, 'Second')
+    session.award_xp(5, 'attending')
+    assert session.undo(1) == "Rolled back last change."
+    assert session.player_characters[1].notes == ['First']
+    assert session.player_characters[1].experience.current == 35
+    session.undo(1)
+    session.undo(1)
+    assert session.undo(1) == "No recent action found to undo."
+    assert session.player_characters[1].skills == {}
+    assert session.player_characters[1].character == 'Alucard'
+    session.redo(1)
+    session.redo(1)
+    assert session.player_characters[1].notes == ['First']
+    assert session.player_characters[1].skills == {'Brawl': 2}
+
+    before_reset = session.player_characters[1]
+    session.reset(1)
+    assert session.player_characters[1].character == ''
+    session.undo(1)
+    assert session.player_characters[1] is before_reset
+    assert session.redo(1) == "Reapplied last rolled back change."
+    assert session.player_characters[1].character == ''
+    assert session.redo(1) == "No rolled back action found to redo."
+
+    session.set_background(1, 'Generation', '1')
+    before = session.get_player_json(1)
+    try:
+        session.set_background(1, 'Generation', '9')
+        assert False
+    except KeyError:
+        pass
+    assert session.get_player_json(1) == before
+    print(' OK.')
+
+
+def _test_replay_skips_saved_records():
+    print('Checking replay skips records already saved...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        session = Session()
+        session.load(tmp)
+        session.add_player(1, 'Alice')
+        session.set_background(1, 'Generation', '2')
+        session.increase_skill(1, 'Brawl')
+        # Simulate a crash between saving and truncating the journal
+        session.journal.truncate = lambda: None
+        session.save(tmp)
+        session.close()
+
+        replayed = Session()
+        replayed.load(tmp)
+        assert replayed.player_characters[1].skills == {'Brawl': 1}
+        replayed.close()
+    print(' OK.')
+
+
+def _test_legacy_save():
+    print('Checking single file saves are converted...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        character = Character()
+        character.character = 'Alucard'
+        with open(os.path.join(tmp, LEGACY_SAVE_NAME), 'w',
+                  encoding='utf-8') as save_handle:
+            json.dump({
+                'equipment': {'Stake': {'category': 'weapon',
+                                        'qualities': []}},
+                'player_characters': {'1': character.to_dict()},
+            }, save_handle)
+        session = Session()
+        session.load(tmp)
+        session.save(tmp)
+        session.close()
+
+        reloaded = Session()
+        reloaded.load(tmp)
+        assert reloaded.player_characters[1].character == 'Alucard'
+        assert 'Stake' in reloaded.equipment
+        reloaded.close()
+    print(' OK.')
+
+
+def _test_sqlite_session():
+    print('Checking sessions saved in SQLite...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        session = Session()
+        session.load(tmp, 'sqlite')
+        session.add_player(1, 'Alice')
+        session.add_note(1, 'Owes a boon')
+        session.create_equipment('Stake', 'weapon')
+        session.save(tmp)
+        session.set_name(1, 'Alucard')
+        session.close()
+        expected = session.get_player_json(1)
+
+        reloaded = Session()
+        reloaded.load(tmp, 'sqlite')
+        assert reloaded.get_player_json(1) == expected
+        assert 'Stake' in reloaded.equipment
+        reloaded.close()
+    print(' OK.')
+
+
+def _test_xp_log_compaction():
+    print('Checking XP logs are compacted and archived...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        session = Session(xp_log_limit=4)
+        session.load(tmp)
+        session.add_player(1, 'Alice')
+        for number in range(5):
+            session.award_xp(1, 'session {}'.format(number))
+        assert 'page 1 of 3' in session.get_xp_history(1, per_page=2)
+        session.save(tmp)
+        log = session.player_characters[1].experience.log
+        assert len(log) == 3
+        assert log[0].code == 'checkpoint'
+        assert 'session 4' in session.get_xp_history(1)
+        try:
+            session.get_xp_history(1, 2)
+            assert False
+        except BadInput:
+            pass
+        with open(os.path.join(tmp, 'xp-archive', '1.jsonl'),
+                  encoding='utf-8') as archive_handle:
+            archived = [json.loads(line) for line in archive_handle]
+        assert [entry['reason'] for entry in archived] == [
+            'session 0', 'session 1', 'session 2']
+        session.close()
+    print(' OK.')
+
+
+def _test_names_ignore_case():
+    print('Checking names are matched ignoring case...', end='')
+    session = Session()
+    session.add_player(1, 'Alice')
+    session.set_clan(1, 'Toreador')
+    session.set_skill(1, 'Brawl', '2')
+    session.set_skill(1, 'BRAWL', '3')
+    session.set_background(1, 'Generation', '2')
+    character = session.player_characters[1]
+    assert dict(character.skills) == {'Brawl': 3}
+    session.add_flaw(1, 'Bad Sight', '1')
+    try:
+        session.add_flaw(1, 'bad sight', '1')
+        assert False
+    except BadInput:
+        pass
+    session.finish_character_creation(1)
+    session.award_xp(10, 'testing')
+    session.increase_skill(1, 'brawl')
+    assert dict(character.skills) == {'Brawl': 4}
+    session.remove_flaw(1, 'BAD SIGHT')
+    assert not character.flaws
+    print(' OK.')
+
+
+def _test_equipment_holders():
+    print('Checking equipment holders are indexed...', end='')
+    session = Session()
+    for player_id, name in ((1, 'Alucard'), (2, 'Mina'), (3, 'Renfield')):
+        session.add_player(player_id, 'Player')
+        session.set_name(player_id, name)
+    session.create_equipment('Stake', 'weapon')
+    assert session.list_holders('Stake') == 'Nobody holds Stake.'
+    try:
+        session.list_holders('Stake', 2)
+        assert False
+    except BadInput:
+        pass
+    session.take_equipment(1, 'Stake')
+    assert session.list_holders('Stake') == 'Stake is held by: Alucard (1)'
+    session.take_equipment(1, 'Stake')
+    session.take_equipment(2, 'Stake')
+    session.drop_equipment(1, 'Stake')
+    assert session.list_holders('Stake') == (
+        'Stake is held by: Alucard (1), Mina (1)')
+
+    session.reset(2)
+    assert session.list_holders('Stake') == 'Stake is held by: Alucard (1)'
+    session.undo(2)
+    assert session.list_holders('Stake') == (
+        'Stake is held by: Alucard (1), Mina (1)')
+
+    session.changed_players = set()
+    assert session.destroy_equipment('Stake') == (
+        'Stake destroyed. Equipment removed from: Alucard, Mina')
+    assert session.changed_players == {1, 2}
+    assert not session.player_characters[1].equipment
+    print(' OK.')
+
+
+def _test_equipment_listing():
+    print('Checking equipment listing is paged...', end='')
+    session = Session()
+    for number in range(25):
+        session.create_equipment('Stake {:02}'.format(number), 'weapon')
+    session.create_equipment('Mirror', 'Tool')
+    session.add_quality_to_equipment('Mirror', 'silver')
+    listing = session.list_equipment()
+    assert listing.startswith('Equipment available (page 1 of 2):\nMirror')
+    assert 'Stake 18' in listing and 'Stake 19' not in listing
+    assert session.list_equipment('tool') == (
+        'Equipment available in tool:\nMirror [Tool] (silver)\n')
+    assert 'Categories: Tool, weapon' in session.list_equipment('bags')
+    try:
+        session.list_equipment(page=3)
+        assert False
+    except BadInput:
+        pass
+    assert session.search_equipment('stake 2').count('\n') == 6
+    matches = session.search_equipment('stake', per_page=10)
+    assert matches.startswith('Equipment matching stake (page 1 of 3):\n')
+    assert 'Stake 20' in session.search_equipment('stake', 3, 10)
+    try:
+        session.search_equipment('stake', 4, 10)
+        assert False
+    except BadInput:
+        pass
+    assert session.search_equipment('cross') == (
+        'No equipment starts with cross.')
+    try:
+        session.search_equipment('cross', 2)
+        assert False
+    except BadInput:
+        pass
+    print(' OK.')
+
+
+def _test_notes_listing():
+    print('Checking notes listing is paged...', end='')
+    session = Session()
+    session.add_player(1, 'Alice')
+    assert session.list_notes(1) == 'You have no notes.'
+    # Empty listings have just the one page
+    try:
+        session.list_notes(1, 2)
+        assert False
+    except BadInput:
+        pass
+    for number in range(1, 6):
+        session.add_note(1, 'Note {}'.format(number))
+    assert session.list_notes(1).startswith('Your notes:\n  1: Note 1')
+    assert session.list_notes(1, 2, 2) == (
+        'Your notes (page 2 of 3):\n  3: Note 3\n  4: Note 4')
+    try:
+        session.list_notes(1, 4, 2)
+        assert False
+    except BadInput:
+        pass
+    print(' OK.')
+
+
+def _test_flaw_points():
+    print('Checking flaw and derangement points...', end='')
+    PointsDict.check = True
+    try:
+        session = Session()
+        session.add_player(1, 'Alice')
+        session.set_clan(1, 'Malkavian')
+        session.add_derangement(1, 'Paranoia')
+        session.add_flaw(1, 'Bad Sight', '4')
+        session.add_derangement(1, 'Amnesia')
+        character = session.player_characters[1]
+        assert character.flaw_points() == 6
+        try:
+            session.add_derangement(1, 'Megalomania')
+            assert False
+        except BadInput:
+            pass
+        session.undo(1)
+        assert character.flaw_points() == 4
+        character.clan = 'Toreador'
+        assert character.flaw_points() == 6
+        session.remove_flaw(1, 'bad sight')
+        session.remove_derangement(1, 'Paranoia')
+        assert character.flaw_points() == 0
+    finally:
+        PointsDict.check = False
+    print(' OK.')
+
+
+def _test_batch():
+    print('Checking batch operations...', end='')
+    with tempfile.TemporaryDirectory() as save_path:
+        session = Session()
+        session.load(save_path)
+        session.add_player(1, 'Alice')
+        session.add_player(2, 'Bob')
+        session.create_equipment('Stake', 'weapon')
+        session.set_skill(1, 'Brawl', 2)
+        before = {
+            player_id: session.get_player_dict(player_id)
+            for player_id in (1, 2)
+        }
+        script = """
+            # Session rewards
+            award_xp 5 "the ball"
+            set_name <@1> Anne
+            take_equipment <@!2> Stake
+            increase_skill 1 brawl exceed_maximum=false
+        """
+        try:
+            session.batch(parse_batch(script))
+            assert False
+        except BadInput as err:
+            assert 'Operation 4' in str(err)
+        assert {
+            player_id: session.get_player_dict(player_id)
+            for player_id in (1, 2)
+        } == before
+        assert session.list_holders('Stake') == 'Nobody holds Stake.'
+        assert session.undo(1) == 'Rolled back last change.'
+
+        # Failing part way through leaves undo and redo history as it was
+        history = session.history_for(1)
+        stacks = (list(history.undo_stack), list(history.redo_stack))
+        try:
+            session.batch(parse_batch(
+                'set_name 1 Anne\nremove_player 1 Anne\nset_name 1 Annie'))
+            assert False
+        except BadInput as err:
+            assert 'Operation 3' in str(err)
+        assert (list(history.undo_stack), list(history.redo_stack)) == stacks
+        assert session.redo(1) == 'Reapplied last rolled back change.'
+
+        for bad_script in ('_record 1', 'list_notes 1', 'set_name 3 Carl',
+                           'set_name 1', 'award_xp "5',
+                           'restore_character 1 x'):
+            try:
+                session.batch(parse_batch(bad_script))
+                assert False
+            except BadInput:
+                pass
+
+        output = session.batch(parse_batch(
+            script.replace('increase_skill', '# increase_skill')))
+        assert output.startswith('Applied 3 operations:')
+        assert session.get_player_dict(1)['header']['character'] == 'Anne'
+        assert session.get_player_dict(2)['xp']['current'] == 35
+        # New players can be set up in the same batch
+        session.batch(parse_batch('add_player 3 Carl\nset_name 3 Renfield'))
+        assert session.get_player_dict(3)['header']['character'] == (
+            'Renfield')
+        session.close()
+
+        replayed = Session()
+        replayed.load(save_path)
+        assert replayed.get_player_dict(1) == session.get_player_dict(1)
+        assert replayed.get_player_dict(3) == session.get_player_dict(3)
+        assert replayed.list_holders('Stake') == session.list_holders('Stake')
+        replayed.close()
+        with open(os.path.join(save_path, JOURNAL_NAME)) as journal:
+            assert [
+                json.loads(line)['op'] for line in journal
+            ][-1] == 'batch'
+    print(' OK.')
+
+
+def _test_concurrent_players():
+    print('Checking players can be changed concurrently...', end='')
+    with tempfile.TemporaryDirectory() as save_path:
+        session = Session()
+        session.load(save_path)
+        for player_id in range(4):
+            session.add_player(player_id, 'Player {}'.format(player_id))
+
+        def add_notes(player_id):
+            for number in range(50):
+                session.add_note(player_id, 'Note {}'.format(number))
+
+        threads = [
+            threading.Thread(target=add_notes, args=(player_id,))
+            for player_id in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for _ in range(10):
+            session.award_xp(1, 'waiting')
+        for thread in threads:
+            thread.join()
+        for player_id in range(4):
+            sheet = session.get_player_dict(player_id)
+            assert sheet['notes'] == tuple(
+                'Note {}'.format(number) for number in range(50))
+            assert sheet['xp']['current'] == 40
+        session.close()
+
+        replayed = Session()
+        replayed.load(save_path)
+        for player_id in range(4):
+            assert replayed.get_player_dict(player_id) == (
+                session.get_player_dict(player_id))
+        replayed.close()
+    print(' OK.')
+
+
+if __name__ == '__main__':
+    _test_journal_replay()
+    _test_undo_redo()
+    _test_replay_skips_saved_records()
+    _test_legacy_save()
+    _test_sqlite_session()
+    _test_xp_log_compaction()
+    _test_names_ignore_case()
+    _test_equipment_holders()
+    _test_equipment_listing()
+    _test_notes_listing()
+    _test_flaw_points()
+    _test_batch()
+    _test_concurrent_players()
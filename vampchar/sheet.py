@@ -1,19 +1,444 @@
 #! /usr/bin/env python3
 # pylint: disable=R0902
 """Simple character sheet backend for VtM."""
+from contextlib import contextmanager
+from contextvars import ContextVar
 from copy import deepcopy
 from datetime import datetime
+from itertools import count
 import json
+import re
+from types import MappingProxyType
 
+from .tracking import (
+    NameDict, NameList, PointsDict, Tracked, TrackedDict, record, recording,
+    revert,
+)
+from .xpcosts import cost_listing, cost_table
 
-class Character:
+_REPLAY_TIME = ContextVar('replay_time', default=None)
+# Character versions are unique across all characters
+_VERSIONS = count(1)
+TIME_FORMAT = '%Y/%m/%d %H:%M'
+
+
+def now():
+    """Return the current time, or the recorded time while replaying."""
+    return _REPLAY_TIME.get() or datetime.now()
+
+
+@contextmanager
+def replaying_at(when):
+    """Make now() return a recorded time, e.g. when replaying a journal."""
+    token = _REPLAY_TIME.set(when)
+    try:
+        yield
+    finally:
+        _REPLAY_TIME.reset(token)
+
+
+def _freeze(value):
+    """Return a read-only copy of nested dicts and lists."""
+    if isinstance(value, dict):
+        return MappingProxyType({
+            key: _freeze(item) for key, item in value.items()
+        })
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class Record(Tracked):
+    """A small record with fixed fields, stored in slots.
+    Records compare equal to the dicts they convert to.
+    """
+    __slots__ = ()
+    # Dict keys for any fields whose names differ from their attribute
+    _keys = {}
+
+    def to_dict(self):
+        """Return the dict of this record."""
+        return {
+            self._keys.get(name, name): getattr(self, name)
+            for name in self.__slots__
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a record from a dict, using defaults for missing fields."""
+        record = cls()
+        for name in cls.__slots__:
+            key = cls._keys.get(name, name)
+            if key in data:
+                setattr(record, name, data[key])
+        return record
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__
+        ))
+
+
+class XPEntry(Record):
+    """One entry in an XP log, with the XP the character had after it."""
+    __slots__ = ('time', 'code', 'amount', 'reason', 'current', 'total')
+
+    def __init__(self, time='', code='gained',  # pylint: disable=R0913
+                 amount=0, reason='', current=None, total=None):
+        self.time = time
+        self.code = code
+        self.amount = amount
+        self.reason = reason
+        self.current = current
+        self.total = total
+
+    @classmethod
+    def from_legacy(cls, line):
+        """Create an entry from a line of an older, text only, XP log."""
+        match = _LEGACY_XP_ENTRY.match(line)
+        if not match:
+            return cls(code='legacy', reason=line)
+        amount = int(match.group('amount'))
+        if match.group('action') == 'Spent':
+            return cls(match.group('time'), 'spent', -amount,
+                       match.group('reason'))
+        return cls(match.group('time'), 'gained', amount,
+                   match.group('reason'))
+
+    def __str__(self):
+        if self.code == 'gained':
+            text = '{}- Gained {} ({})'.format(self.time, self.amount,
+                                               self.reason)
+        elif self.code == 'spent':
+            text = '{}- Spent {} ({})'.format(self.time, -self.amount,
+                                              self.reason)
+        elif self.code == 'checkpoint':
+            text = '{}- Net {:+} ({})'.format(self.time, self.amount,
+                                              self.reason)
+        else:
+            return self.reason
+        if self.current is not None:
+            text += ' [{} unspent, {} total]'.format(self.current,
+                                                     self.total)
+        return text
+
+
+_LEGACY_XP_ENTRY = re.compile(
+    r'^(?P<time>.*?)- (?P<action>Gained|Spent) (?P<amount>-?\d+) '
+    r'\((?P<reason>.*)\)$',
+    re.DOTALL,
+)
+
+
+class XPLog(Tracked):
+    """Log of XP gained and spent, oldest first.
+
+    Older entries can be compacted into a single checkpoint entry. Entries
+    are numbered from when the log was created, so that undoing a change
+    still finds its entry after older ones have been compacted.
+    The log records how to undo its own changes, so its attributes are
+    only set directly.
+    """
+    __slots__ = ('entries', 'start', 'checkpoint')
+
+    def __init__(self, entries=(), checkpoint=None):
+        object.__setattr__(self, 'entries', list(entries))
+        object.__setattr__(self, 'start', 0)
+        object.__setattr__(self, 'checkpoint', checkpoint)
+
+    def append(self, entry):
+        """Add an entry to the log."""
+        number = self.start + len(self.entries)
+        record(self._remove, number)
+        self.entries.append(entry)
+        self.touch()
+
+    def _remove(self, number):
+        """Remove a numbered entry, if it hasn't been compacted."""
+        index = number - self.start
+        if index >= 0:
+            entry = self.entries.pop(index)
+            record(self._insert, number, entry)
+            self.touch()
+
+    def _insert(self, number, entry):
+        """Put back a numbered entry, if it wouldn't have been compacted."""
+        index = number - self.start
+        if index >= 0:
+            self.entries.insert(index, entry)
+            record(self._remove, number)
+            self.touch()
+
+    def compact(self, keep):
+        """Replace all but the latest `keep` entries with a checkpoint.
+        Returns the entries removed, oldest first, which may include an
+        earlier checkpoint.
+        """
+        count = len(self.entries) - keep
+        if count <= 0:
+            return []
+        removed = self.entries[:count]
+        if self.checkpoint is not None:
+            removed.insert(0, self.checkpoint)
+        latest = removed[-1]
+        checkpoint = XPEntry(
+            latest.time, 'checkpoint',
+            sum(entry.amount for entry in removed),
+            'earlier entries', latest.current, latest.total,
+        )
+        del self.entries[:count]
+        object.__setattr__(self, 'start', self.start + count)
+        object.__setattr__(self, 'checkpoint', checkpoint)
+        self.touch()
+        return removed
+
+    def page(self, page, per_page):
+        """Return one page of entries, newest first, counting from page 1.
+        The checkpoint, if any, is the last entry of the last page."""
+        entries = self.entries
+        if self.checkpoint is not None:
+            entries = [self.checkpoint] + entries
+        end = len(entries) - (page - 1) * per_page
+        return entries[max(end - per_page, 0):max(end, 0)][::-1]
+
+    def page_count(self, per_page):
+        """Return how many pages of entries there are."""
+        return max(-(-len(self) // per_page), 1)
+
+    def __len__(self):
+        return len(self.entries) + (self.checkpoint is not None)
+
+    def __iter__(self):
+        if self.checkpoint is not None:
+            yield self.checkpoint
+        yield from self.entries
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def to_list(self):
+        """Return the list of entries, each as a dict."""
+        return [entry.to_dict() for entry in self]
+
+    @classmethod
+    def from_list(cls, entries):
+        """Create a log from a list of entries, as dicts or older text."""
+        log = [
+            XPEntry.from_legacy(entry) if isinstance(entry, str)
+            else XPEntry.from_dict(entry)
+            for entry in entries
+        ]
+        if log and log[0].code == 'checkpoint':
+            return cls(log[1:], log[0])
+        return cls(log)
+
+    def __eq__(self, other):
+        if isinstance(other, XPLog):
+            other = other.to_list()
+        return self.to_list() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'XPLog({!r})'.format(self.to_list())
+
+
+class Experience(Record):
+    """Experience points and how they were gained and spent."""
+    __slots__ = ('current', 'total', 'log')
+
+    def __init__(self, current=30, total=30, log=()):
+        self.current = current
+        self.total = total
+        self.log = XPLog.from_list(log)
+
+    def to_dict(self):
+        """Return the dict of this record."""
+        return {
+            'current': self.current,
+            'total': self.total,
+            'log': self.log.to_list(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a record from a dict, using defaults for missing fields."""
+        return cls(data.get('current', 30), data.get('total', 30),
+                   data.get('log', ()))
+
+    def add(self, code, amount, reason):
+        """Log a change in XP, which has already been made."""
+        self.log.append(XPEntry(
+            now().strftime(TIME_FORMAT), code, amount, reason,
+            self.current, self.total,
+        ))
+
+
+class Attribute(Record):
+    """An attribute rating and its focuses."""
+    __slots__ = ('value', 'focuses')
+
+    def __init__(self, value=0, focuses=()):
+        self.value = value
+        self.focuses = list(focuses)
+
+
+class Blood(Record):
+    """Blood pool and how much of it can be spent per round."""
+    __slots__ = ('max', 'current', 'rate')
+
+    def __init__(self, max=0, current=0, rate=0):  # pylint: disable=W0622
+        self.max = max
+        self.current = current
+        self.rate = rate
+
+
+class Willpower(Record):
+    """Willpower pool."""
+    __slots__ = ('max', 'current')
+
+    def __init__(self, max=6, current=6):  # pylint: disable=W0622
+        self.max = max
+        self.current = current
+
+
+class Morality(Record):
+    """Morality rating and beast traits."""
+    __slots__ = ('max', 'current', 'beast_traits')
+    _keys = {'beast_traits': 'beast traits'}
+
+    def __init__(self, max=5, current=5,  # pylint: disable=W0622
+                 beast_traits=0):
+        self.max = max
+        self.current = current
+        self.beast_traits = beast_traits
+
+
+class HealthLevels(Record):
+    """How many wound levels a character has in each health state."""
+    __slots__ = ('healthy', 'injured', 'incapacitated')
+
+    def __init__(self, healthy=3, injured=3,
+                 incapacitated=3):
+        self.healthy = healthy
+        self.injured = injured
+        self.incapacitated = incapacitated
+
+
+class Damage(Record):
+    """Damage taken, counted by type.
+    It is saved as a list of damage types, aggravated damage first, and
+    compares equal to any list with the same amount of each type.
+    """
+    __slots__ = ('normal', 'aggravated')
+
+    def __init__(self, normal=0, aggravated=0):
+        self.normal = normal
+        self.aggravated = aggravated
+
+    @property
+    def total(self):
+        """Total damage of both types."""
+        return self.normal + self.aggravated
+
+    def to_list(self):
+        """Return the list of damage taken."""
+        return ['aggravated'] * self.aggravated + ['normal'] * self.normal
+
+    @classmethod
+    def from_list(cls, damage):
+        """Create a record of damage from a list of damage types."""
+        return cls(damage.count('normal'), damage.count('aggravated'))
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple)):
+            other = Damage.from_list(other)
+        return super().__eq__(other)
+
+    __hash__ = None
+
+
+class Inventory(TrackedDict):
+    """Items of equipment held, with how many of each.
+    It is saved as a list with an entry for each item held, and compares
+    equal to any list holding the same items.
+    """
+    __slots__ = ()
+
+    def count(self, item):
+        """Return how many of an item are held."""
+        return self.get(item, 0)
+
+    def add(self, item, amount=1):
+        """Add some of an item. Returns how many are now held."""
+        self[item] = self.get(item, 0) + amount
+        return self[item]
+
+    def remove(self, item, amount=1):
+        """Remove some of an item, which must be held.
+        Returns how many are now held."""
+        remaining = self[item] - amount
+        if remaining > 0:
+            self[item] = remaining
+        else:
+            del self[item]
+        return max(remaining, 0)
+
+    def to_list(self):
+        """Return the list of items held."""
+        return [item for item, count in self.items() for _ in range(count)]
+
+    @classmethod
+    def from_list(cls, items):
+        """Create an inventory from a list of items."""
+        inventory = cls()
+        for item in items:
+            dict.__setitem__(inventory, item, inventory.get(item, 0) + 1)
+        return inventory
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple)):
+            other = Inventory.from_list(other)
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+
+ATTRIBUTES = ('physical', 'social', 'mental')
+HEALTH_LEVELS = ('healthy', 'injured', 'incapacitated')
+DAMAGE_TYPES = ('normal', 'aggravated')
+
+
+class Character(Tracked):
     """Simple CtM character sheet."""
+    __slots__ = (
+        'experience', 'player', 'character', 'archetype', 'clan', 'sect',
+        'title', 'attributes', 'skills', 'backgrounds', 'disciplines',
+        'merits', 'flaws', 'derangements', 'blood', 'willpower', 'morality',
+        'health_levels', 'damage_taken', 'notes', 'status', 'equipment',
+        'character_creation', 'version', '_view', '_json',
+    )
+
     def __init__(self):
-        self.experience = {
-            'current': 30,
-            'total': 30,
-            'log': [],
-        }
+        # The version changes whenever anything on the sheet changes, and is
+        # never shared with another character, so it identifies the sheet's
+        # contents. Cached views are stored with the version they were made
+        # from.
+        object.__setattr__(self, 'version', next(_VERSIONS))
+        object.__setattr__(self, '_view', (None, None))
+        object.__setattr__(self, '_json', (None, None))
+        self.experience = Experience()
         self.player = ''
         self.character = ''
         self.archetype = ''
@@ -21,131 +446,125 @@ class Character:
         self.sect = ''
         self.title = ''
         self.attributes = {
-            'physical': {
-                'value': 0,
-                'focuses': [],
-            },
-            'social': {
-                'value': 0,
-                'focuses': [],
-            },
-            'mental': {
-                'value': 0,
-                'focuses': [],
-            },
-        }
-        self.skills = {}
-        self.backgrounds = {}
-        self.disciplines = {}
-        self.merits = {}
-        self.flaws = {}
-        self.derangements = []
-        self.blood = {
-            'max': 0,
-            'current': 0,
-            'rate': 0,
-        }
-        self.willpower = {
-            'max': 6,
-            'current': 6,
+            attribute: Attribute() for attribute in ATTRIBUTES
         }
-        self.morality = {
-            'max': 5,
-            'current': 5,
-            'beast traits': 0,
-        }
-        self.health_levels = {
-            'healthy': 3,
-            'injured': 3,
-            'incapacitated': 3,
-        }
-        self.damage_taken = []
+        # Named entries are indexed so they can be found ignoring case
+        self.skills = NameDict()
+        self.backgrounds = NameDict()
+        self.disciplines = NameDict()
+        self.merits = PointsDict()
+        self.flaws = PointsDict()
+        self.derangements = NameList()
+        self.blood = Blood()
+        self.willpower = Willpower()
+        self.morality = Morality()
+        self.health_levels = HealthLevels()
+        self.damage_taken = Damage()
         self.notes = []
         self.status = []
-        self.equipment = []
+        self.equipment = Inventory()
         self.character_creation = True
 
     def award_xp(self, amount, reason):
         """Award XP to this character."""
-        self.experience['current'] += amount
-        self.experience['total'] += amount
-        self.experience['log'].append('{}- Gained {} ({})'.format(
-            datetime.now().strftime('%Y/%m/%d %H:%M'),
-            amount,
-            reason,
-        ))
+        self.experience.current += amount
+        self.experience.total += amount
+        self.experience.add('gained', amount, reason)
 
     def spend_xp(self, amount, reason):
         """Indicate XP has been spent on this character, and what for."""
-        self.experience['current'] -= amount
-        self.experience['log'].append('{}- Spent {} ({})'.format(
-            datetime.now().strftime('%Y/%m/%d %H:%M'),
-            amount,
-            reason,
-        ))
+        self.experience.current -= amount
+        self.experience.add('spent', -amount, reason)
+
+    def is_malkavian(self):
+        """Check whether the character is a Malkavian."""
+        return self.clan.casefold() == 'malkavian'
+
+    def flaw_points(self):
+        """Return the points of flaws and derangements the character has.
+        Derangements are worth 2 points, except a Malkavian's first."""
+        derangements = len(self.derangements)
+        if self.is_malkavian():
+            derangements = max(0, derangements - 1)
+        return self.flaws.total() + 2 * derangements
+
+    def inflict_damage(self, damage_type, amount=1):
+        """Inflict some damage of one type."""
+        setattr(self.damage_taken, damage_type,
+                getattr(self.damage_taken, damage_type) + amount)
+
+    def heal_damage(self, damage_type, amount=1):
+        """Heal some damage of one type. Returns how much was healed."""
+        amount = min(amount, getattr(self.damage_taken, damage_type))
+        setattr(self.damage_taken, damage_type,
+                getattr(self.damage_taken, damage_type) - amount)
+        return amount
 
     def get_health_level(self):
         """Return the character's current health level."""
-        health = []
-        for level in [
-                'healthy', 'injured', 'incapacitated'
-        ]:
-            health.extend([level for i in range(self.health_levels[level])])
-        if len(self.damage_taken) <= len(health):
-            pos = max(len(self.damage_taken) - 1, 0)
-            return health[pos]
+        # Even an undamaged character is in their first level.
+        remaining = max(self.damage_taken.total, 1)
+        for level in HEALTH_LEVELS:
+            remaining -= getattr(self.health_levels, level)
+            if remaining <= 0:
+                return level
         return 'torpid'
 
-    def get_xp_costs(self):
-        """Return a dict of XP costs for this character."""
+    def is_torpid(self):
+        """Check whether the character has taken more damage than they have
+        health levels."""
+        return self.excess_damage() > 0
+
+    def excess_damage(self):
+        """Return how much more damage the character has taken than they
+        have health levels."""
+        levels = sum(getattr(self.health_levels, level)
+                     for level in HEALTH_LEVELS)
+        return max(self.damage_taken.total - levels, 0)
+
+    def get_generation(self):
+        """Return this character's generation, defaulting to 1."""
         if all(gen in self.backgrounds for gen in
                ('generation', 'Generation')):
             raise RuntimeError('Generation set multiple times.')
-        generation = (
+        return (
             self.backgrounds.get('generation')
             or self.backgrounds.get('Generation', 1)
         )
 
-        xp_costs = {
-            'Attribute': 3,
-            'In-clan discipline': 'new level x 3',
-            'Regain lost humanity': 10,
-            'Merit': 'rating',
-            'Ritual': 'rating x 2',
-            'Background': 'new level x 2',
-            'Skill': 'new level x 2',
-            'Out-of-clan discipline': 'new level x 4',
-            'Technique': 12,
-            'In-clan elder power': 'Not allowed',
-            'Out-of-clan elder power': 'Not allowed',
-        }
+    def get_xp_costs(self):
+        """Return a read-only dict of XP costs for this character, for
+        display."""
+        return cost_listing(self.get_generation())
 
-        if generation == 1:
-            xp_costs['Background'] = 'new level x 1'
-            xp_costs['Skill'] = 'new level x 1'
-        elif generation == 3:
-            xp_costs['Technique'] = 20
-            xp_costs['In-clan elder power'] = (
-                '(max one in/out-of-clan elder power) 18'
-            )
-            xp_costs['Out-of-clan elder power'] = (
-                '(max one in/out-of-clan elder power) 24'
-            )
-        elif generation == 4:
-            xp_costs['Technique'] = 'Not allowed'
-            xp_costs['In-clan elder power'] = 18
-            xp_costs['Out-of-clan elder power'] = 24
-        elif generation == 5:
-            xp_costs['Technique'] = 'Not allowed'
-            xp_costs['In-clan elder power'] = 18
-            xp_costs['Out-of-clan elder power'] = 30
-            xp_costs['Out-of-clan discipline'] = 'new level x 5'
-
-        return xp_costs
+    def cost_of(self, thing_type, current_level):
+        """Return the XP cost of raising something (e.g. 'Skill') from its
+        current level, or of buying something (e.g. 'Merit') of the given
+        rating."""
+        return cost_table(self.get_generation())[thing_type].cost(
+            current_level)
+
+    def touch(self):
+        """Note that something on this character has changed."""
+        object.__setattr__(self, 'version', next(_VERSIONS))
 
     def to_json(self):
-        """Return a json dump of the character."""
-        return json.dumps(self.to_dict(), sort_keys=True)
+        """Return a json dump of the character.
+        This is cached until the character changes."""
+        version, dump = self._json
+        if version != self.version:
+            dump = json.dumps(self.to_dict(), sort_keys=True)
+            object.__setattr__(self, '_json', (self.version, dump))
+        return dump
+
+    def view(self):
+        """Return a read-only version of the dict of this character, with
+        lists as tuples. This is cached until the character changes."""
+        version, view = self._view
+        if version != self.version:
+            view = _freeze(self.to_dict())
+            object.__setattr__(self, '_view', (self.version, view))
+        return view
 
     def to_dict(self):
         """Return the dict of this character."""
@@ -158,8 +577,11 @@ class Character:
                 'sect': self.sect,
                 'title': self.title,
             },
-            'xp': self.experience,
-            'attributes': self.attributes,
+            'xp': self.experience.to_dict(),
+            'attributes': {
+                name: attribute.to_dict()
+                for name, attribute in self.attributes.items()
+            },
             'skills': self.skills,
             'backgrounds': self.backgrounds,
             'disciplines': self.disciplines,
@@ -169,16 +591,16 @@ class Character:
                 'derangements': self.derangements,
             },
             'state': {
-                'blood': self.blood,
-                'willpower': self.willpower,
-                'morality': self.morality,
+                'blood': self.blood.to_dict(),
+                'willpower': self.willpower.to_dict(),
+                'morality': self.morality.to_dict(),
                 'health': {
-                    'levels': self.health_levels,
-                    'damage': self.damage_taken,
+                    'levels': self.health_levels.to_dict(),
+                    'damage': self.damage_taken.to_list(),
                 },
                 'status': self.status,
             },
-            'equipment': self.equipment,
+            'equipment': self.equipment.to_list(),
             'notes': self.notes,
             'character_creation': self.character_creation,
         }
@@ -198,23 +620,26 @@ class Character:
         self.title = header['title']
 
         merits_and_flaws = data['merits_and_flaws']
-        self.merits = merits_and_flaws['merits']
-        self.flaws = merits_and_flaws['flaws']
-        self.derangements = merits_and_flaws['derangements']
+        self.merits = PointsDict(merits_and_flaws['merits'])
+        self.flaws = PointsDict(merits_and_flaws['flaws'])
+        self.derangements = NameList(merits_and_flaws['derangements'])
 
         state = data['state']
-        self.blood = state['blood']
-        self.willpower = state['willpower']
-        self.morality = state['morality']
-        self.health_levels = state['health']['levels']
-        self.damage_taken = state['health']['damage']
-
-        self.experience = data['xp']
-        self.attributes = data['attributes']
-        self.skills = data['skills']
-        self.backgrounds = data['backgrounds']
-        self.disciplines = data['disciplines']
-        self.equipment = data['equipment']
+        self.blood = Blood.from_dict(state['blood'])
+        self.willpower = Willpower.from_dict(state['willpower'])
+        self.morality = Morality.from_dict(state['morality'])
+        self.health_levels = HealthLevels.from_dict(state['health']['levels'])
+        self.damage_taken = Damage.from_list(state['health']['damage'])
+
+        self.experience = Experience.from_dict(data['xp'])
+        self.attributes = {
+            name: Attribute.from_dict(attribute)
+            for name, attribute in data['attributes'].items()
+        }
+        self.skills = NameDict(data['skills'])
+        self.backgrounds = NameDict(data['backgrounds'])
+        self.disciplines = NameDict(data['disciplines'])
+        self.equipment = Inventory.from_list(data['equipment'])
         self.notes = data['notes']
 
         self.character_creation = data['character_creation']
@@ -355,18 +780,24 @@ def _test_get_health_level():
     print('Checking health levels...', end='')
     char = Character()
     assert char.get_health_level() == 'healthy'
-    char.damage_taken = ['normal', 'normal', 'aggravated']
+    char.damage_taken = Damage.from_list(['normal', 'normal', 'aggravated'])
     assert char.get_health_level() == 'healthy'
-    char.damage_taken.append('aggravated')
+    char.inflict_damage('aggravated')
     assert char.get_health_level() == 'injured'
-    char.damage_taken.extend(['normal', 'normal'])
+    char.inflict_damage('normal', 2)
     assert char.get_health_level() == 'injured'
-    char.damage_taken.append('normal')
+    char.inflict_damage('normal')
     assert char.get_health_level() == 'incapacitated'
-    char.damage_taken.extend(['normal', 'aggravated'])
+    char.inflict_damage('normal')
+    char.inflict_damage('aggravated')
     assert char.get_health_level() == 'incapacitated'
-    char.damage_taken.append('normal')
+    assert not char.is_torpid()
+    char.inflict_damage('normal')
     assert char.get_health_level() == 'torpid'
+    assert char.excess_damage() == 1
+    assert char.heal_damage('aggravated', 5) == 3
+    assert char.get_health_level() == 'incapacitated'
+    assert char.to_dict()['state']['health']['damage'] == ['normal'] * 7
     print(' OK.')
 
 
@@ -416,6 +847,9 @@ def _test_xp_costs():
     exp['Out-of-clan discipline'] = 'new level x 5'
     assert char.get_xp_costs() == exp
 
+    assert char.cost_of('Out-of-clan discipline', 2) == 15
+    assert char.cost_of('Merit', 3) == 3
+
     char.backgrounds['generation'] = 4
     try:
         char.get_xp_costs()
@@ -429,18 +863,110 @@ def _test_xp():
     print('Checking award XP...', end='')
     char = Character()
     char.award_xp(4, 'for testing')
-    assert char.experience['current'] == 34
-    assert char.experience['total'] == 34
-    assert len(char.experience['log']) == 1
-    message = char.experience['log'][0].split('-', 1)[1]
-    assert message == ' Gained 4 (for testing)'
+    assert char.experience.current == 34
+    assert char.experience.total == 34
+    assert len(char.experience.log) == 1
+    message = str(char.experience.log[0]).split('-', 1)[1]
+    assert message == ' Gained 4 (for testing) [34 unspent, 34 total]'
 
     char.spend_xp(3, 'increase mental attribute')
-    assert char.experience['current'] == 31
-    assert char.experience['total'] == 34
-    assert len(char.experience['log']) == 2
-    message = char.experience['log'][1].split('-', 1)[1]
-    assert message == ' Spent 3 (increase mental attribute)'
+    assert char.experience.current == 31
+    assert char.experience.total == 34
+    assert len(char.experience.log) == 2
+    message = str(char.experience.log[1]).split('-', 1)[1]
+    assert message == (
+        ' Spent 3 (increase mental attribute) [31 unspent, 34 total]')
+    print(' OK.')
+
+
+def _test_xp_log():
+    print('Checking XP log compaction and paging...', end='')
+    char = Character()
+    char.from_dict(json.loads(json.dumps(char.to_dict())))
+    char.experience.log = XPLog.from_list([
+        '2020/01/01 20:00- Gained 5 (attending)',
+        '2020/01/02 20:00- Spent 2 (increase skill Brawl to 1)',
+    ])
+    assert char.experience.log[1].amount == -2
+    for session in range(5):
+        char.award_xp(1, 'session {}'.format(session))
+    with recording() as changes:
+        char.spend_xp(2, 'increase skill Brawl to 2')
+    assert len(char.experience.log) == 8
+
+    removed = char.experience.log.compact(3)
+    assert len(removed) == 5
+    assert len(char.experience.log) == 4
+    checkpoint = char.experience.log[0]
+    assert checkpoint.code == 'checkpoint'
+    assert checkpoint.amount == 5 - 2 + 3
+    assert checkpoint.current == 33
+
+    revert(changes)
+    assert [entry.reason for entry in char.experience.log.page(1, 2)] == [
+        'session 4', 'session 3']
+    assert char.experience.log.page(2, 2) == [checkpoint]
+    assert char.experience.log.page_count(2) == 2
+
+    loaded = Character()
+    loaded.from_dict(json.loads(char.to_json()))
+    assert loaded.experience.log == char.experience.log
+    assert loaded.experience.log.compact(1)[0] == checkpoint
+    print(' OK.')
+
+
+def _test_inventory():
+    print('Checking inventory counts...', end='')
+    char = Character()
+    assert char.equipment.add('Stake') == 1
+    assert char.equipment.add('Stake') == 2
+    char.equipment.add('Mirror')
+    assert char.equipment.remove('Stake') == 1
+    assert char.equipment == ['Mirror', 'Stake']
+    assert char.to_dict()['equipment'] == ['Stake', 'Mirror']
+    assert char.equipment.remove('Mirror') == 0
+    assert 'Mirror' not in char.equipment
+    print(' OK.')
+
+
+def _test_records():
+    print('Checking sheet records...', end='')
+    morality = Morality.from_dict({'max': 5, 'current': 4})
+    assert morality.beast_traits == 0
+    assert morality == {'max': 5, 'current': 4, 'beast traits': 0}
+    morality.beast_traits = 2
+    assert Morality.from_dict(morality.to_dict()) == morality
+    char = Character()
+    try:
+        char.hunger = 3  # pylint: disable=E0237
+    except AttributeError:
+        pass
+    else:
+        raise AssertionError('Characters should not take new attributes.')
+    print(' OK.')
+
+
+def _test_cached_views():
+    print('Checking cached character views...', end='')
+    char = Character()
+    view = char.view()
+    dump = char.to_json()
+    assert char.view() is view
+    assert char.to_json() is dump
+    try:
+        view['skills']['brawl'] = 5
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('Views should be read only.')
+    assert not char.skills
+
+    char.attributes['mental'].focuses.append('perception')
+    assert char.view() is not view
+    assert char.view()['attributes']['mental']['focuses'] == ('perception',)
+    assert Character().version not in (char.version, Character().version)
+    assert json.loads(char.to_json()) == json.loads(
+        json.dumps(char.to_dict()))
     print(' OK.')
 
 
@@ -451,3 +977,7 @@ if __name__ == '__main__':
     _test_get_health_level()
     _test_xp_costs()
     _test_xp()
+    _test_xp_log()
+    _test_records()
+    _test_inventory()
+    _test_cached_views()
@@ -0,0 +1,150 @@
+"""Background saving of sessions."""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+
+def write_atomically(path, data):
+    """Write a file such that readers see either the old or new contents.
+    The data is written to a temporary file in the same directory, synced,
+    then renamed over the target.
+    """
+    directory = os.path.dirname(path) or '.'
+    handle, temp_path = tempfile.mkstemp(
+        dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'w', encoding='utf-8') as temp_handle:
+            temp_handle.write(data)
+            temp_handle.flush()
+            os.fsync(temp_handle.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class SnapshotService:
+    """Save a session in an executor thread when it has changed.
+    Saves are coalesced so that at most one happens every `interval`
+    seconds, however many changes were made in that time.
+    """
+    def __init__(self, session, save_path, interval=30):
+        self.session = session
+        self.save_path = save_path
+        self.interval = interval
+        self.last_snapshot = None
+        self.last_duration = None
+        self.snapshot_count = 0
+        self.failure_count = 0
+        self.last_error = None
+        self._task = None
+
+    def start(self):
+        """Start saving periodically on the running event loop."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stop saving periodically, saving any outstanding changes."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.snapshot()
+
+    async def _run(self):
+        """Save changes every interval, carrying on if a save fails."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.snapshot()
+            except Exception as err:  # pylint: disable=W0703
+                sys.stderr.write('Could not save to {}: {!r}\n'.format(
+                    self.save_path, err))
+                self.failure_count += 1
+                self.last_error = repr(err)
+
+    async def snapshot(self):
+        """Save the session if it has changed since it was last saved."""
+        if not self.session.dirty:
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.session.sync_journal)
+            return False
+        start = time.monotonic()
+        await asyncio.get_event_loop().run_in_executor(
+            None, self.session.save, self.save_path)
+        self.last_duration = time.monotonic() - start
+        self.last_snapshot = time.time()
+        self.snapshot_count += 1
+        return True
+
+    def metrics(self):
+        """Return details of recent saves."""
+        age = None
+        if self.last_snapshot is not None:
+            age = time.time() - self.last_snapshot
+        return {
+            'last_snapshot_age': age,
+            'last_snapshot_duration': self.last_duration,
+            'snapshot_count': self.snapshot_count,
+            'failure_count': self.failure_count,
+            'last_error': self.last_error,
+            'dirty': self.session.dirty,
+        }
+
+
+def _test_write_atomically():
+    print('Checking atomic writes...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'session.save')
+        write_atomically(path, 'old\n')
+        write_atomically(path, 'new\n')
+        with open(path, encoding='utf-8') as handle:
+            assert handle.read() == 'new\n'
+        assert os.listdir(tmp) == ['session.save']
+    print(' OK.')
+
+
+def _test_failed_snapshots():
+    print('Checking failed saves are retried...', end='')
+
+    class FailingSession:
+        """A session whose first save fails."""
+        dirty = True
+        saves = 0
+
+        def save(self, _path):
+            """Fail the first time."""
+            self.saves += 1
+            if self.saves == 1:
+                raise OSError('Disk full')
+            self.dirty = False
+
+        def sync_journal(self):
+            """Nothing to sync."""
+
+    async def run():
+        service = SnapshotService(FailingSession(), 'nowhere', 0.01)
+        service.start()
+        await asyncio.sleep(0.1)
+        await service.stop()
+        return service
+
+    stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+    try:
+        service = asyncio.run(run())
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+    assert service.session.saves == 2
+    metrics = service.metrics()
+    assert metrics['failure_count'] == 1
+    assert 'Disk full' in metrics['last_error']
+    assert metrics['snapshot_count'] == 1
+    print(' OK.')
+
+
+if __name__ == '__main__':
+    _test_write_atomically()
+    _test_failed_snapshots()
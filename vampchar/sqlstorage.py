@@ -0,0 +1,354 @@
+"""SQLite storage for vampire sessions."""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+from .sheet import Character
+from .storage import LazyCharacters, ShardedStorage, Storage
+
+DATABASE_NAME = 'session.sqlite3'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS characters (
+    player_id INTEGER PRIMARY KEY,
+    sheet TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS equipment (
+    name TEXT PRIMARY KEY,
+    category TEXT NOT NULL,
+    qualities TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS equipment_by_category ON equipment (category);
+CREATE TABLE IF NOT EXISTS xp_log (
+    player_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (player_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS notes (
+    player_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (player_id, position)
+) WITHOUT ROWID;
+'''
+
+# Lists kept in their own tables, by table name, column, where they are
+# found in a character's dict, and whether entries are stored as JSON.
+_LIST_TABLES = (
+    ('xp_log', 'entry', ('xp', 'log'), True),
+    ('notes', 'content', ('notes',), False),
+)
+
+
+def _get_path(data, path):
+    """Get a value from nested dicts by a tuple of keys."""
+    for key in path:
+        data = data[key]
+    return data
+
+
+def _decode(entry):
+    """Decode a list entry stored as JSON, leaving older plain text ones."""
+    try:
+        return json.loads(entry)
+    except ValueError:
+        return entry
+
+
+class SQLiteStorage(Storage):
+    """Session storage in an SQLite database.
+
+    Characters are stored one row each, with their XP logs and notes one row
+    per entry, so saving a change only rewrites the rows that changed.
+    The database uses write-ahead logging, so characters can be loaded on
+    the event loop while a save runs in another thread.
+    """
+    def __init__(self, save_path):
+        super().__init__(save_path)
+        self.database_path = os.path.join(save_path, DATABASE_NAME)
+        self._local = threading.local()
+        # Every thread's open connection, so all can be closed
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._saved_lists = {}
+        self._saved_equipment = {}
+        with self._connection() as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connection(self):
+        """Get this thread's connection to the database."""
+        local = self._local
+        connection = getattr(local, 'connection', None)
+        if connection is None:
+            # Only used by this thread, but closed by whichever calls close
+            connection = sqlite3.connect(self.database_path,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        """Close every thread's connection to the database."""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+            # Threads that connect again get new connections
+            self._local = threading.local()
+        for connection in connections:
+            connection.close()
+
+    def load(self):
+        """Load the equipment and the list of players."""
+        connection = self._connection()
+        equipment = {}
+        for name, category, qualities in connection.execute(
+                'SELECT name, category, qualities FROM equipment'):
+            equipment[name] = {
+                'category': category,
+                'qualities': json.loads(qualities),
+            }
+            self._saved_equipment[name] = (category, qualities)
+        player_ids = [
+            player_id for (player_id,) in connection.execute(
+                'SELECT player_id FROM characters ORDER BY player_id')
+        ]
+        sequence = connection.execute(
+            "SELECT value FROM meta WHERE key = 'journal_sequence'"
+        ).fetchone()
+        return (
+            equipment,
+            LazyCharacters(self._load_character, player_ids),
+            int(sequence[0]) if sequence else 0,
+        )
+
+    def _load_character(self, player_id):
+        """Load one character from the database."""
+        connection = self._connection()
+        (sheet,) = connection.execute(
+            'SELECT sheet FROM characters WHERE player_id = ?', (player_id,)
+        ).fetchone()
+        data = json.loads(sheet)
+        for table, column, path, encoded in _LIST_TABLES:
+            entries = [
+                entry for (entry,) in connection.execute(
+                    'SELECT {} FROM {} WHERE player_id = ? '
+                    'ORDER BY position'.format(column, table),
+                    (player_id,),
+                )
+            ]
+            self._saved_lists[table, player_id] = list(entries)
+            if encoded:
+                entries = [_decode(entry) for entry in entries]
+            _get_path(data, path[:-1])[path[-1]] = entries
+        character = Character()
+        character.from_dict(data)
+        return character
+
+    def save(  # pylint: disable=R0913
+            self, equipment, characters, changed_players, journal_sequence):
+        """Update the rows for changed players and equipment, in a single
+        transaction."""
+        connection = self._connection()
+        try:
+            with connection:
+                for player_id in changed_players:
+                    if player_id in characters:
+                        self._save_character(connection, player_id,
+                                             characters[player_id].to_dict())
+                    else:
+                        self._delete_character(connection, player_id)
+                if equipment is not None:
+                    self._save_equipment(connection, equipment)
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) "
+                    "VALUES ('journal_sequence', ?)",
+                    (str(journal_sequence),),
+                )
+        except Exception:
+            # The record of what was last saved may now be wrong, so make
+            # sure the next save rewrites everything it touches.
+            self._saved_lists = {}
+            self._saved_equipment = {
+                name: (category, qualities)
+                for name, category, qualities in connection.execute(
+                    'SELECT name, category, qualities FROM equipment')
+            }
+            raise
+
+    def _save_character(self, connection, player_id, data):
+        """Update one character's rows."""
+        sheet = dict(data)
+        sheet['xp'] = dict(sheet['xp'])
+        for table, column, path, encoded in _LIST_TABLES:
+            entries = _get_path(data, path)
+            if encoded:
+                entries = [
+                    json.dumps(entry, sort_keys=True) for entry in entries
+                ]
+            _get_path(sheet, path[:-1])[path[-1]] = []
+            self._save_list(connection, table, column, player_id, entries)
+        connection.execute(
+            'INSERT OR REPLACE INTO characters (player_id, sheet) '
+            'VALUES (?, ?)',
+            (player_id, json.dumps(sheet)),
+        )
+
+    def _save_list(self, connection, table, column,  # pylint: disable=R0913
+                   player_id, entries):
+        """Write the entries of a list that differ from the last save."""
+        saved = self._saved_lists.get((table, player_id), [])
+        unchanged = 0
+        for saved_entry, entry in zip(saved, entries):
+            if saved_entry != entry:
+                break
+            unchanged += 1
+        if unchanged == len(saved) == len(entries):
+            return
+        connection.execute(
+            'DELETE FROM {} WHERE player_id = ? AND position >= ?'.format(
+                table),
+            (player_id, unchanged),
+        )
+        connection.executemany(
+            'INSERT INTO {} (player_id, position, {}) VALUES (?, ?, ?)'.format(
+                table, column),
+            [
+                (player_id, position, entry)
+                for position, entry in enumerate(entries[unchanged:],
+                                                 start=unchanged)
+            ],
+        )
+        self._saved_lists[table, player_id] = list(entries)
+
+    def _delete_character(self, connection, player_id):
+        """Remove a character's rows."""
+        connection.execute('DELETE FROM characters WHERE player_id = ?',
+                           (player_id,))
+        for table, _, _, _ in _LIST_TABLES:
+            connection.execute(
+                'DELETE FROM {} WHERE player_id = ?'.format(table),
+                (player_id,),
+            )
+            self._saved_lists.pop((table, player_id), None)
+
+    def _save_equipment(self, connection, equipment):
+        """Write equipment that differs from the last save."""
+        for name in set(self._saved_equipment) - set(equipment):
+            connection.execute('DELETE FROM equipment WHERE name = ?',
+                               (name,))
+            self._saved_equipment.pop(name)
+        for name, details in equipment.items():
+            row = (details['category'], json.dumps(details['qualities']))
+            if self._saved_equipment.get(name) != row:
+                connection.execute(
+                    'INSERT OR REPLACE INTO equipment '
+                    '(name, category, qualities) VALUES (?, ?, ?)',
+                    (name,) + row,
+                )
+                self._saved_equipment[name] = row
+
+
+def migrate(save_path):
+    """Copy a file based session save into an SQLite database in the same
+    directory. Returns the number of players migrated.
+    """
+    files = ShardedStorage(save_path)
+    equipment, characters, sequence = files.load()
+    database = SQLiteStorage(save_path)
+    try:
+        database.save(equipment, characters, set(characters), sequence)
+    finally:
+        database.close()
+    return len(characters)
+
+
+def _test_round_trip():
+    print('Checking SQLite round trip...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = SQLiteStorage(tmp)
+        characters = LazyCharacters()
+        characters[1] = Character()
+        characters[1].award_xp(3, 'testing')
+        characters[1].notes.append('Owes a boon')
+        characters[2] = Character()
+        storage.save({'Stake': {'category': 'weapon', 'qualities': ['wood']}},
+                     characters, {1, 2}, 4)
+
+        characters[1].notes.append('Second note')
+        characters[1].notes.pop(0)
+        storage.save(None, characters, {1}, 5)
+        expected = characters[1].to_json()
+        storage.close()
+
+        storage = SQLiteStorage(tmp)
+        equipment, characters, sequence = storage.load()
+        assert sequence == 5
+        assert equipment['Stake']['qualities'] == ['wood']
+        assert sorted(characters) == [1, 2]
+        assert not characters.loaded()
+        assert characters[1].to_json() == expected
+
+        characters.pop(2)
+        storage.save({}, characters, {2}, 6)
+        storage.close()
+        equipment, characters, _ = SQLiteStorage(tmp).load()
+        assert equipment == {}
+        assert sorted(characters) == [1]
+    print(' OK.')
+
+
+def _test_migrate():
+    print('Checking migration from a session.save...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        character = Character()
+        character.character = 'Alucard'
+        character.notes.append('Hates garlic')
+        with open(os.path.join(tmp, 'session.save'), 'w',
+                  encoding='utf-8') as save_handle:
+            json.dump({
+                'equipment': {},
+                'player_characters': {'7': character.to_dict()},
+            }, save_handle)
+        assert migrate(tmp) == 1
+        _, characters, _ = SQLiteStorage(tmp).load()
+        assert characters[7].to_json() == character.to_json()
+    print(' OK.')
+
+
+def _test_close_all_threads():
+    print('Checking every thread\'s connection is closed...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = SQLiteStorage(tmp)
+        connections = []
+
+        def connect():
+            connections.append(storage._connection())  # pylint: disable=W0212
+
+        thread = threading.Thread(target=connect)
+        thread.start()
+        thread.join()
+        storage.close()
+        try:
+            connections[0].execute('SELECT 1')
+            assert False
+        except sqlite3.ProgrammingError:
+            pass
+        # Connecting again after closing gets a new connection
+        assert storage.load()[2] == 0
+        storage.close()
+    print(' OK.')
+
+
+if __name__ == '__main__':
+    _test_round_trip()
+    _test_migrate()
+    _test_close_all_threads()
@@ -0,0 +1,309 @@
+"""On-disk storage for vampire sessions."""
+from collections.abc import MutableMapping
+import json
+import os
+import tempfile
+import threading
+import time
+
+from .sheet import Character
+from .snapshot import write_atomically
+from .tracking import is_recording, record
+
+LEGACY_SAVE_NAME = 'session.save'
+INDEX_NAME = 'session.index'
+PLAYERS_DIR = 'players'
+XP_ARCHIVE_DIR = 'xp-archive'
+
+
+class LazyCharacters(MutableMapping):
+    """Player characters by player ID, each loaded on first access.
+    Adding, replacing, and removing characters is tracked for undo.
+    Characters may be loaded from several threads at once, but each is only
+    loaded once.
+    """
+    def __init__(self, load_character=None, player_ids=()):
+        self._load_character = load_character
+        self._characters = dict.fromkeys(player_ids)
+        # Held while loading, adding, or removing characters
+        self._lock = threading.RLock()
+
+    def __getitem__(self, player_id):
+        character = self._characters[player_id]
+        if character is None:
+            with self._lock:
+                # Another thread may have loaded it while this one waited
+                character = self._characters[player_id]
+                if character is None:
+                    character = self._load_character(player_id)
+                    self._characters[player_id] = character
+        return character
+
+    def __setitem__(self, player_id, character):
+        with self._lock:
+            if is_recording():
+                self._record_old(player_id)
+            self._characters[player_id] = character
+
+    def __delitem__(self, player_id):
+        with self._lock:
+            if is_recording():
+                self._record_old(player_id)
+            del self._characters[player_id]
+
+    def _record_old(self, player_id):
+        """Record how to restore the current character for a player."""
+        if player_id in self._characters:
+            record(self.__setitem__, player_id, self[player_id])
+        else:
+            record(self.__delitem__, player_id)
+
+    def __contains__(self, player_id):
+        return player_id in self._characters
+
+    def __iter__(self):
+        return iter(self._characters)
+
+    def __len__(self):
+        return len(self._characters)
+
+    def loaded(self):
+        """Return the characters that have been loaded so far."""
+        return {
+            player_id: character
+            for player_id, character in self._characters.items()
+            if character is not None
+        }
+
+
+class Storage:
+    """Interface for session storage backends."""
+    def __init__(self, save_path):
+        self.save_path = save_path
+
+    def load(self):
+        """Load the session.
+        Returns the equipment, the characters (which may be loaded lazily),
+        and the last journal sequence number included in the save.
+        """
+        raise NotImplementedError
+
+    def needs_full_save(self):  # pylint: disable=R0201
+        """Check whether the next save must write everything."""
+        return False
+
+    def save(  # pylint: disable=R0913
+            self, equipment, characters, changed_players, journal_sequence):
+        """Save the changed players, and the equipment unless it is None.
+        Changed players that are no longer in the session are removed.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by the storage."""
+
+    def archive_xp_log(self, player_id, entries):
+        """Append XP log entries compacted out of a character's log to the
+        player's archive file, one JSON entry per line."""
+        archive_dir = os.path.join(self.save_path, XP_ARCHIVE_DIR)
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(archive_dir, '{}.jsonl'.format(player_id))
+        with open(path, 'a', encoding='utf-8') as archive_handle:
+            for entry in entries:
+                archive_handle.write(json.dumps(entry.to_dict()) + '\n')
+            archive_handle.flush()
+            os.fsync(archive_handle.fileno())
+
+
+class ShardedStorage(Storage):
+    """Session storage with one file per player, plus one for equipment.
+
+    An index names the current file for each player. Every save writes the
+    files it changes under new names and then replaces the index, so a crash
+    part way through a save leaves the previous save intact.
+    """
+    def __init__(self, save_path):
+        super().__init__(save_path)
+        self._index = {
+            'generation': 0,
+            'journal_sequence': 0,
+            'equipment': None,
+            'players': {},
+        }
+
+    def _path(self, name):
+        """Get the full path of a file in this storage."""
+        return os.path.join(self.save_path, name)
+
+    def load(self):
+        """Load the session index and equipment.
+        Older single-file saves are loaded in full, to be written out as
+        separate files on the next save.
+        """
+        index_path = self._path(INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, encoding='utf-8') as index_handle:
+                self._index = json.load(index_handle)
+            equipment = {}
+            if self._index['equipment']:
+                with open(self._path(self._index['equipment']),
+                          encoding='utf-8') as equipment_handle:
+                    equipment = json.load(equipment_handle)
+            characters = LazyCharacters(
+                self._load_character,
+                [int(player_id) for player_id in self._index['players']],
+            )
+            return equipment, characters, self._index['journal_sequence']
+
+        characters = LazyCharacters()
+        legacy_path = self._path(LEGACY_SAVE_NAME)
+        if not os.path.exists(legacy_path):
+            return {}, characters, 0
+        with open(legacy_path, encoding='utf-8') as save_handle:
+            data = json.load(save_handle)
+        for player_id, character_data in data['player_characters'].items():
+            character = Character()
+            character.from_dict(character_data)
+            characters[int(player_id)] = character
+        return data['equipment'], characters, data.get('journal_sequence', 0)
+
+    def needs_full_save(self):
+        """Check whether the next save must write every file."""
+        return self._index['equipment'] is None
+
+    def _load_character(self, player_id):
+        """Load one character from its file."""
+        with open(self._path(self._index['players'][str(player_id)]),
+                  encoding='utf-8') as character_handle:
+            character = Character()
+            character.from_dict(json.load(character_handle))
+        return character
+
+    def save(  # pylint: disable=R0913
+            self, equipment, characters, changed_players, journal_sequence):
+        """Write the files for changed players and the equipment, then point
+        the index at them."""
+        generation = self._index['generation'] + 1
+        players = dict(self._index['players'])
+        obsolete = []
+
+        os.makedirs(self._path(PLAYERS_DIR), exist_ok=True)
+        for player_id in changed_players:
+            old_name = players.pop(str(player_id), None)
+            if old_name:
+                obsolete.append(old_name)
+            if player_id in characters:
+                name = os.path.join(PLAYERS_DIR, '{}-{}.json'.format(
+                    player_id, generation))
+                write_atomically(
+                    self._path(name),
+                    json.dumps(characters[player_id].to_dict()) + '\n',
+                )
+                players[str(player_id)] = name
+
+        equipment_name = self._index['equipment']
+        if equipment is not None or equipment_name is None:
+            if equipment_name:
+                obsolete.append(equipment_name)
+            equipment_name = 'equipment-{}.json'.format(generation)
+            write_atomically(self._path(equipment_name),
+                             json.dumps(equipment or {}) + '\n')
+
+        index = {
+            'generation': generation,
+            'journal_sequence': journal_sequence,
+            'equipment': equipment_name,
+            'players': players,
+        }
+        write_atomically(self._path(INDEX_NAME), json.dumps(index) + '\n')
+        self._index = index
+
+        for name in obsolete:
+            try:
+                os.unlink(self._path(name))
+            except FileNotFoundError:
+                pass
+
+
+def _test_lazy_loading():
+    print('Checking characters are loaded on demand...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = ShardedStorage(tmp)
+        characters = LazyCharacters()
+        for player_id in (1, 2, 3):
+            characters[player_id] = Character()
+            characters[player_id].player = 'Player {}'.format(player_id)
+        storage.save({'Stake': {'category': 'weapon', 'qualities': []}},
+                     characters, {1, 2, 3}, 7)
+
+        storage = ShardedStorage(tmp)
+        equipment, characters, sequence = storage.load()
+        assert sequence == 7
+        assert 'Stake' in equipment
+        assert sorted(characters) == [1, 2, 3]
+        assert 2 in characters
+        assert not characters.loaded()
+        assert characters[2].player == 'Player 2'
+        assert list(characters.loaded()) == [2]
+    print(' OK.')
+
+
+def _test_changed_only():
+    print('Checking only changed players are saved...', end='')
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = ShardedStorage(tmp)
+        characters = LazyCharacters()
+        characters[1] = Character()
+        characters[2] = Character()
+        storage.save({}, characters, {1, 2}, 0)
+        untouched = os.path.join(tmp, PLAYERS_DIR, '2-1.json')
+
+        characters[1].character = 'Alucard'
+        characters.pop(2)
+        characters[3] = Character()
+        storage.save(None, characters, {1, 2, 3}, 0)
+        assert sorted(os.listdir(os.path.join(tmp, PLAYERS_DIR))) == [
+            '1-2.json', '3-2.json']
+        assert sorted(os.listdir(tmp)) == [
+            'equipment-1.json', PLAYERS_DIR, INDEX_NAME]
+        assert not os.path.exists(untouched)
+
+        characters[3].character = 'Mina'
+        storage.save(None, characters, {3}, 0)
+        assert sorted(os.listdir(os.path.join(tmp, PLAYERS_DIR))) == [
+            '1-2.json', '3-3.json']
+
+        _, characters, _ = ShardedStorage(tmp).load()
+        assert characters[1].character == 'Alucard'
+        assert characters[3].character == 'Mina'
+    print(' OK.')
+
+
+def _test_concurrent_loading():
+    print('Checking characters are only loaded once...', end='')
+    loads = []
+
+    def load_slowly(player_id):
+        loads.append(player_id)
+        time.sleep(0.05)
+        return Character()
+
+    characters = LazyCharacters(load_slowly, (1,))
+    seen = []
+    threads = [
+        threading.Thread(target=lambda: seen.append(characters[1]))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == [1]
+    assert all(character is seen[0] for character in seen)
+    print(' OK.')
+
+
+if __name__ == '__main__':
+    _test_lazy_loading()
+    _test_changed_only()
+    _test_concurrent_loading()
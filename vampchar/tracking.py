@@ -0,0 +1,628 @@
+"""Tracking of changes to character sheets, for undo and redo.
+
+Tracked containers record how to reverse each change made to them while a
+recording is active. Each recorded change is a small tuple of a function and
+its arguments, so the cost of recording is proportional to the change rather
+than to the sheet being changed.
+
+Every tracked value also knows its owner, and tells it when it changes, so
+e.g. a character can tell when anything on its sheet has changed.
+"""
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from copy import deepcopy
+
+_RECORDINGS = ContextVar('recordings', default=())
+_MISSING = object()
+
+
+def record(undo, *args):
+    """Record how to reverse a change in all active recordings."""
+    for changes in _RECORDINGS.get():
+        changes.append((undo, args))
+
+
+def is_recording():
+    """Check whether changes are currently being recorded."""
+    return bool(_RECORDINGS.get())
+
+
+@contextmanager
+def recording():
+    """Record how to reverse every tracked change made in this context.
+    Recordings may be nested; changes are recorded in all of them.
+    """
+    changes = []
+    token = _RECORDINGS.set(_RECORDINGS.get() + (changes,))
+    try:
+        yield changes
+    finally:
+        _RECORDINGS.reset(token)
+
+
+def revert(changes):
+    """Reverse recorded changes, most recent first."""
+    for undo, args in reversed(changes):
+        undo(*args)
+
+
+def track(value, owner=None):
+    """Return a tracked version of a value, converting dicts and lists.
+    The owner will be told when the value changes."""
+    if isinstance(value, dict) and not isinstance(value, TrackedDict):
+        value = TrackedDict(value)
+    elif isinstance(value, list) and not isinstance(value, TrackedList):
+        value = TrackedList(value)
+    elif not isinstance(value, (TrackedDict, TrackedList, Tracked)):
+        return value
+    object.__setattr__(value, '_owner', owner)
+    return value
+
+
+def _touch(value):
+    """Tell a tracked value's owner that the value has changed."""
+    owner = getattr(value, '_owner', None)
+    if owner is not None:
+        owner.touch()
+
+
+class TrackedDict(dict):
+    """A dict that records how to reverse changes made to it."""
+    __slots__ = ('_owner',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._owner = None
+        for key, value in dict(*args, **kwargs).items():
+            dict.__setitem__(self, key, track(value, self))
+
+    def touch(self):
+        """Note that this dict, or something in it, has changed."""
+        _touch(self)
+
+    def _record_old(self, key):
+        """Record how to restore the current state of a key."""
+        old = self.get(key, _MISSING)
+        if old is _MISSING:
+            record(self.pop, key)
+        else:
+            record(self.__setitem__, key, old)
+
+    def __setitem__(self, key, value):
+        if is_recording():
+            self._record_old(key)
+        super().__setitem__(key, track(value, self))
+        self.touch()
+
+    def __delitem__(self, key):
+        if is_recording() and key in self:
+            self._record_old(key)
+        super().__delitem__(key)
+        self.touch()
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        if is_recording():
+            self._record_old(key)
+        value = super().pop(key)
+        self.touch()
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        if is_recording():
+            record(self.__setitem__, key, value)
+        self.touch()
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):  # pylint: disable=W0221
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        if is_recording():
+            record(self.update, dict(self))
+        super().clear()
+        self.touch()
+
+    def __deepcopy__(self, memo):
+        return type(self)({
+            key: deepcopy(value, memo) for key, value in self.items()
+        })
+
+
+class TrackedList(list):
+    """A list that records how to reverse changes made to it."""
+    __slots__ = ('_owner',)
+
+    def __init__(self, iterable=()):
+        super().__init__()
+        self._owner = None
+        super().extend(track(value, self) for value in iterable)
+
+    def touch(self):
+        """Note that this list, or something in it, has changed."""
+        _touch(self)
+
+    def _record_restore(self):
+        """Record how to restore the whole list as it is now."""
+        record(self.__setitem__, slice(None), list(self))
+
+    def append(self, value):
+        if is_recording():
+            record(self.__delitem__, len(self))
+        super().append(track(value, self))
+        self.touch()
+
+    def extend(self, iterable):
+        if is_recording():
+            record(self.__delitem__, slice(len(self), None))
+        super().extend(track(value, self) for value in iterable)
+        self.touch()
+
+    def __iadd__(self, iterable):
+        self.extend(iterable)
+        return self
+
+    def insert(self, index, value):
+        if is_recording():
+            if index < 0:
+                index = max(len(self) + index, 0)
+            record(self.__delitem__, min(index, len(self)))
+        super().insert(index, track(value, self))
+        self.touch()
+
+    def pop(self, index=-1):
+        value = super().pop(index)
+        if is_recording():
+            if index < 0:
+                index += len(self) + 1
+            record(self.insert, index, value)
+        self.touch()
+        return value
+
+    def remove(self, value):
+        self.pop(self.index(value))
+
+    def __setitem__(self, index, value):
+        if is_recording():
+            if isinstance(index, slice):
+                self._record_restore()
+            else:
+                record(self.__setitem__, index, self[index])
+        if isinstance(index, slice):
+            value = [track(item, self) for item in value]
+        else:
+            value = track(value, self)
+        super().__setitem__(index, value)
+        self.touch()
+
+    def __delitem__(self, index):
+        if is_recording():
+            if isinstance(index, slice):
+                self._record_restore()
+            else:
+                if index < 0:
+                    index += len(self)
+                record(self.insert, index, self[index])
+        super().__delitem__(index)
+        self.touch()
+
+    def clear(self):
+        if is_recording():
+            self._record_restore()
+        super().clear()
+        self.touch()
+
+    def sort(self, *args, **kwargs):
+        if is_recording():
+            self._record_restore()
+        super().sort(*args, **kwargs)
+        self.touch()
+
+    def reverse(self):
+        if is_recording():
+            self._record_restore()
+        super().reverse()
+        self.touch()
+
+    def __deepcopy__(self, memo):
+        return type(self)(deepcopy(value, memo) for value in self)
+
+
+class NameDict(TrackedDict):
+    """A tracked dict keyed by names, which can also be found ignoring
+    case. The case of names is kept as they were added."""
+    __slots__ = ('_names',)
+
+    def __init__(self, *args, **kwargs):
+        self._names = {}
+        super().__init__(*args, **kwargs)
+        for key in self:
+            self._names.setdefault(key.casefold(), key)
+
+    def find(self, name):
+        """Return the key matching a name ignoring case, or None."""
+        return self._names.get(name.casefold())
+
+    def resolve(self, name):
+        """Return the key matching a name ignoring case, or the name if
+        there is none."""
+        return self._names.get(name.casefold(), name)
+
+    def _unindex(self, key):
+        """Remove a key, which is no longer in the dict, from the index."""
+        folded = key.casefold()
+        if self._names.get(folded) == key:
+            del self._names[folded]
+            if len(self._names) != len(self):
+                # Older sheets may have the same name in different cases
+                for other in self:
+                    if other.casefold() == folded:
+                        self._names[folded] = other
+                        break
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._names.setdefault(key.casefold(), key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._unindex(key)
+
+    def pop(self, key, *default):
+        present = key in self
+        value = super().pop(key, *default)
+        if present:
+            self._unindex(key)
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._unindex(key)
+        return key, value
+
+    def clear(self):
+        super().clear()
+        self._names.clear()
+
+
+class PointsDict(NameDict):
+    """A NameDict of points, e.g. flaws by name, keeping a running total.
+    Set `check` to recount the total every time it is used, and fail if
+    the running total is wrong, e.g. in tests.
+    """
+    __slots__ = ('_total',)
+    check = False
+
+    def __init__(self, *args, **kwargs):
+        self._total = 0
+        super().__init__(*args, **kwargs)
+        self._total = sum(self.values())
+
+    def total(self):
+        """Return the total of the points."""
+        if self.check and self._total != sum(self.values()):
+            raise AssertionError('Running total {} should be {}.'.format(
+                self._total, sum(self.values())))
+        return self._total
+
+    def __setitem__(self, key, value):
+        self._total += value - self.get(key, 0)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        value = self[key]
+        super().__delitem__(key)
+        self._total -= value
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        self._total -= value
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._total -= value
+        return key, value
+
+    def clear(self):
+        super().clear()
+        self._total = 0
+
+
+class NameList(TrackedList):
+    """A tracked list of names, which can also be found ignoring case."""
+    __slots__ = ('_names',)
+
+    def __init__(self, iterable=()):
+        super().__init__(iterable)
+        self._names = {}
+        self._reindex()
+
+    def _reindex(self):
+        """Rebuild the index of names."""
+        self._names.clear()
+        for name in self:
+            self._names.setdefault(name.casefold(), name)
+
+    def find(self, name):
+        """Return the entry matching a name ignoring case, or None."""
+        return self._names.get(name.casefold())
+
+    def resolve(self, name):
+        """Return the entry matching a name ignoring case, or the name if
+        there is none."""
+        return self._names.get(name.casefold(), name)
+
+    def _unindex(self, name):
+        """Remove a name, which has just been removed, from the index."""
+        folded = name.casefold()
+        if self._names.get(folded) == name:
+            del self._names[folded]
+            if len(self._names) != len(self):
+                self._reindex()
+
+    def append(self, value):
+        super().append(value)
+        self._names.setdefault(value.casefold(), value)
+
+    def extend(self, iterable):
+        super().extend(iterable)
+        self._reindex()
+
+    def insert(self, index, value):
+        super().insert(index, value)
+        self._names.setdefault(value.casefold(), value)
+
+    def pop(self, index=-1):
+        value = super().pop(index)
+        self._unindex(value)
+        return value
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._reindex()
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            super().__delitem__(index)
+            self._reindex()
+        else:
+            value = self[index]
+            super().__delitem__(index)
+            self._unindex(value)
+
+    def clear(self):
+        super().clear()
+        self._names.clear()
+
+
+class History:
+    """Undo and redo stacks of recorded changes, each of limited depth."""
+    def __init__(self, depth=10):
+        self.undo_stack = deque(maxlen=depth)
+        self.redo_stack = deque(maxlen=depth)
+
+    def push(self, changes):
+        """Add a new set of changes, which can no longer be redone past."""
+        self.undo_stack.append(changes)
+        self.redo_stack.clear()
+
+    def undo(self):
+        """Reverse the most recent changes. Returns whether there were any."""
+        if not self.undo_stack:
+            return False
+        with recording() as changes:
+            revert(self.undo_stack.pop())
+        self.redo_stack.append(changes)
+        return True
+
+    def redo(self):
+        """Reapply the most recently undone changes.
+        Returns whether there were any."""
+        if not self.redo_stack:
+            return False
+        with recording() as changes:
+            revert(self.redo_stack.pop())
+        self.undo_stack.append(changes)
+        return True
+
+
+class Tracked:  # pylint: disable=R0903
+    """Mixin recording how to reverse changes to an object's attributes.
+    Dict and list attributes are converted to tracked ones as they are set.
+    """
+    __slots__ = ('_owner',)
+
+    def __setattr__(self, name, value):
+        if is_recording():
+            old = getattr(self, name, _MISSING)
+            if old is not _MISSING:
+                record(setattr, self, name, old)
+        super().__setattr__(name, track(value, self))
+        self.touch()
+
+    def touch(self):
+        """Note that this object, or something on it, has changed."""
+        _touch(self)
+
+
+def _test_dict():
+    print('Checking tracked dict undo...', end='')
+    data = TrackedDict({'a': 1, 'nested': {'b': [1, 2]}})
+    original = {'a': 1, 'nested': {'b': [1, 2]}}
+    with recording() as changes:
+        data['a'] = 2
+        data['c'] = 3
+        data.pop('nested')
+        data.setdefault('d', []).append(4)
+        data.update(e=5)
+    assert data == {'a': 2, 'c': 3, 'd': [4], 'e': 5}
+    assert len(changes) == 6
+    with recording() as redo:
+        revert(changes)
+    assert data == original
+    revert(redo)
+    assert data == {'a': 2, 'c': 3, 'd': [4], 'e': 5}
+    print(' OK.')
+
+
+def _test_list():
+    print('Checking tracked list undo...', end='')
+    data = TrackedList(['a', 'b', 'c'])
+    with recording() as changes:
+        data.append('d')
+        data.remove('b')
+        data.insert(0, 'z')
+        data[1] = 'A'
+        data.pop()
+        del data[-1]
+        data.extend(['x', 'y'])
+        data.sort()
+    assert data == ['A', 'x', 'y', 'z']
+    with recording() as redo:
+        revert(changes)
+    assert data == ['a', 'b', 'c']
+    revert(redo)
+    assert data == ['A', 'x', 'y', 'z']
+    print(' OK.')
+
+
+def _test_attributes():
+    print('Checking tracked attribute undo...', end='')
+
+    class Sheet(Tracked):  # pylint: disable=R0903
+        """Test sheet."""
+        def __init__(self):
+            self.name = 'Alucard'
+            self.notes = []
+
+    sheet = Sheet()
+    assert isinstance(sheet.notes, TrackedList)
+    with recording() as changes:
+        sheet.name = 'Dracula'
+        sheet.notes.append('Count')
+        sheet.notes = ['Replaced']
+    assert isinstance(sheet.notes, TrackedList)
+    revert(changes)
+    assert sheet.name == 'Alucard'
+    assert sheet.notes == []
+    print(' OK.')
+
+
+def _test_history():
+    print('Checking undo history depth...', end='')
+    data = TrackedList()
+    history = History(depth=2)
+    for value in range(3):
+        with recording() as changes:
+            data.append(value)
+        history.push(changes)
+    assert history.undo() and history.undo()
+    assert not history.undo()
+    assert data == [0]
+    assert history.redo()
+    assert data == [0, 1]
+    with recording() as changes:
+        data.append(5)
+    history.push(changes)
+    assert not history.redo()
+    assert history.undo()
+    assert data == [0, 1]
+    print(' OK.')
+
+
+def _test_owners():
+    print('Checking owners are told of changes...', end='')
+
+    class Sheet(Tracked):  # pylint: disable=R0903
+        """Test sheet counting its changes."""
+        def __init__(self):
+            object.__setattr__(self, 'changes', 0)
+            self.skills = {'brawl': {'specialties': []}}
+
+        def touch(self):
+            object.__setattr__(self, 'changes', self.changes + 1)
+
+    sheet = Sheet()
+    changes = sheet.changes
+    sheet.skills['brawl']['specialties'].append('grappling')
+    assert sheet.changes == changes + 1
+    sheet.skills.pop('missing', None)
+    assert sheet.changes == changes + 1
+    del sheet.skills['brawl']
+    assert sheet.changes == changes + 2
+    print(' OK.')
+
+
+def _test_names():
+    print('Checking names can be found ignoring case...', end='')
+    skills = NameDict({'Brawl': 2, 'brawl': 1})
+    assert skills.find('BRAWL') == 'Brawl'
+    assert skills.resolve('Melee') == 'Melee'
+    with recording() as changes:
+        del skills['Brawl']
+        assert skills.find('brawl') == 'brawl'
+        skills.pop('brawl')
+        skills['Melee'] = 1
+    assert skills.find('brawl') is None
+    revert(changes)
+    assert skills.find('melee') is None
+    assert skills.find('brawl') in ('Brawl', 'brawl')
+
+    derangements = NameList(['Paranoia'])
+    with recording() as changes:
+        derangements.append('Amnesia')
+        derangements.remove('Paranoia')
+    assert derangements.find('amnesia') == 'Amnesia'
+    assert derangements.find('paranoia') is None
+    revert(changes)
+    assert derangements.find('PARANOIA') == 'Paranoia'
+    assert derangements.find('amnesia') is None
+    print(' OK.')
+
+
+def _test_points():
+    print('Checking running point totals...', end='')
+    PointsDict.check = True
+    try:
+        flaws = PointsDict({'Bad Sight': 2})
+        with recording() as changes:
+            flaws['Dark Secret'] = 1
+            flaws['Bad Sight'] = 3
+            flaws.setdefault('Enemy', 2)
+            flaws.pop('Dark Secret')
+        assert flaws.total() == 5
+        revert(changes)
+        assert flaws.total() == 2
+        flaws.clear()
+        assert flaws.total() == 0
+        dict.__setitem__(flaws, 'Hidden', 1)
+        try:
+            flaws.total()
+            assert False
+        except AssertionError as err:
+            assert 'should be 1' in str(err)
+    finally:
+        PointsDict.check = False
+    print(' OK.')
+
+
+if __name__ == '__main__':
+    _test_dict()
+    _test_list()
+    _test_attributes()
+    _test_history()
+    _test_owners()
+    _test_names()
+    _test_points()
@@ -0,0 +1,182 @@
+"""XP costs of improving a character, by generation.
+
+The cost tables are built once and shared by all characters. Each entry is a
+rule that can both work out a cost and describe itself for display.
+"""
+from types import MappingProxyType
+
+
+class Cost:
+    """A rule for the XP cost of something."""
+    __slots__ = ()
+
+    def cost(self, current_level):
+        """Return the cost of raising something from its current level, or
+        of buying something of the given rating."""
+        raise NotImplementedError
+
+    def describe(self):
+        """Return how this cost is shown in the XP cost listing."""
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.describe())
+
+
+class FlatCost(Cost):
+    """The same cost every time."""
+    __slots__ = ('amount',)
+
+    def __init__(self, amount):
+        self.amount = amount
+
+    def cost(self, current_level):  # pylint: disable=W0613
+        return self.amount
+
+    def describe(self):
+        return self.amount
+
+
+class PerLevelCost(Cost):
+    """A cost of the new level times a multiplier."""
+    __slots__ = ('multiplier',)
+
+    def __init__(self, multiplier):
+        self.multiplier = multiplier
+
+    def cost(self, current_level):
+        return (current_level + 1) * self.multiplier
+
+    def describe(self):
+        return 'new level x {}'.format(self.multiplier)
+
+
+class RatingCost(Cost):
+    """A cost of the rating of the thing bought, times a multiplier."""
+    __slots__ = ('multiplier',)
+
+    def __init__(self, multiplier=1):
+        self.multiplier = multiplier
+
+    def cost(self, current_level):
+        return current_level * self.multiplier
+
+    def describe(self):
+        if self.multiplier == 1:
+            return 'rating'
+        return 'rating x {}'.format(self.multiplier)
+
+
+class LimitedCost(FlatCost):
+    """A flat cost for something of which only one may be bought, shared
+    with other things in the same group."""
+    __slots__ = ('group',)
+
+    def __init__(self, amount, group):
+        super().__init__(amount)
+        self.group = group
+
+    def describe(self):
+        return '(max one {}) {}'.format(self.group, self.amount)
+
+
+class NotAllowed(Cost):
+    """Something that can't be bought."""
+    __slots__ = ()
+
+    def cost(self, current_level):  # pylint: disable=W0613
+        raise ValueError('This is not allowed at this generation.')
+
+    def describe(self):
+        return 'Not allowed'
+
+
+ELDER_POWERS = 'in/out-of-clan elder power'
+
+
+def _build_costs(generation):
+    """Build the cost rules for a generation."""
+    costs = {
+        'Attribute': FlatCost(3),
+        'In-clan discipline': PerLevelCost(3),
+        'Regain lost humanity': FlatCost(10),
+        'Merit': RatingCost(),
+        'Ritual': RatingCost(2),
+        'Background': PerLevelCost(2),
+        'Skill': PerLevelCost(2),
+        'Out-of-clan discipline': PerLevelCost(4),
+        'Technique': FlatCost(12),
+        'In-clan elder power': NotAllowed(),
+        'Out-of-clan elder power': NotAllowed(),
+    }
+
+    if generation == 1:
+        costs['Background'] = PerLevelCost(1)
+        costs['Skill'] = PerLevelCost(1)
+    elif generation == 3:
+        costs['Technique'] = FlatCost(20)
+        costs['In-clan elder power'] = LimitedCost(18, ELDER_POWERS)
+        costs['Out-of-clan elder power'] = LimitedCost(24, ELDER_POWERS)
+    elif generation == 4:
+        costs['Technique'] = NotAllowed()
+        costs['In-clan elder power'] = FlatCost(18)
+        costs['Out-of-clan elder power'] = FlatCost(24)
+    elif generation == 5:
+        costs['Technique'] = NotAllowed()
+        costs['In-clan elder power'] = FlatCost(18)
+        costs['Out-of-clan elder power'] = FlatCost(30)
+        costs['Out-of-clan discipline'] = PerLevelCost(5)
+
+    return MappingProxyType(costs)
+
+
+GENERATIONS = range(1, 6)
+COST_TABLES = {
+    generation: _build_costs(generation) for generation in GENERATIONS
+}
+COST_LISTINGS = {
+    generation: MappingProxyType({
+        thing_type: rule.describe() for thing_type, rule in costs.items()
+    })
+    for generation, costs in COST_TABLES.items()
+}
+
+
+def cost_table(generation):
+    """Get the cost rules for a generation."""
+    try:
+        return COST_TABLES[generation]
+    except KeyError:
+        return _build_costs(generation)
+
+
+def cost_listing(generation):
+    """Get the displayed costs for a generation."""
+    try:
+        return COST_LISTINGS[generation]
+    except KeyError:
+        return MappingProxyType({
+            thing_type: rule.describe()
+            for thing_type, rule in cost_table(generation).items()
+        })
+
+
+def _test_costs():
+    print('Checking XP cost rules...', end='')
+    assert cost_table(1)['Skill'].cost(0) == 1
+    assert cost_table(2)['Skill'].cost(2) == 6
+    assert cost_table(5)['Out-of-clan discipline'].cost(1) == 10
+    assert cost_table(2)['Ritual'].cost(3) == 6
+    assert cost_table(3)['Attribute'].cost(7) == 3
+    assert cost_table(3)['In-clan elder power'].cost(0) == 18
+    try:
+        cost_table(4)['Technique'].cost(0)
+        assert False
+    except ValueError:
+        pass
+    assert cost_table(2) is cost_table(2)
+    print(' OK.')
+
+
+if __name__ == '__main__':
+    _test_costs()